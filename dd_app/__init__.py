@@ -4,27 +4,67 @@
 """
 
 from pyramid.config import Configurator
+from pyramid.settings import asbool
 
 from pyramid_beaker import set_cache_regions_from_settings
 from dd_app.jsonrpc import jsonrpc
-from dd_app.connections import MongoConnector, DDMongoConnector, DDRedisConnector
+from dd_app.connections import MongoConnector, DDMongoConnector, DDRedisConnector, mongo_options
 from dd_app.render import DDJSONRenderer
 from dd_app.socket.sessions import DDSockJSSession
+from dd_app.rules.registry import REGISTRY as RULES_REGISTRY
+from dd_app.rules.reload import RulesReloader
+from dd_app.batch import is_batch
+from dd_app.cache import UserCache, SessionCache, GameCache
 
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
     set_cache_regions_from_settings(settings)
+    RULES_REGISTRY.warm()
     config = Configurator(settings=settings)
     config.include(jsonrpc)
     config.add_renderer('ddjson', DDJSONRenderer)
-    config.registry.settings['mongodb.connector'] = DDMongoConnector(settings['mongodb.uri'], settings['mongodb.db'], settings['mongodb.users'])
+    user_cache_ttl = int(settings.get('dd_app.user_cache_ttl', 0))
+    user_cache = None
+    if user_cache_ttl > 0:
+        user_cache = UserCache(int(settings.get('dd_app.user_cache_size', 10000)), user_cache_ttl, config.registry.settings)
+    game_cache_ttl = int(settings.get('dd_app.game_cache_ttl', 0))
+    game_cache = None
+    if game_cache_ttl > 0:
+        game_cache = GameCache(int(settings.get('dd_app.game_cache_size', 1000)), game_cache_ttl, config.registry.settings)
+    config.registry.settings['mongodb.connector'] = DDMongoConnector(settings['mongodb.uri'], settings['mongodb.db'], settings['mongodb.users'],
+                                                                   node_layout=settings.get('mongodb.node_layout', 'array'),
+                                                                   queue_layout=settings.get('mongodb.queue_layout', 'embedded'),
+                                                                   user_cache=user_cache,
+                                                                   game_cache=game_cache,
+                                                                   **mongo_options(settings, 'mongodb'))
     if settings.get('mongodb_log.uri', None) is not None:
-        config.registry.settings['logdb.connector'] = MongoConnector(settings['mongodb_log.uri'], settings['mongodb_log.db'])
+        config.registry.settings['logdb.connector'] = MongoConnector(settings['mongodb_log.uri'], settings['mongodb_log.db'],
+                                                                     **mongo_options(settings, 'mongodb_log'))
     config.registry.settings['redis.connector'] = DDRedisConnector(settings['redis.host'], settings['redis.port'], settings['redis.db'], password=settings.get('redis.pass', None))
+    if user_cache is not None:
+        user_cache.start()
+    session_cache_size = int(settings.get('session.cache_size', 0))
+    if session_cache_size > 0:
+        config.registry.settings['session.cache'] = SessionCache(session_cache_size,
+                                                                 int(settings.get('session.cookie_cache_ttl', 0)),
+                                                                 config.registry.settings)
+        config.registry.settings['session.cache'].start()
+    reload_interval = int(settings.get('dd_app.rules_reload_interval', 0))
+    if reload_interval > 0:
+        config.registry.settings['rules.reloader'] = RulesReloader(config.registry.settings, reload_interval)
+        config.registry.settings['rules.reloader'].start()
+    config.add_tween('dd_app.compression.compression_tween_factory')
     config.include('pyramid_sockjs')
     #config.add_static_view('static', 'static', cache_max_age=3600)
     config.add_route('home', '/app/')
+    config.add_route('rules', '/app/rules/{hash}.json')
+    if asbool(settings.get('dd_app.metrics_enabled', False)):
+        # outside of /app/, which is proxied publicly
+        config.add_route('metrics', '/metrics')
+        config.add_view('dd_app.views.MetricsHandler', attr='metrics', route_name='metrics', renderer='json')
+    # batches are routed first, pyramid_rpc can't parse them
+    config.add_route('api_batch', '/app/api/', custom_predicates=(is_batch, ))
     config.add_jsonrpc_endpoint('api', '/app/api/', default_renderer='ddjson')
     config.add_sockjs_route(prefix='/__sockjs__', session=DDSockJSSession, sockjs_cdn='https://beta.datadealer.com/sockjs-0.3.4.min.js', cookie_needed=False)
     config.scan()
@@ -4,6 +4,7 @@
 from decorator import decorator
 from pyramid.httpexceptions import HTTPForbidden
 
+from dd_app.batch import GameContext
 from dd_app.django_codec import DjangoSessionCodec
 from dd_app.messaging.mixins import MsgMixin
 
@@ -11,6 +12,8 @@ class DDHandler(object):
     """Base view handler object
     """
 
+    _games_context = None
+
     def __init__(self, request, *args, **kwargs):
         self.request = request
 
@@ -30,6 +33,29 @@ class DDHandler(object):
     def settings(self):
         return self.request.registry.settings
 
+    @property
+    def games(self):
+        """The ``games`` collection, or the game context of a batch or of the game cache
+
+        See :py:class:`dd_app.batch.GameContext`.
+        """
+        if self._games_context is None and self.mongo.game_cache is not None:
+            self._games_context = GameContext(self.mongo.get_db()['games'], lambda: self.game_query_base, self.mongo.game_cache)
+        if self._games_context is not None:
+            return self._games_context
+        return self.mongo.get_db()['games']
+
+    def read_games(self, operation):
+        """The ``games`` collection for the read-only ``operation``
+
+        Reads with the read preference configured for ``operation``, see
+        :py:meth:`dd_app.connections.MongoConnector.get_db`. In a batch or
+        with the game cache, this is the game context like :py:attr:`games`.
+        """
+        if self._games_context is not None or self.mongo.game_cache is not None:
+            return self.games
+        return self.mongo.get_db(operation)['games']
+
     @property
     def cookies(self):
         return self.request.cookies
@@ -55,13 +81,23 @@ class DjangoSessionMixin(object):
             self._session_codec = DjangoSessionCodec(self.settings)
         return self._session_codec
 
+    @property
+    def session_cache(self):
+        """The :py:class:`dd_app.cache.SessionCache` of the process or None"""
+        return self.settings.get('session.cache', None)
+
     def get_session_cookie(self):
         if hasattr(self, '_token'):
             return self._token
         return self.cookies.get(self.settings['session.cookie_id'], None)
 
     def get_redis_session(self, key):
-        self._raw_session = self.redis.get().get(self._get_redis_key(key))
+        cache = self.session_cache
+        self._raw_session = cache.get_raw(key) if cache is not None else None
+        if self._raw_session is None:
+            self._raw_session = self.redis.get().get(self._get_redis_key(key))
+            if cache is not None and self._raw_session is not None:
+                cache.set_raw(key, self._raw_session)
         result = self._raw_session
         return result
 
@@ -72,7 +108,10 @@ class DjangoSessionMixin(object):
         session_data = self.get_redis_session(key)
         if session_data is None:
             return {} # no session data for key
-        session_dec, auth_uid = self.session_codec.decode(session_data)
+        if self.session_cache is not None:
+            session_dec, auth_uid = self.session_cache.decode(self.session_codec, session_data)
+        else:
+            session_dec, auth_uid = self.session_codec.decode(session_data)
         return session_dec
 
     @property
@@ -113,11 +152,20 @@ class DjangoSessionMixin(object):
             query_base.update({'version': version})
         return query_base
 
+    def _reset_session(self):
+        """Forgets session, user and game of a previous token"""
+        for key in ('_django_session', '_raw_session', '_userdata', '_game_version'):
+            self.__dict__.pop(key, None)
+        if self._games_context is not None:
+            self._games_context.invalidate()
+
     def _delete_session(self):
         del self._django_session
         del self._raw_session
         if hasattr(self, '_delkey'):
             self.redis.get().delete(self._get_redis_key(self._delkey))
+            if self.session_cache is not None and self._delkey is not None:
+                self.session_cache.invalidate(self._delkey)
             del self._delkey
 
     def _delete_cookie(self):
@@ -150,6 +198,9 @@ class BaseHandler(DDHandler, DjangoSessionMixin, MsgMixin):
 # see https://micheles.googlecode.com/hg/decorator/documentation.html
 @decorator
 def dd_protected(f, obj, token, *args, **kwargs):
+    if getattr(obj, '_token', token) != token:
+        # calls of a batch share the handler
+        obj._reset_session()
     obj._token = token
     if obj.auth_uid is None:
         raise HTTPForbidden('unauthorized')
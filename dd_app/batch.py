@@ -0,0 +1,215 @@
+"""JSON-RPC 2.0 batch requests on the ``api`` endpoint
+
+pyramid_rpc only handles single calls, batches (a json array of calls
+posted to ``/app/api/``) are routed to :py:class:`dd_app.views.BatchHandler`
+by :py:func:`is_batch`. All calls of a batch run in order on one
+:py:class:`dd_app.views.ApiHandler`, so the session is decoded and the user
+loaded once. The game document is loaded once as well and shared through a
+:py:class:`GameContext`, every write refreshes it from the
+``find_and_modify`` result. With a game cache (see
+:py:class:`dd_app.cache.GameCache`) single calls use a context too, loading
+the game from the cache. Action logs of the batch are sent as a single
+celery task.
+
+Only methods in ``ApiHandler.BATCH_METHODS`` may be batched.
+"""
+
+import copy
+import logging
+
+from pyramid.httpexceptions import HTTPForbidden
+from pyramid_rpc.jsonrpc import (JsonRpcError, JsonRpcInternalError, JsonRpcMethodNotFound,
+                                 JsonRpcParamsInvalid, JsonRpcRequestInvalid)
+from pyramid_rpc.mapper import MapplyViewMapper, ViewMapperArgsInvalid
+
+from dd_app.jsonrpc import JsonRpcUnauthorized
+from dd_app.metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 50
+
+# arrays matched by positional projections
+_ARRAYS = ('nodes', 'db_queue')
+
+
+def is_batch(info, request):
+    """Route predicate matching posted json arrays"""
+    return request.method == 'POST' and request.body.lstrip()[:1] == '['
+
+
+def _array_match(query, array):
+    prefix = array + '.'
+    return dict((key[len(prefix):], value) for key, value in query.iteritems() if key.startswith(prefix))
+
+def project(doc, query, fields):
+    """Returns a copy of ``doc`` restricted to ``fields``
+
+    Supports inclusion of top-level fields, fields of embedded documents
+    (``game_values.xp_value``) and positional projections (``nodes.$``) of
+    the arrays in ``_ARRAYS``. The element matched by ``query`` is returned,
+    or None if no element matches.
+    """
+    result = {'_id': doc['_id']}
+    for key in fields:
+        if key.endswith('.$'):
+            array = key[:-2]
+            match = _array_match(query, array)
+            elems = [e for e in doc.get(array, []) if all(e.get(f) == v for f, v in match.iteritems())]
+            if not elems:
+                return None
+            result[array] = [copy.deepcopy(elems[0])]
+        elif '.' in key:
+            head, tail = key.split('.', 1)
+            if isinstance(doc.get(head, None), dict) and tail in doc[head]:
+                result.setdefault(head, {})[tail] = copy.deepcopy(doc[head][tail])
+        elif key in doc:
+            result[key] = copy.deepcopy(doc[key])
+    return result
+
+
+class GameContext(object):
+    """Game document shared by the calls of a batch
+
+    Stands in for the ``games`` collection (see ``DDHandler.games``).
+    ``find_one`` queries of the user's game are answered from the loaded
+    document, other queries go to mongodb. Writes always go to mongodb,
+    ``find_and_modify`` fetches the whole new document to refresh the
+    context. Mutations still compare-and-swap ``nodes_lock``, so a stale
+    context can't overwrite concurrent changes.
+
+    With a ``cache``, the game is loaded from it, games loaded from mongodb
+    and results of ``find_and_modify`` are stored in it, other writes and
+    failed mutations invalidate it.
+
+    :param collection: the ``games`` collection
+    :param get_query_base: returns the query of the user's game, called when
+                           the game is loaded
+    :param cache: :py:class:`dd_app.cache.GameCache`, optional
+    """
+
+    def __init__(self, collection, get_query_base, cache=None):
+        self.collection = collection
+        self.get_query_base = get_query_base
+        self.cache = cache
+        self.game = None
+        self.loads = 0
+
+    def invalidate(self):
+        """Forgets the loaded game"""
+        self.game = None
+
+    def _changed(self):
+        # written without a result to refresh from
+        self.invalidate()
+        if self.cache is not None:
+            self.cache.invalidate(self.get_query_base())
+
+    def _supported(self, query, fields, query_base):
+        for key, value in query.iteritems():
+            if key in query_base:
+                if query_base[key] != value:
+                    return False
+            elif key.split('.', 1)[0] not in _ARRAYS or isinstance(value, dict):
+                return False
+        for key in fields:
+            if key.endswith('.$') and not _array_match(query, key[:-2]):
+                return False
+        return True
+
+    def find_one(self, query, fields=None):
+        query_base = self.get_query_base()
+        if fields is None or not self._supported(query, fields, query_base):
+            return self.collection.find_one(query, fields)
+        if self.game is None and self.cache is not None:
+            self.game = self.cache.get(query_base)
+        if self.game is None:
+            self.game = self.collection.find_one(query_base)
+            self.loads += 1
+            if self.game is None:
+                return None
+            if self.cache is not None:
+                self.cache.put(query_base, self.game, replace=False)
+        for array in _ARRAYS:
+            match = _array_match(query, array)
+            if match and not any(all(e.get(f) == v for f, v in match.iteritems()) for e in self.game.get(array, [])):
+                return None
+        return project(self.game, query, fields)
+
+    def find_and_modify(self, query, update, upsert=False, new=False, fields=None, **kwargs):
+        if upsert or not new:
+            result = self.collection.find_and_modify(query=query, update=update, upsert=upsert, new=new, fields=fields, **kwargs)
+            self._changed()
+            return result
+        result = self.collection.find_and_modify(query=query, update=update, upsert=False, new=True, **kwargs)
+        if result is None:
+            # stale game or failed guard
+            self._changed()
+            return None
+        self.game = result
+        if self.cache is not None:
+            self.cache.put(self.get_query_base(), result)
+        if fields is None:
+            return copy.deepcopy(result)
+        return project(result, query, fields)
+
+    def update(self, *args, **kwargs):
+        result = self.collection.update(*args, **kwargs)
+        self._changed()
+        return result
+
+
+def _call(handler, call):
+    if not isinstance(call, dict) or call.get('jsonrpc', None) != '2.0' \
+       or not isinstance(call.get('method', None), basestring):
+        raise JsonRpcRequestInvalid()
+    method = call['method']
+    if method not in handler.BATCH_METHODS:
+        raise JsonRpcMethodNotFound()
+    params = call.get('params', [])
+    if isinstance(params, dict):
+        keywords, params = params, ()
+    elif isinstance(params, list):
+        keywords = {}
+    else:
+        raise JsonRpcParamsInvalid()
+    try:
+        return MapplyViewMapper().mapply(getattr(handler, method), params, keywords)
+    except ViewMapperArgsInvalid:
+        raise JsonRpcParamsInvalid()
+
+def run_batch(handler, calls):
+    """Runs ``calls`` in order on ``handler``
+
+    Returns the list of JSON-RPC responses, without responses for
+    notifications. Errors are returned per call, like pyramid_rpc's
+    ``exception_view`` does for single calls.
+    """
+    if not isinstance(calls, list) or not calls or len(calls) > MAX_BATCH_SIZE:
+        return {'jsonrpc': '2.0', 'id': None, 'error': JsonRpcRequestInvalid().as_dict()}
+    context = GameContext(handler.mongo.get_db()['games'], lambda: handler.game_query_base, handler.mongo.game_cache)
+    handler._games_context = context
+    handler._batch_logs = []
+    responses = []
+    for call in calls:
+        rpc_id = call.get('id', None) if isinstance(call, dict) else None
+        try:
+            out = {'jsonrpc': '2.0', 'id': rpc_id, 'result': _call(handler, call)}
+        except Exception, exc:
+            if isinstance(exc, JsonRpcError):
+                fault = exc
+            elif isinstance(exc, HTTPForbidden):
+                fault = JsonRpcUnauthorized()
+            else:
+                fault = JsonRpcInternalError()
+                log.exception('json-rpc batch exception rpc_id:%s "%s"', rpc_id, exc)
+            out = {'jsonrpc': '2.0', 'id': rpc_id, 'error': fault.as_dict()}
+        if not isinstance(call, dict) or 'id' in call:
+            responses.append(out)
+    if handler._batch_logs:
+        from dd_app.tasks import logActions
+        logActions.apply_async(kwargs={'actions': handler._batch_logs})
+    METRICS.add('rpc.batch.count')
+    METRICS.add('rpc.batch.calls', len(calls))
+    METRICS.add('rpc.batch.game_loads', context.loads)
+    return responses
@@ -0,0 +1,357 @@
+"""In-process caches
+
+:py:class:`TTLCache` is a bounded LRU cache with expiring entries, safe to
+share between threads and greenlets. :py:class:`UserCache` keeps user
+documents by ``auth_uid`` for :py:class:`dd_app.connections.DDMongoConnector`,
+:py:class:`SessionCache` decoded django sessions for
+:py:class:`dd_app.base_handler.DjangoSessionMixin`. Their entries are
+invalidated in all processes through messages on the ``srv_msg`` channel.
+:py:class:`GameCache` keeps game documents in process and in Redis, for
+:py:class:`dd_app.batch.GameContext`.
+"""
+
+import copy
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from bson import BSON
+from bson.objectid import ObjectId
+
+from dd_app.messaging.messenger import Messenger, Message
+from dd_app.metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+
+class TTLCache(object):
+    """LRU cache of at most ``size`` entries, expiring ``ttl`` seconds after being set"""
+
+    def __init__(self, size, ttl, clock=time.time):
+        self.size = size
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            if entry[0] < self._clock():
+                return default
+            # most recently used last
+            self._entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self._clock() + self.ttl, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class BroadcastCache(object):
+    """Base of caches invalidated in all processes
+
+    Subclasses set ``action``, the :py:class:`dd_app.messaging.messenger.Messenger`
+    action of their invalidations, and implement :py:meth:`receive` and
+    :py:meth:`clear`.
+
+    :param settings: registry settings, used for the ``redis.connector`` to
+                     broadcast and receive invalidations
+    """
+    action = None
+
+    def __init__(self, settings=None):
+        self.settings = settings
+        self._pid = None
+
+    def broadcast(self, data):
+        if self.settings is not None:
+            self._messenger().broadcast(Message(action=self.action, data=data))
+
+    def receive(self, data):
+        """Applies an invalidation broadcast by any process"""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def _messenger(self):
+        return Messenger(settings=self.settings)
+
+    def listen(self):
+        while True:
+            try:
+                # own messenger, pubsub connections can't be shared
+                messenger = self._messenger()
+                messenger.attach()
+                for m in messenger.get_incoming():
+                    if m.action == self.action:
+                        self.receive(m.data)
+            except Exception:
+                log.exception('%s listener failed' % self.__class__.__name__)
+                # invalidations may have been missed meanwhile
+                self.clear()
+                time.sleep(1)
+
+    def start(self):
+        """Starts the invalidation listener, once per process
+
+        Safe to be called again after a fork, the cache inherited from the
+        parent is cleared then.
+        """
+        if self._pid == os.getpid():
+            return
+        if self._pid is not None:
+            self.clear()
+        self._pid = os.getpid()
+        thread = threading.Thread(target=self.listen, name='%s-listen' % self.action)
+        thread.daemon = True
+        thread.start()
+
+
+class UserCache(BroadcastCache):
+    """User documents by ``auth_uid``
+
+    Users are cached for at most ``ttl`` seconds, changes made by other
+    applications (e.g. deactivation by dd_auth) are seen after that.
+
+    :param size: maximum number of cached users
+    :param ttl: seconds users are cached
+    :param settings: see :py:class:`BroadcastCache`
+    """
+    action = Messenger.USER_INVALIDATE
+
+    def __init__(self, size, ttl, settings=None):
+        super(UserCache, self).__init__(settings)
+        self._users = TTLCache(size, ttl)
+        # auth_uid by user _id, to invalidate writes by _id
+        self._uids = TTLCache(size, ttl)
+        self._generation = 0
+
+    @property
+    def generation(self):
+        """Changes with every invalidation, see :py:meth:`set`"""
+        return self._generation
+
+    def get(self, auth_uid):
+        """Returns a copy of the cached user or None"""
+        user = self._users.get(auth_uid)
+        return None if user is None else copy.deepcopy(user)
+
+    def set(self, auth_uid, user, generation):
+        """Caches ``user`` read at ``generation``
+
+        Users read before an invalidation aren't cached, they may predate
+        the write.
+        """
+        if generation != self._generation:
+            return
+        self._users.set(auth_uid, copy.deepcopy(user))
+        self._uids.set(user['_id'], auth_uid)
+
+    def drop(self, auth_uid=None, oid=None):
+        """Removes a user from the cache of this process"""
+        self._generation += 1
+        if oid is not None:
+            auth_uid = self._uids.pop(oid, auth_uid)
+        if auth_uid is not None:
+            self._users.pop(auth_uid)
+
+    def invalidate(self, auth_uid=None, oid=None):
+        """Removes a user, by ``auth_uid`` or ``_id``, from the caches of all processes"""
+        self.drop(auth_uid, oid)
+        self.broadcast({'auth_uid': auth_uid, 'oid': oid})
+
+    def receive(self, data):
+        self.drop(data.get('auth_uid', None), data.get('oid', None))
+
+    def clear(self):
+        self._generation += 1
+        self._users.clear()
+        self._uids.clear()
+
+
+class SessionCache(BroadcastCache):
+    """Decoded django sessions
+
+    Sessions are decoded once per raw session data, keyed by its digest, so
+    changed sessions are decoded again. With ``cookie_ttl``, raw sessions
+    are also kept by session key for ``cookie_ttl`` seconds, skipping the
+    Redis read; a session deleted by a logout is forgotten by all processes,
+    other changes (e.g. by dd_auth) are seen after ``cookie_ttl``.
+
+    :param size: maximum number of decoded sessions and of session keys
+    :param cookie_ttl: seconds raw sessions are kept by session key, 0 reads
+                       them from Redis every time
+    :param settings: see :py:class:`BroadcastCache`
+    """
+    action = Messenger.SESSION_INVALIDATE
+
+    # decoded sessions don't change, they are only evicted to bound memory
+    DECODED_TTL = 3600
+
+    def __init__(self, size, cookie_ttl=0, settings=None):
+        super(SessionCache, self).__init__(settings)
+        self._decoded = TTLCache(size, self.DECODED_TTL)
+        self._raw = TTLCache(size, cookie_ttl) if cookie_ttl > 0 else None
+
+    @staticmethod
+    def digest(value):
+        return hashlib.sha256(value).hexdigest()
+
+    def decode(self, codec, session_data):
+        """Returns ``codec.decode(session_data)``, decoding once per distinct data"""
+        digest = self.digest(session_data)
+        decoded = self._decoded.get(digest)
+        if decoded is None:
+            decoded = codec.decode(session_data)
+            self._decoded.set(digest, decoded)
+        session_dec, auth_uid = decoded
+        return dict(session_dec), auth_uid
+
+    def get_raw(self, key):
+        """Returns the raw session of session ``key`` or None"""
+        if self._raw is None:
+            return None
+        return self._raw.get(self.digest(key))
+
+    def set_raw(self, key, session_data):
+        if self._raw is not None:
+            self._raw.set(self.digest(key), session_data)
+
+    def invalidate(self, key):
+        """Forgets session ``key`` in all processes"""
+        # session keys aren't broadcast, only their digest
+        data = {'key': self.digest(key)}
+        self.receive(data)
+        self.broadcast(data)
+
+    def receive(self, data):
+        if self._raw is not None:
+            session_data = self._raw.pop(data['key'])
+            if session_data is not None:
+                self._decoded.pop(self.digest(session_data))
+
+    def clear(self):
+        self._decoded.clear()
+        if self._raw is not None:
+            self._raw.clear()
+
+
+class GameCache(object):
+    """Game documents of active players
+
+    Games are cached as snapshots keyed by ``_id``, ``nodes_lock`` and a
+    stamp of the write, in process and in Redis. A Redis pointer per game
+    of a user (``dd_game:<user _id>:<version>``) names the current snapshot,
+    so all processes see a write as soon as it's cached. Snapshots never
+    change, only the pointer does, and only to a snapshot of a higher
+    ``nodes_lock``: a request finishing late can't replace a newer game.
+
+    Mutations still compare-and-swap ``nodes_lock``: a mutation computed
+    from a stale snapshot matches no document, which invalidates the pointer
+    (see :py:class:`dd_app.batch.GameContext`) and is retried from mongodb.
+    Writes not returning the new game have to :py:meth:`invalidate` it,
+    writes outside of mutations advance ``nodes_lock`` and pass it along.
+
+    :param size: maximum number of snapshots kept in process
+    :param ttl: seconds snapshots and pointers are kept
+    :param settings: registry settings, used for the ``redis.connector``
+    :param cacheable: returns False for games not to cache, optional
+    """
+    PREFIX = 'dd_game:'
+
+    def __init__(self, size, ttl, settings, cacheable=None):
+        self.ttl = ttl
+        self.settings = settings
+        self.cacheable = cacheable
+        self._snapshots = TTLCache(size, ttl)
+
+    @property
+    def redis(self):
+        return self.settings['redis.connector'].get()
+
+    def _pointer(self, query_base):
+        return '%s%s:%s' % (self.PREFIX, query_base['user.$id'], query_base.get('version', ''))
+
+    @staticmethod
+    def _lock(key):
+        # keys are '<_id>:<nodes_lock>:<stamp>', tombstones have no stamp
+        return int(key.split(':')[1] or 0)
+
+    def _swap(self, pointer, key, replace):
+        # moves the pointer to ``key`` unless it names a newer game
+        def swap(pipe):
+            current = pipe.get(pointer)
+            if current is not None:
+                lock, tombstone = self._lock(current), current.endswith(':')
+                if self._lock(key) < lock or (self._lock(key) == lock and not tombstone and not replace):
+                    return
+            pipe.multi()
+            pipe.set(pointer, key, ex=self.ttl)
+        self.redis.transaction(swap, pointer)
+
+    def get(self, query_base):
+        """Returns a copy of the current game of ``query_base`` or None"""
+        key = self.redis.get(self._pointer(query_base))
+        if key is not None and key.endswith(':'):
+            key = None
+        game = None if key is None else self._snapshots.get(key)
+        if game is not None:
+            METRICS.add('game_cache.hits')
+        elif key is not None:
+            data = self.redis.get(self.PREFIX + key)
+            if data is not None:
+                game = BSON(data).decode(tz_aware=True)
+                self._snapshots.set(key, game)
+                METRICS.add('game_cache.redis_hits')
+        if game is None or (self.cacheable is not None and not self.cacheable(game)):
+            METRICS.add('game_cache.misses')
+            return None
+        return copy.deepcopy(game)
+
+    def put(self, query_base, game, replace=True):
+        """Makes a copy of ``game`` the current game of ``query_base``
+
+        Games read rather than written (``replace=False``) don't replace a
+        current game of the same ``nodes_lock``. Games of a lower
+        ``nodes_lock`` than the current one are never cached.
+        """
+        if self.cacheable is not None and not self.cacheable(game):
+            self.invalidate(query_base)
+            return
+        key = '%s:%s:%s' % (game['_id'], game.get('nodes_lock', ''), ObjectId())
+        self._snapshots.set(key, copy.deepcopy(game))
+        self.redis.setex(self.PREFIX + key, self.ttl, BSON.encode(game))
+        self._swap(self._pointer(query_base), key, replace)
+
+    def invalidate(self, query_base, nodes_lock=None):
+        """Drops the current game of ``query_base`` in all processes
+
+        With the ``nodes_lock`` of the write invalidating the game, games
+        of a lower ``nodes_lock`` can't be cached afterwards either.
+        """
+        if nodes_lock is None:
+            self.redis.delete(self._pointer(query_base))
+        else:
+            self._swap(self._pointer(query_base), ':%s:' % nodes_lock, True)
@@ -0,0 +1,135 @@
+"""Negotiated gzip compression of responses
+
+Static data (the content-addressed client rules, see
+:py:mod:`dd_app.rules.client`) is compressed once when a ruleset is loaded,
+with :py:func:`precompress`. Other responses are compressed by
+:py:func:`compression_tween_factory` if the client accepts gzip and the body
+is at least ``dd_app.compress_min_size`` bytes. Settings::
+
+    dd_app.compress_level = 6       # zlib level for dynamic bodies, 0 disables
+    dd_app.compress_min_size = 1024 # smaller bodies are sent uncompressed
+
+Bytes in/out, compression ratio and CPU time are recorded per kind
+(``static``, ``dynamic``, ``stream``) in :py:data:`dd_app.metrics.METRICS`.
+"""
+
+import time
+import zlib
+
+from dd_app.metrics import METRICS
+
+STATIC_LEVEL = 9
+DEFAULT_LEVEL = 6
+DEFAULT_MIN_SIZE = 1024
+
+# gzip header and trailer instead of zlib's
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+_COMPRESSIBLE_TYPES = ('application/json', 'text/plain', 'text/html')
+
+
+def record(kind, size_in, size_out, cpu_time):
+    """Records a compressed body of ``kind`` in the metrics"""
+    prefix = 'compression.%s.' % kind
+    METRICS.add(prefix + 'count')
+    METRICS.add(prefix + 'bytes_in', size_in)
+    METRICS.add(prefix + 'bytes_out', size_out)
+    METRICS.add(prefix + 'cpu_time', cpu_time)
+    METRICS.set(prefix + 'ratio', float(METRICS.get(prefix + 'bytes_out')) / (METRICS.get(prefix + 'bytes_in') or 1))
+
+def gzip_compress(data, level=DEFAULT_LEVEL, kind='dynamic'):
+    """Returns ``data`` gzip compressed"""
+    start = time.clock()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+    result = compressor.compress(data) + compressor.flush()
+    record(kind, len(data), len(result), time.clock() - start)
+    return result
+
+def precompress(data):
+    """Compresses static ``data`` once, at the highest level"""
+    return gzip_compress(data, STATIC_LEVEL, kind='static')
+
+def gzip_iter(app_iter, level=DEFAULT_LEVEL):
+    """Compresses a streamed body chunk by chunk"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+    size_in = size_out = 0
+    cpu_time = 0.0
+    try:
+        for chunk in app_iter:
+            start = time.clock()
+            data = compressor.compress(chunk)
+            cpu_time += time.clock() - start
+            size_in += len(chunk)
+            if data:
+                size_out += len(data)
+                yield data
+        start = time.clock()
+        data = compressor.flush()
+        cpu_time += time.clock() - start
+        size_out += len(data)
+        yield data
+    finally:
+        close = getattr(app_iter, 'close', None)
+        if close is not None:
+            close()
+    record('stream', size_in, size_out, cpu_time)
+
+def accepts_gzip(request):
+    """Returns True if ``request`` accepts gzip content coding"""
+    header = request.headers.get('Accept-Encoding', None)
+    if not header:
+        return False
+    codings = {}
+    for coding in header.split(','):
+        params = coding.split(';')
+        name = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[name] = q
+    for name in ('gzip', 'x-gzip', '*'):
+        if name in codings:
+            return codings[name] > 0
+    return False
+
+def add_vary(response):
+    vary = response.vary or ()
+    if 'Accept-Encoding' not in vary:
+        response.vary = tuple(vary) + ('Accept-Encoding', )
+
+def compression_tween_factory(handler, registry):
+    """Tween compressing responses for clients accepting gzip
+
+    Responses with a ``Content-Encoding`` already set (e.g. precompressed
+    static data) are passed through. Streamed bodies (see
+    :py:func:`dd_app.jsonrpc.make_streaming_response`) stay streamed.
+    """
+    level = int(registry.settings.get('dd_app.compress_level', DEFAULT_LEVEL))
+    min_size = int(registry.settings.get('dd_app.compress_min_size', DEFAULT_MIN_SIZE))
+    if level <= 0:
+        return handler
+
+    def compression_tween(request):
+        response = handler(request)
+        if response.status_int != 200 or response.content_encoding \
+           or response.content_type not in _COMPRESSIBLE_TYPES:
+            return response
+        add_vary(response)
+        if not accepts_gzip(request):
+            return response
+        if isinstance(response.app_iter, (list, tuple)):
+            body = response.body
+            if len(body) < min_size:
+                return response
+            response.body = gzip_compress(body, level)
+        else:
+            response.app_iter = gzip_iter(response.app_iter, level)
+        response.content_encoding = 'gzip'
+        return response
+
+    return compression_tween
@@ -0,0 +1,71 @@
+"""Optimistic concurrency for game mutations
+
+Mutations read the game, compute the update and write it with
+``find_and_modify``, guarded by a compare-and-swap on ``nodes_lock``. If the
+game changed in between, the write matches no document. The mutation raises
+:py:class:`WriteConflict` then and :py:func:`retry_on_conflict` runs it again
+from the read, after a jittered backoff. Settings::
+
+    dd_app.conflict_retries = 3     # retries before giving up
+    dd_app.conflict_backoff = 20    # max backoff of the first retry, in ms
+
+Conflicts, retries and failures are counted per method in
+:py:data:`dd_app.metrics.METRICS` (``rpc.<method>.conflicts`` etc.).
+"""
+
+import random
+import time
+
+from decorator import decorator
+
+from dd_app.metrics import METRICS
+
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 20
+
+
+class WriteConflict(Exception):
+    """Raised if a guarded write didn't match
+
+    :param error: error code returned to the client if retries are exhausted
+    """
+
+    def __init__(self, error):
+        Exception.__init__(self, error)
+        self.error = error
+
+
+def backoff(attempt, base):
+    """Returns seconds to wait before retry ``attempt`` (1-based)"""
+    return random.uniform(0, base * 2**(attempt - 1)) / 1000.0
+
+@decorator
+def retry_on_conflict(f, obj, *args, **kwargs):
+    """Retries handler method ``f`` on :py:class:`WriteConflict`
+
+    Every attempt runs the whole method again. Actions logged with
+    ``obj._log_action`` during a failed attempt are dropped.
+    """
+    settings = obj.settings
+    retries = int(settings.get('dd_app.conflict_retries', DEFAULT_RETRIES))
+    base = float(settings.get('dd_app.conflict_backoff', DEFAULT_BACKOFF))
+    name = f.__name__
+    attempt = 0
+    while True:
+        pending, obj._batch_logs = obj._batch_logs, []
+        try:
+            result = f(obj, *args, **kwargs)
+        except WriteConflict, exc:
+            METRICS.add('rpc.%s.conflicts' % name)
+            if attempt >= retries:
+                METRICS.add('rpc.%s.conflict_failures' % name)
+                return {'error': exc.error}
+            attempt += 1
+            METRICS.add('rpc.%s.retries' % name)
+            time.sleep(backoff(attempt, base))
+            continue
+        finally:
+            logs, obj._batch_logs = obj._batch_logs, pending
+        for log in logs:
+            obj._log_action(log)
+        return result
@@ -5,26 +5,125 @@ Helper classes providing connection to external services/storage providers
 import pymongo
 import redis
 import datetime
+import time
 from bson.dbref import DBRef
+from pymongo import pool
+from pymongo.read_preferences import ReadPreference
 
 from dd_app.rules import RulesVersion
+from dd_app.nodes import NodeStore, ARRAY
+from dd_app.queues import QueueStore, EMBEDDED
+from dd_app.metrics import METRICS
+
+READ_PREFERENCES = {'primary': ReadPreference.PRIMARY,
+                    'primary_preferred': ReadPreference.PRIMARY_PREFERRED,
+                    'secondary': ReadPreference.SECONDARY,
+                    'secondary_preferred': ReadPreference.SECONDARY_PREFERRED,
+                    'nearest': ReadPreference.NEAREST}
+
+# client settings (``<prefix>.<name>``) with the MongoClient option they set
+CLIENT_OPTIONS = {'max_pool_size': ('max_pool_size', int),
+                  'wait_queue_timeout_ms': ('waitQueueTimeoutMS', int),
+                  'wait_queue_multiple': ('waitQueueMultiple', int),
+                  'connect_timeout_ms': ('connectTimeoutMS', int),
+                  'socket_timeout_ms': ('socketTimeoutMS', int),
+                  'secondary_latency_ms': ('secondaryAcceptableLatencyMS', int),
+                  'replica_set': ('replicaSet', str),
+                  'read_preference': ('read_preference', lambda mode: READ_PREFERENCES[mode])}
+
+
+def mongo_options(settings, prefix='mongodb'):
+    """Returns the keyword arguments of :py:class:`MongoConnector` set in ``settings``
+
+    ``<prefix>.read_preference.<operation>`` sets the read preference of
+    ``get_db(operation)``.
+    """
+    client_options = {}
+    for name, (option, convert) in CLIENT_OPTIONS.items():
+        value = settings.get('%s.%s' % (prefix, name), None)
+        if value is not None:
+            client_options[option] = convert(value)
+    read_preferences = {}
+    operation_prefix = '%s.read_preference.' % prefix
+    for key, value in settings.items():
+        if key.startswith(operation_prefix):
+            read_preferences[key[len(operation_prefix):]] = value
+    return {'client_options': client_options, 'read_preferences': read_preferences}
+
+
+class TimedPool(pool.Pool):
+    """Connection pool counting socket checkouts in :py:data:`dd_app.metrics.METRICS`
+
+    ``mongodb.pool.checkouts`` counts checkouts, ``mongodb.pool.wait_ms``
+    sums the time they took (waiting for a free socket or connecting a new
+    one), ``mongodb.pool.wait_timeouts`` counts checkouts failed after
+    ``wait_queue_timeout_ms``.
+    """
+
+    def get_socket(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return pool.Pool.get_socket(self, *args, **kwargs)
+        finally:
+            METRICS.add('mongodb.pool.checkouts')
+            METRICS.add('mongodb.pool.wait_ms', (time.time() - start) * 1000)
+
+    def _raise_wait_queue_timeout(self):
+        METRICS.add('mongodb.pool.wait_timeouts')
+        pool.Pool._raise_wait_queue_timeout(self)
 
 
 class MongoConnector(object):
+    """MongoDB connector
+
+    :param uri: mongodb URI
+
+    :param db: mongodb database identifier
 
-    def __init__(self, uri, db):
+    :param client_options: keyword arguments of the client, see
+                           :py:func:`mongo_options`. A ``replicaSet`` makes
+                           it a MongoReplicaSetClient, which reads from
+                           secondaries.
+
+    :param read_preferences: read preference mode (e.g. ``secondary_preferred``)
+                             per operation name, see :py:meth:`get_db`
+    """
+
+    def __init__(self, uri, db, client_options=None, read_preferences=None):
         self._uri = uri
         self._db_name = db
+        self._client_options = client_options or {}
+        self._read_preferences = dict((operation, READ_PREFERENCES[mode])
+                                      for operation, mode in (read_preferences or {}).items())
+        self._operation_dbs = {}
 
     def get_connection(self):
         """Returns a pymongo connection"""
-        return pymongo.mongo_client.MongoClient(host=self._uri, use_greenlets=True, tz_aware=True)
+        if 'replicaSet' in self._client_options:
+            client = pymongo.mongo_replica_set_client.MongoReplicaSetClient
+        else:
+            client = pymongo.mongo_client.MongoClient
+        return client(host=self._uri, use_greenlets=True, tz_aware=True, _pool_class=TimedPool, **self._client_options)
 
-    def get_db(self):
-        """Returns a pymongo.database.Database instance"""
+    def get_db(self, operation=None):
+        """Returns a pymongo.database.Database instance
+
+        :param operation: name of a read-only operation; if a read preference
+                          is configured for it, the returned database reads
+                          with that preference. Writes always go to the
+                          primary.
+        """
         if not hasattr(self, '_db'):
             self._db = self.get_connection()[self._db_name]
-        return self._db
+        read_preference = self._read_preferences.get(operation, None)
+        if read_preference is None:
+            return self._db
+        db = self._operation_dbs.get(operation, None)
+        if db is None:
+            db = self._db.connection[self._db_name]
+            db.read_preference = read_preference
+            self._operation_dbs[operation] = db
+        return db
 
 
 class DDMongoConnector(MongoConnector):
@@ -36,42 +135,89 @@ class DDMongoConnector(MongoConnector):
 
     :param users: name of collection containing userdata
 
+    :param node_layout: storage layout of game nodes, see :py:mod:`dd_app.nodes`
+
+    :param queue_layout: storage layout of game queues, see :py:mod:`dd_app.queues`
+
+    :param client_options: see :py:class:`MongoConnector`
+
+    :param read_preferences: see :py:class:`MongoConnector`
+
+    :param user_cache: :py:class:`dd_app.cache.UserCache` of users read by
+                       :py:meth:`get_user_by_auth_uid`, optional
+
+    :param game_cache: :py:class:`dd_app.cache.GameCache` of games read and
+                       written by game actions, optional
+
     """
 
     def __init__(self, uri, db, users, *args, **kwargs):
-        self._uri = uri
-        self._db_name = db
+        super(DDMongoConnector, self).__init__(uri, db,
+                                               client_options=kwargs.get('client_options', None),
+                                               read_preferences=kwargs.get('read_preferences', None))
         self._users_collection = users
+        self.nodes = NodeStore(kwargs.get('node_layout', ARRAY))
+        self.queues = QueueStore(self.get_db, kwargs.get('queue_layout', EMBEDDED))
+        self.user_cache = kwargs.get('user_cache', None)
+        self.game_cache = kwargs.get('game_cache', None)
+        if self.game_cache is not None:
+            # moving embedded queues changes the game outside of mutations
+            self.game_cache.cacheable = self.queues.adopted
 
     def get_user_by_auth_uid(self, uid, *args):
-        """Fetch user by userid"""
+        """Fetch user by userid
+
+        With a user cache, the whole cached user is returned regardless of
+        the requested fields.
+        """
         # TODO move me to pseudomodel layer?
+        if self.user_cache is not None:
+            result = self.user_cache.get(uid)
+            if result is not None:
+                return result
+            generation = self.user_cache.generation
+            args = ()
         db = self.get_db()
         result = db[self._users_collection].find_one({'auth_uid': uid, 'auth_is_active': True}, *args)
         # db.connection.end_request()
+        if result is not None and self.user_cache is not None:
+            self.user_cache.set(uid, result, generation)
         return result
 
+    def invalidate_game(self, query_base, nodes_lock=None):
+        """Drops a game changed outside of a game context from the game cache
+
+        :param nodes_lock: ``nodes_lock`` of the game after the change, if
+                           the change advanced it
+        """
+        if self.game_cache is not None:
+            self.game_cache.invalidate(query_base, nodes_lock)
+
+    def invalidate_user(self, auth_uid=None, oid=None):
+        """Drops a changed user, by ``auth_uid`` or ``_id``, from the user cache"""
+        if self.user_cache is not None:
+            self.user_cache.invalidate(auth_uid, oid)
+
     def create_game(self, oid):
         """ FIXME this is a test only """
         db = self.get_db()
         rules = RulesVersion(lang='en')
         rules.set_newgame()
         uref = DBRef(collection=self._users_collection, id=oid)
-        game = rules.get_new_game()
+        game = self.nodes.prepare(rules.get_new_game())
         game['user'] = uref
-        db['games'].ensure_index('user.$id')
-        db['games'].ensure_index('version')
-        db['games'].ensure_index([('user.$id', pymongo.ASCENDING), ('version', pymongo.DESCENDING)])
-        db['games'].ensure_index('nodes.game_id')
-        db['games'].ensure_index('nodes.full_path')
-        db['games'].ensure_index([('nodes.instance_data.powerups.gestalt', pymongo.ASCENDING), ('nodes.instance_data.powerups.gestalt', pymongo.ASCENDING)])
         game['_id'] = db['games'].save(game, safe=True)
         db[self._users_collection].update({'_id': oid}, {'$set': {'game_version': game.get('version', None)}}, safe=True)
+        self.invalidate_user(oid=oid)
         # db.connection.end_request()
         return game
 
-    def get_game(self, oid, version=None):
-        """ FIXME this is a test only """
+    def get_game(self, oid, version=None, user=None):
+        """ FIXME this is a test only
+
+        :param user: the already loaded user ``oid`` (or the fields of it to
+                     return), the user reference is dereferenced otherwise
+        """
         query = {'user.$id':oid}
         created = False
         if version is not None:
@@ -81,37 +227,79 @@ class DDMongoConnector(MongoConnector):
         if result is None:
             result = self.create_game(oid)
             created = True
+            if user is not None:
+                # as written by create_game
+                user = dict(user, game_version=result.get('version', None))
         # deref user ref
-        u_deref = db.dereference(result['user'])
-        result['user'] = u_deref
+        if user is None:
+            user = db.dereference(result['user'])
+        result['user'] = user
         result['server_time'] = datetime.datetime.utcnow()
+        self.nodes.export(result)
+        self.queues.export(result)
         # db.connection.end_request()
         return result, created
 
+    def get_games(self, oids=None, version=None, user_fields=None, batch_size=100):
+        """Yields games, with their users, for tools
+
+        Users are dereferenced with one query per ``batch_size`` games. Games
+        are exported like by :py:meth:`get_game`, but not created.
+
+        :param oids: ids of the users whose games to load, all games if None
+        :param version: game version to load, all versions if None
+        :param user_fields: fields of the users to load, all if None
+        """
+        query = {}
+        if oids is not None:
+            query['user.$id'] = {'$in': list(oids)}
+        if version is not None:
+            query['version'] = version
+        batch = []
+        for game in self.get_db()['games'].find(query).batch_size(batch_size):
+            batch.append(game)
+            if len(batch) >= batch_size:
+                for game in self._with_users(batch, user_fields):
+                    yield game
+                batch = []
+        for game in self._with_users(batch, user_fields):
+            yield game
+
+    def _with_users(self, games, fields=None):
+        ids = list(set(game['user'].id for game in games))
+        if not ids:
+            return games
+        users = self.get_db()[self._users_collection].find({'_id': {'$in': ids}}, fields)
+        users = dict((user['_id'], user) for user in users)
+        for game in games:
+            game['user'] = users.get(game['user'].id, None)
+            self.nodes.export(game)
+            self.queues.export(game)
+        return games
+
     def drop_game(self, oid, version=None):
         query = {'user.$id':oid}
         if version is not None:
             query.update({'version': version})
         db = self.get_db()
         result = db['games'].remove(query)
+        self.invalidate_game(query)
         return result
 
     def get_top_values(self, value_field, num=50):
-        db = self.get_db()
-        db['games'].ensure_index([('game_values.%s' % value_field, pymongo.DESCENDING),])
+        db = self.get_db('ranking')
         games = db['games'].find({}, {'game_values.%s' % value_field :1, '_id': 0, 'user': 1}).sort('game_values.%s' % value_field, pymongo.DESCENDING).limit(num)
         return [{'value': doc.get('game_values', {}).get(value_field, 0), 'user': doc['user'].id} for doc in games]
 
     def get_display_names_map(self, oids):
-        db = self.get_db()
+        db = self.get_db('ranking')
         users = db['users'].find({'_id': {'$in': oids}}, {'display_name': 1})
         result = dict((u['_id'], u.get('display_name', '')) for u in users)
         return result
 
     def get_rank(self, oid, value_field):
-        db = self.get_db()
+        db = self.get_db('ranking')
         query = {'user.$id': oid}
-        db['games'].ensure_index([('game_values.%s' % value_field, pymongo.DESCENDING),])
         game = db['games'].find_one(query, {'game_values.%s' % value_field: 1})
         hasmore = db['games'].find({'game_values.%s' % value_field: {'$gt': game.get('game_values', {}).get(value_field, 0)}}).count()
         total = db['games'].count()
@@ -2,19 +2,40 @@
 Helper functions
 """
 
+import calendar
 import datetime
-import math
 import pytz
 import random
 import re
 
+EPOCH = datetime.datetime.utcfromtimestamp(0).replace(tzinfo=pytz.UTC)
+
+def datetime_to_millis(dt, ceil=False):
+    """Milliseconds since epoch for ``dt`` (naive datetimes are taken as UTC)"""
+    if dt.utcoffset() is not None:
+        dt = dt - dt.utcoffset()
+    millis = calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond // 1000
+    if ceil and dt.microsecond % 1000:
+        millis += 1
+    return millis
+
+def millis_to_datetime(millis):
+    """Timezone aware UTC datetime for milliseconds since epoch"""
+    return EPOCH + datetime.timedelta(milliseconds=millis)
+
+def calculateAPMillis(snap_val, snap_ms, levelinfo, now_ms):
+    """Returns ``(ap, update_ms)``, all times in milliseconds since epoch"""
+    increments = (now_ms - snap_ms) // levelinfo['ap_inc_interval']
+    update_ms = snap_ms + increments*levelinfo['ap_inc_interval']
+    ap = max(0, min(snap_val + (increments * levelinfo['ap_inc_value']), levelinfo['ap_max']))
+    return (ap, update_ms)
+
 def calculateAP(snap_val, snap_dt, levelinfo, datenow=None):
     if datenow is None:
         datenow = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
-    period = datenow - snap_dt
-    increments = int(math.ceil(period.total_seconds()*1000)) // levelinfo['ap_inc_interval']
-    update_dt = snap_dt + datetime.timedelta(milliseconds=increments*levelinfo['ap_inc_interval'])
-    ap = max(0, min(snap_val + (increments * levelinfo['ap_inc_value']), levelinfo['ap_max']))
+    snap_ms = datetime_to_millis(snap_dt)
+    ap, update_ms = calculateAPMillis(snap_val, snap_ms, levelinfo, datetime_to_millis(datenow, ceil=True))
+    update_dt = snap_dt + datetime.timedelta(milliseconds=update_ms - snap_ms)
     return (ap, update_dt)
 
 class WeightedRandomizer:
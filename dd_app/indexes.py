@@ -0,0 +1,84 @@
+"""Index declarations of all collections
+
+Indexes are created at deploy time by ``dd_ensure_indexes`` (see
+:py:mod:`dd_app.scripts.ensure_indexes`), request handlers and tasks don't
+issue index commands.
+"""
+
+import pymongo
+
+ASC = pymongo.ASCENDING
+DESC = pymongo.DESCENDING
+
+# game values ranked by getRanking
+RANKING_FIELDS = ('xp_value', 'cash_value', 'profiles_value', 'cash_spent')
+
+# actions logged by logAction, one collection each
+LOG_ACTIONS = ('newgame', 'loadgame', 'missiondone', 'levelup', 'charge', 'collect', 'integrate', 'buyperp', 'buypowerup', 'incident')
+
+
+class Index(object):
+    """Index of ``collection`` on ``keys``, a list of (field, direction)"""
+
+    def __init__(self, collection, keys, unique=False):
+        self.collection = collection
+        self.keys = list(keys)
+        self.unique = unique
+
+    def __repr__(self):
+        return '%s %s%s' % (self.collection, ', '.join('%s:%s' % key for key in self.keys), ' unique' if self.unique else '')
+
+
+def game_indexes(users='users', node_layout='array', queue_layout='embedded'):
+    """Indexes of the game database"""
+    indexes = [Index(users, [('auth_uid', ASC)]),
+               # game of a user (and version), see game_query_base
+               Index('games', [('user.$id', ASC), ('version', DESC)])]
+    if node_layout == 'array':
+        indexes.append(Index('games', [('nodes.full_path', ASC)]))
+    indexes.extend(Index('games', [('game_values.%s' % field, DESC)]) for field in RANKING_FIELDS)
+    if queue_layout == 'collection':
+        # uniqueness of slots keeps queue items from being added twice
+        indexes.append(Index('game_queues', [('game', ASC), ('slot', ASC)], unique=True))
+    return indexes
+
+def log_indexes():
+    """Indexes of the action log database"""
+    indexes = []
+    for action in LOG_ACTIONS:
+        indexes.append(Index(action, [('uid', ASC)]))
+        indexes.append(Index(action, [('time', ASC)]))
+    indexes.append(Index('levelup', [('level', ASC)]))
+    indexes.append(Index('missiondone', [('mission', ASC)]))
+    return indexes
+
+def check(db, indexes, create=False):
+    """Compares ``indexes`` with the indexes of ``db``
+
+    Returns lists of missing (created if ``create``) and present declared
+    indexes, and undeclared indexes as (collection, name) pairs.
+    """
+    missing, present = [], []
+    declared = {}
+    for index in indexes:
+        declared.setdefault(index.collection, []).append(index)
+    collections = set(db.collection_names())
+    undeclared = []
+    for name in sorted(declared):
+        existing = db[name].index_information() if name in collections else {}
+        keys = [[tuple(key) for key in info['key']] for info in existing.itervalues()]
+        for index in declared[name]:
+            if index.keys in keys:
+                present.append(index)
+            else:
+                missing.append(index)
+                if create:
+                    db[name].ensure_index(index.keys, unique=index.unique, background=True)
+        for index_name, info in sorted(existing.iteritems()):
+            if index_name != '_id_' and [tuple(key) for key in info['key']] not in [index.keys for index in declared[name]]:
+                undeclared.append((name, index_name))
+    for name in sorted(collections - set(declared)):
+        if name.startswith('system.'):
+            continue
+        undeclared.extend((name, index_name) for index_name in sorted(db[name].index_information()) if index_name != '_id_')
+    return missing, present, undeclared
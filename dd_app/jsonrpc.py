@@ -6,6 +6,8 @@ from pyramid_rpc import jsonrpc
 from pyramid.httpexceptions import HTTPForbidden
 import functools
 
+from dd_app.render import iterdumps
+
 class JsonRpcUnauthorized(jsonrpc.JsonRpcError):
     """Extends pyramid_rpc.jsonrpc.JsonRpcError,
     represents a 'client unauthorized' exception."""
@@ -26,3 +28,19 @@ def add_dd_exceptions(f):
     return wrapper
 
 jsonrpc.exception_view = add_dd_exceptions(jsonrpc.exception_view)
+
+
+def make_streaming_response(request, result):
+    """Like pyramid_rpc.jsonrpc.make_response, but streams the body
+
+    The JSON-RPC envelope and ``result`` are encoded by
+    :py:func:`dd_app.render.iterdumps` into a chunked WSGI iterable. Errors
+    while streaming can't be reported as JSON-RPC errors any more, so
+    ``result`` must be fully loaded before.
+    """
+    response = request.response
+    response.content_type = 'application/json'
+    response.app_iter = iterdumps({'jsonrpc': '2.0',
+                                   'id': getattr(request, 'rpc_id', None),
+                                   'result': result})
+    return response
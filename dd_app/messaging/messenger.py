@@ -5,6 +5,12 @@ from dd_app.messaging import backend
 
 class Messenger(object):
 
+    RULES_RELOAD = 'rules_reload'
+    USER_INVALIDATE = 'user_invalidate'
+    SESSION_INVALIDATE = 'session_invalidate'
+    # broadcast actions for server processes only, not forwarded to clients
+    SERVER_ACTIONS = (RULES_RELOAD, USER_INVALIDATE, SESSION_INVALIDATE)
+
     def __init__(self, settings={}, backend_class=backend.RedisBackend, uid=None, queues=tuple()):
         self.backend = backend_class(settings=settings)
         self.uid = uid
@@ -88,6 +94,11 @@ class Messenger(object):
                       data=data)
         return self.user_send(uid, msg)
 
+    def rules_reload(self, sources):
+        msg = Message(action=self.RULES_RELOAD,
+                      data={'sources': sources})
+        return self.broadcast(msg)
+
 class Message(object):
 
     def __init__(self, *args, **kwargs):
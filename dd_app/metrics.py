@@ -0,0 +1,44 @@
+"""Per-process metrics
+
+Counters are kept in memory per worker process and exposed as json by the
+``metrics`` view (``/metrics``, with ``dd_app.metrics_enabled``), see
+:py:class:`dd_app.views.MetricsHandler`.
+"""
+
+import os
+import threading
+import time
+
+
+class Metrics(object):
+    """Thread safe named counters and gauges"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self.started = time.time()
+
+    def add(self, name, value=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+
+    def set(self, name, value):
+        with self._lock:
+            self._values[name] = value
+
+    def get(self, name, default=0):
+        return self._values.get(name, default)
+
+    def snapshot(self):
+        """Returns all values, plus pid and uptime of the process"""
+        with self._lock:
+            values = dict(self._values)
+        values['pid'] = os.getpid()
+        values['uptime'] = time.time() - self.started
+        return values
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+METRICS = Metrics()
@@ -3,6 +3,8 @@ from bson.objectid import ObjectId
 import itertools
 import logging
 
+from dd_app.nodes import MAP
+
 log = logging.getLogger(__name__)
 
 class MissionData(object):
@@ -61,9 +63,10 @@ class MissionData(object):
 
 class MissionHandler(object):
 
-    def __init__(self, version, lang, goal_data=[], active_missions=[], game_nodes=None, db=None, game_id=None, game_values=None):
+    def __init__(self, version, lang, goal_data=[], active_missions=[], game_nodes=None, db=None, game_id=None, game_values=None, rules=None, node_store=None):
         self.rules_version = version
         self.lang = lang
+        self._rules = rules
         self.mission_data = MissionData(goal_data)
         self.active_missions = active_missions
         self.game_nodes = game_nodes
@@ -71,6 +74,7 @@ class MissionHandler(object):
         self.complete_missions = []
         self.db = db
         self.game_id = game_id
+        self.node_store = node_store
         self.extra_perps = []
         self.extra_powerups = {}
         self.extra_token_amounts = {}
@@ -95,13 +99,20 @@ class MissionHandler(object):
     @property
     def rules(self):
         if getattr(self, '_rules', None) is None:
-            from dd_app.rules import RulesVersion
-            self._rules =  RulesVersion(version=self.rules_version, lang=self.lang)
+            from dd_app.rules.registry import get_rules_version
+            self._rules = get_rules_version(self.rules_version, self.lang)
         return self._rules
 
+    def _load_node_map(self):
+        # a node_map can't be $unwind, read the nodes instead
+        if self.game_nodes is None and self.node_store is not None and self.node_store.layout == MAP:
+            game = self.db.games.find_one({'_id': self.game_id}, self.node_store.fields())
+            self.game_nodes = self.node_store.all(game or {})
+
     @property
     def perp_gestalten(self):
         if getattr(self, '_perps', None) is None:
+            self._load_node_map()
             if self.game_nodes is not None:
                 self._perps = [node['full_type'].split(':')[-1] for node in self.game_nodes]
             else:
@@ -122,6 +133,7 @@ class MissionHandler(object):
     def project_powerups(self):
         if getattr(self, '_project_powerups', None) is None:
             self._project_powerups = {}
+            self._load_node_map()
             if self.game_nodes is not None:
                 for node in self.game_nodes:
                     if node['full_type'].startswith('ProjectPerp'):
@@ -146,6 +158,7 @@ class MissionHandler(object):
     def token_amounts(self):
         if getattr(self, '_token_amounts', None) is None:
             self._token_amounts = {}
+            self._load_node_map()
             if self.game_nodes is not None:
                 for node in self.game_nodes:
                     if node['full_type'].startswith('TokenPerp'):
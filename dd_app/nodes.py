@@ -0,0 +1,220 @@
+"""Storage layouts of game nodes
+
+Nodes are stored in one of two layouts in the game document:
+
+``array``
+    ``nodes`` is a list of nodes, matched by ``nodes.full_path`` and
+    updated with positional (``nodes.$``) operators. Cost of matching grows
+    with the number of nodes.
+
+``map``
+    ``node_map`` is a sub-document of nodes keyed by their ``game_id``, so a
+    node is read and updated by its key (``node_map.<game_id>``).
+    ``node_children`` maps the ``game_id`` of a parent (``Database`` for top
+    level nodes) to the list of its children's ids.
+
+:py:class:`NodeStore` (``DDMongoConnector.nodes``) builds the projections,
+queries and updates for the layout configured with ``mongodb.node_layout``
+(default ``array``). With ``map``, documents still in the ``array`` layout
+are read and written as well, so games can be migrated online with
+``dd_migrate_nodes`` (see :py:mod:`dd_app.scripts.migrate_nodes`): switch
+all servers to ``map`` first, then run the migration.
+"""
+
+ARRAY = 'array'
+MAP = 'map'
+LAYOUTS = (ARRAY, MAP)
+
+ROOT = 'Database'
+
+
+def node_id(path):
+    """Returns the ``game_id`` of the node at ``path``"""
+    return path.rsplit('.', 1)[-1]
+
+def parent_id(path):
+    """Returns the ``game_id`` of the parent of the node at ``path``"""
+    parts = path.rsplit('.', 2)
+    return parts[-2] if len(parts) > 1 else None
+
+def to_map(nodes):
+    """Returns ``node_map`` and ``node_children`` of a list of nodes"""
+    node_map = {}
+    node_children = {}
+    for node in nodes:
+        path = node['full_path']
+        node_map[node_id(path)] = node
+        node_children.setdefault(parent_id(path) or ROOT, []).append(node_id(path))
+    return node_map, node_children
+
+
+class NodeStore(object):
+    """Data access of game nodes
+
+    Read helpers take the document as returned by mongodb, write helpers
+    the ``layout`` of the document written to (see :py:meth:`layout_of`),
+    the write has to compare-and-swap ``nodes_lock`` so the layout can't
+    change in between.
+
+    :param layout: layout of new games and of node reads, one of
+                   :py:data:`LAYOUTS`
+    """
+
+    def __init__(self, layout=ARRAY):
+        if layout not in LAYOUTS:
+            raise ValueError('unknown node layout %r' % layout)
+        self.layout = layout
+
+    @property
+    def layouts(self):
+        """Layouts documents may be in"""
+        if self.layout == MAP:
+            return (MAP, ARRAY)
+        return (ARRAY, )
+
+    def layout_of(self, doc):
+        return MAP if 'node_map' in doc else ARRAY
+
+    # reads
+
+    def find(self, path):
+        """Query matching games containing the node at ``path``
+
+        Empty with the ``map`` layout, there is nothing to match efficiently,
+        :py:meth:`get` returns None for missing nodes.
+        """
+        if self.layout == MAP:
+            return {}
+        return {'nodes.full_path': path}
+
+    def fields(self, path=None):
+        """Projection of the node at ``path``, of all nodes without ``path``"""
+        if self.layout == MAP:
+            # documents not yet migrated return the whole array
+            if path is None:
+                return {'node_map': 1, 'node_children': 1, 'nodes': 1}
+            return {'node_map.%s' % node_id(path): 1, 'nodes': 1}
+        if path is None:
+            return {'nodes': 1}
+        return {'nodes.$': 1}
+
+    def get(self, doc, path):
+        """Returns the node at ``path`` of ``doc`` or None"""
+        if self.layout_of(doc) == MAP:
+            node = doc['node_map'].get(node_id(path), None)
+            # ids are unique, the rest of the path has to match as well
+            if node is None or node['full_path'] != path:
+                return None
+            return node
+        for node in doc.get('nodes', []):
+            if node['full_path'] == path:
+                return node
+        return None
+
+    def all(self, doc):
+        """Returns the list of nodes of ``doc``, parents before children"""
+        if self.layout_of(doc) == ARRAY:
+            return doc.get('nodes', [])
+        node_map = doc['node_map']
+        children = doc.get('node_children', {})
+        result = []
+        stack = list(reversed(children.get(ROOT, [])))
+        while stack:
+            i = stack.pop()
+            if i in node_map:
+                result.append(node_map[i])
+                stack.extend(reversed(children.get(i, [])))
+        if len(result) < len(node_map):
+            # partial projection or missing index entries
+            seen = set(node['game_id'] for node in result)
+            result.extend(node_map[i] for i in sorted(node_map) if i not in seen)
+        return result
+
+    def children(self, doc, path):
+        """Returns the child nodes of the node at ``path``"""
+        if self.layout_of(doc) == MAP:
+            node_map = doc['node_map']
+            return [node_map[i] for i in doc.get('node_children', {}).get(node_id(path), []) if i in node_map]
+        prefix = path + '.'
+        return [node for node in doc.get('nodes', []) if node['full_path'].startswith(prefix)
+                and '.' not in node['full_path'][len(prefix):]]
+
+    # writes
+
+    def match(self, layout, path):
+        """Query matching the node at ``path`` for an update"""
+        if layout == MAP:
+            return {'node_map.%s.full_path' % node_id(path): path}
+        return {'nodes.full_path': path}
+
+    def field(self, layout, path, name):
+        """Update key of field ``name`` of the node at ``path``
+
+        The query has to contain :py:meth:`match` of ``path``.
+        """
+        if layout == MAP:
+            return 'node_map.%s.%s' % (node_id(path), name)
+        return 'nodes.$.%s' % name
+
+    def add(self, layout, update, node):
+        """Adds inserting ``node`` to ``update``"""
+        if layout == MAP:
+            path = node['full_path']
+            update.setdefault('$set', {})['node_map.%s' % node_id(path)] = node
+            update.setdefault('$push', {})['node_children.%s' % (parent_id(path) or ROOT)] = node_id(path)
+        else:
+            update.setdefault('$push', {})['nodes'] = node
+
+    def put(self, layout, update, nodes, changed, added=()):
+        """Adds writing nodes to ``update``
+
+        :param nodes: all nodes of the game
+        :param changed: modified and ``added`` nodes, only these are written
+                        with the ``map`` layout
+        :param added: nodes not yet in the game
+        """
+        if layout == ARRAY:
+            update.setdefault('$set', {})['nodes'] = nodes
+            return
+        for node in changed:
+            update.setdefault('$set', {})['node_map.%s' % node_id(node['full_path'])] = node
+        for node in added:
+            key = 'node_children.%s' % (parent_id(node['full_path']) or ROOT)
+            update.setdefault('$push', {}).setdefault(key, {'$each': []})['$each'].append(node['game_id'])
+
+    # games
+
+    def prepare(self, game):
+        """Converts the nodes of a new ``game`` to the configured layout"""
+        if self.layout == MAP and 'nodes' in game:
+            game['node_map'], game['node_children'] = to_map(game.pop('nodes'))
+        return game
+
+    def export(self, game):
+        """Converts the nodes of a loaded ``game`` to the list sent to clients"""
+        if self.layout_of(game) == MAP:
+            game['nodes'] = self.all(game)
+            del game['node_map']
+            game.pop('node_children', None)
+        return game
+
+    def migrate(self, collection, game):
+        """Converts ``game`` to the ``map`` layout
+
+        ``game`` needs ``_id``, ``nodes`` and ``nodes_lock``. The update
+        compare-and-swaps ``nodes_lock``, so concurrent mutations of the game
+        fail and are retried on the new layout. Returns False if the game
+        changed since it was read.
+        """
+        node_map, node_children = to_map(game.get('nodes', []))
+        query = {'_id': game['_id'], 'node_map': {'$exists': False}}
+        if game.get('nodes_lock', None) is None:
+            query['nodes_lock'] = {'$exists': False}
+        else:
+            query['nodes_lock'] = game['nodes_lock']
+        resp = collection.update(query,
+                                 {'$set': {'node_map': node_map, 'node_children': node_children},
+                                  '$unset': {'nodes': 1},
+                                  '$inc': {'nodes_lock': 1}},
+                                 safe=True, upsert=False, multi=False)
+        return resp.get('n', 0) == 1
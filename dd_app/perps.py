@@ -5,13 +5,27 @@ class PerpTypeError(Exception):
 class BasePerp(object):
 
     CHILD_TYPES = ()
+    # whether required_level is checked for new instances
+    CHECK_LEVEL = True
 
-    def __init__(self, gestalt, node_data, rules, game_id, game_values={}, game_nodes=[]):
+    def __init__(self, gestalt, node_data, rules, game_id, game_values={}, game_nodes=[], graph=None):
         self.gestalt = gestalt
         self.rules = rules
         self.game_nodes = game_nodes
         self.game_values = game_values
         self.game_id = game_id
+        if graph is not None:
+            self._graph = graph
+
+    @property
+    def graph(self):
+        """:py:class:`PerpGraph` of the ruleset, shared via its rules index"""
+        if not hasattr(self, '_graph'):
+            self._graph = self.rules.index.perp_graph
+        return self._graph
+
+    def _new_perp(self, gestalt, **kwargs):
+        return PerpNode(gestalt, rules=self.rules, game_values=self.game_values, game_nodes=self.game_nodes, graph=self.graph, **kwargs)
 
     @property
     def node_type_data(self):
@@ -64,8 +78,7 @@ class BasePerp(object):
         return True
 
     def _check_level(self):
-        if not self.game_values.get('xp_level', 1) < self.node_type_data.get('type_data', {}).get('required_level', 1):
-            return True
+        return self.graph.level_reached(self.gestalt, self.game_values.get('xp_level', 1))
 
     def _check_extra_requirements(self):
         return True
@@ -89,20 +102,17 @@ class BasePerp(object):
 
     def get_provided(self):
         """return all available provided perps"""
-        # BAD BAD BAD WORKAROUND FOR F(*$#&ED UP SCHEMA, see #303
-        gestalten = self.get_prop('provided_perps', [])
-        result = []
-        for gestalt in gestalten:
-            try:
-                PerpNode(gestalt, rules=self.rules, game_values=self.game_values, game_nodes=self.game_nodes)
-                result.append(gestalt)
-            except PerpTypeError:
-                pass
-        return result
+        if 'provided_perps' in self.node_data.get('instance_data', {}):
+            # BAD BAD BAD WORKAROUND FOR F(*$#&ED UP SCHEMA, see #303
+            return [g for g in self.get_prop('provided_perps', []) if self.graph.is_registered(g)]
+        return list(self.graph.provided.get(self.gestalt, ()))
 
     def get_addable(self):
-        instances = (PerpNode(gestalt, rules=self.rules, game_values=self.game_values, game_nodes=self.game_nodes) for gestalt in self.get_provided())
-        return [perp.gestalt for perp in instances if perp.check_addable(self)]
+        xp_level = self.game_values.get('xp_level', 1)
+        # type and level checks are answered by the graph, instances only run game specific checks
+        candidates = [gestalt for gestalt in self.get_provided()
+                      if self.graph.types.get(gestalt, None) in self.CHILD_TYPES and self.graph.level_reached(gestalt, xp_level)]
+        return [gestalt for gestalt in candidates if self._new_perp(gestalt).check_addable(self)]
 
     def check_addable(self, parent):
         """returns true if allowed to be created"""
@@ -141,8 +151,8 @@ class DatabaseSpecialPerp(BasePerp):
         return {'full_path': ''}
 
     def get_provided(self):
-        perps = [gestalt for gestalt, data in self.rules.tokens.items() if data['game_type'] in self.CHILD_TYPES and data['type_data'].get('is_buyable', False)==True]
-        return [perp for perp in perps if perp not in self.token_gestalten]
+        token_gestalten = set(self.token_gestalten)
+        return [perp for perp in self.graph.buyable_tokens if perp not in token_gestalten]
 
     def check_addable(self, parent):
         return False
@@ -156,7 +166,7 @@ class DatabasePerp(BasePerp):
 
     def get_provided(self):
         # all city perps
-        return [gestalt for gestalt, data in self.rules.perps.items() if data['game_type'] in self.CHILD_TYPES]
+        return self.graph.perps_of_types(self.CHILD_TYPES)
 
 
 class CityPerp(BasePerp):
@@ -187,20 +197,14 @@ class PusherPerp(BasePerp):
     # required: parent muss CityPerp sein, required_level muss erreicht sein NEIN, siehe #303
     # zumindest ein client aus provided_perps muss kaufbar sein
     CHILD_TYPES = ('ClientPerp',)
-
-    def _check_level(self):
-        return True
+    CHECK_LEVEL = False
 
     def _check_extra_requirements(self):
-        client_gestalten = self.get_provided()
-        for cl in client_gestalten:
-            try:
-                instance = PerpNode(cl, rules=self.rules, game_values=self.game_values, game_nodes=self.game_nodes)
-                if instance.check_theoretical():
-                    return True
-            except PerpTypeError:
-                # FIXME BAD BAD BAD WORKAROUND FOR MESSED UP SCHEMA, SEE #303
-                pass
+        xp_level = self.game_values.get('xp_level', 1)
+        available = set(self.game_gestalten)
+        for cl in self.graph.children.get(self.gestalt, ()):
+            if self.graph.level_reached(cl, xp_level) and self.graph.required_providers.get(cl, frozenset()) & available:
+                return True
         return False
 
 
@@ -356,3 +360,64 @@ class PerpNode(object):
             return cls.registered_classes[game_type](gestalt, node_data, rules, game_id, game_values, game_nodes, *args, **kwargs)
         raise PerpTypeError('No perp type "%s" registered' % game_type)
 
+
+
+class PerpGraph(object):
+    """Static perp dependency graph of a ruleset
+
+    Built once per ruleset by :py:class:`dd_app.rules.index.RulesIndex`.
+    Holds everything needed to decide addability that does not depend on a
+    game: provided perps of registered types, type compatible children per
+    provider, level thresholds and the required providers of clients.
+    """
+
+    def __init__(self, perps, tokens):
+        registered = PerpNode.registered_classes
+        # gestalt -> game_type, registered types only
+        self.types = {}
+        for elems in (tokens, perps):
+            for gestalt, data in elems.iteritems():
+                if data.get('game_type', None) in registered:
+                    self.types[gestalt] = data['game_type']
+        # gestalt -> minimum xp_level for new instances
+        self.min_level = {}
+        # client gestalt -> frozenset of provider gestalten
+        self.required_providers = {}
+        # provider gestalt -> (provided gestalt, ...)
+        self.provided = {}
+        # provider gestalt -> (provided gestalt of a CHILD_TYPE, ...)
+        self.children = {}
+        for gestalt, game_type in self.types.iteritems():
+            data = perps.get(gestalt, tokens.get(gestalt))
+            type_data = data.get('type_data', {})
+            perp_class = registered[game_type]
+            if perp_class.CHECK_LEVEL:
+                self.min_level[gestalt] = type_data.get('required_level', 1)
+            if 'required_providers' in type_data:
+                self.required_providers[gestalt] = frozenset(type_data['required_providers'])
+            if gestalt not in perps:
+                continue
+            provided = tuple(g for g in type_data.get('provided_perps', []) if g in self.types)
+            if provided:
+                self.provided[gestalt] = provided
+                children = tuple(g for g in provided if self.types[g] in perp_class.CHILD_TYPES)
+                if children:
+                    self.children[gestalt] = children
+        # game_type -> [gestalt, ...]
+        self.by_type = {}
+        for gestalt, game_type in self.types.iteritems():
+            self.by_type.setdefault(game_type, []).append(gestalt)
+        self.buyable_tokens = tuple(gestalt for gestalt in self.perps_of_types(DatabaseSpecialPerp.CHILD_TYPES)
+                                    if tokens.get(gestalt, {}).get('type_data', {}).get('is_buyable', False)==True)
+
+    def is_registered(self, gestalt):
+        return gestalt in self.types
+
+    def level_reached(self, gestalt, xp_level):
+        return not xp_level < self.min_level.get(gestalt, 0)
+
+    def perps_of_types(self, game_types):
+        result = []
+        for game_type in game_types:
+            result.extend(self.by_type.get(game_type, []))
+        return result
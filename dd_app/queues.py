@@ -0,0 +1,332 @@
+"""Storage of the game queues ``db_queue``, ``nodes_charging`` and ``nodes_collect``
+
+Queues are stored in one of two layouts, configured with
+``mongodb.queue_layout``:
+
+``embedded`` (default)
+    Arrays in the game document, changed by ``$push``/``$pull`` along with
+    the rest of a mutation.
+
+``collection``
+    One document per item in the ``game_queues`` collection, unique per
+    game and ``slot`` (the ``collect_id`` of ``db_queue`` items, the node
+    path of charging and collectable items). A node charges and becomes
+    collectable in the same document, so that transfer is a single update.
+    The game document keeps none of the queues.
+
+Mutations change queues through a transaction, see :py:meth:`QueueStore.begin`.
+With the ``collection`` layout, items taken or put by a transaction are
+tagged with its id before the game is updated, and the game update sets
+``queue_txn`` to that id. The tags are resolved afterwards: taken items are
+removed, put items become visible. Tags left behind by a crashed process are
+resolved by the next transaction of the game: a transaction is committed if
+the game's ``queue_txn`` says so, and aborted once older than
+``TXN_TIMEOUT`` otherwise. A stale transaction may only be stalled, so before
+it is aborted the game's ``nodes_lock`` is advanced unless ``queue_txn``
+names it; its late game update can't match then. Every transaction first
+resolves the one the game's ``queue_txn`` points to, so that id is never
+overwritten unresolved.
+
+Games still holding embedded queues are moved to the collection by their
+first transaction, so the layout can be switched while serving.
+
+Writes to the game document outside of a mutation (moving queues, charged
+nodes) advance ``nodes_lock`` as well, so mutations and cached games read
+before them are recognized as stale.
+"""
+
+import datetime
+
+from pymongo.errors import DuplicateKeyError
+from bson.objectid import ObjectId
+
+EMBEDDED = 'embedded'
+COLLECTION = 'collection'
+LAYOUTS = (EMBEDDED, COLLECTION)
+
+QUEUES = ('db_queue', 'nodes_charging', 'nodes_collect')
+
+# field identifying an item of a queue
+KEYS = {'db_queue': 'collect_id', 'nodes_charging': 'path', 'nodes_collect': 'path'}
+
+# seconds after which unresolved transactions are aborted
+TXN_TIMEOUT = 60
+
+
+def slot(queue, key):
+    """Returns the per-game unique key of an item"""
+    if queue == 'db_queue':
+        return 'db_queue:%s' % key
+    # charging and collectable items of a node share a slot
+    return 'charge:%s' % key
+
+
+class EmbeddedTxn(object):
+    """Queue transaction on the arrays of the game document"""
+
+    def __init__(self, game):
+        self.game = game
+        self.takes = []
+        self.puts = []
+
+    def peek(self, queue, key):
+        """Returns the item ``key`` of ``queue`` or None"""
+        for item in self.game.get(queue, []):
+            if item.get(KEYS[queue], None) == key:
+                return item
+        return None
+
+    def take(self, queue, key):
+        self.takes.append((queue, key))
+
+    def put(self, queue, item):
+        self.puts.append((queue, item))
+
+    def prepare(self, query_find, query_set):
+        """Adds the queue changes to a mutation, returns False on conflicts"""
+        for queue, key in self.takes:
+            query_set.setdefault('$pull', {})[queue] = {KEYS[queue]: key}
+        for queue, item in self.puts:
+            push = query_set.setdefault('$push', {}).setdefault(queue, {'$each': []})
+            push['$each'].append(item)
+            if queue != 'db_queue':
+                path = item[KEYS[queue]]
+                query_find.update({'nodes_charging.path': {'$nin': [path]},
+                                   'nodes_collect.path': {'$nin': [path]}})
+        return True
+
+    def commit(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class CollectionTxn(object):
+    """Queue transaction on the ``game_queues`` collection
+
+    Items are only tagged by :py:meth:`prepare`, right before the game
+    update, so returning early doesn't need an :py:meth:`abort`.
+    """
+
+    def __init__(self, store, game):
+        self.store = store
+        self.game_id = game['_id']
+        self.id = unicode(ObjectId())
+        self.takes = []
+        self.puts = []
+        self.tagged = []
+
+    def peek(self, queue, key):
+        doc = self.store.collection.find_one({'game': self.game_id, 'slot': slot(queue, key), 'queue': queue,
+                                              'op': {'$ne': 'put'}}, {'item': 1})
+        return None if doc is None else doc['item']
+
+    def take(self, queue, key):
+        self.takes.append((queue, key))
+
+    def put(self, queue, item):
+        self.puts.append((queue, item))
+
+    def prepare(self, query_find, query_set):
+        collection = self.store.collection
+        now = datetime.datetime.utcnow()
+        for queue, key in self.takes:
+            doc = collection.find_and_modify(query={'game': self.game_id, 'slot': slot(queue, key), 'queue': queue,
+                                                    'txn': {'$exists': False}},
+                                             update={'$set': {'txn': self.id, 'op': 'take', 'txn_at': now}},
+                                             fields={'_id': 1})
+            if doc is None:
+                self.abort()
+                return False
+            self.tagged.append(doc['_id'])
+        for queue, item in self.puts:
+            doc = {'game': self.game_id, 'queue': queue, 'slot': slot(queue, item[KEYS[queue]]), 'item': item,
+                   'txn': self.id, 'op': 'put', 'txn_at': now}
+            try:
+                self.tagged.append(collection.insert(doc, safe=True))
+            except DuplicateKeyError:
+                self.abort()
+                return False
+        if self.tagged:
+            query_set.setdefault('$set', {})['queue_txn'] = self.id
+        return True
+
+    def commit(self):
+        if self.tagged:
+            self.store.resolve(self.game_id, self.id, True)
+
+    def abort(self):
+        if self.tagged:
+            self.store.resolve(self.game_id, self.id, False)
+            self.tagged = []
+
+
+class QueueStore(object):
+    """Data access of the game queues
+
+    :param db: returns the pymongo database
+    :param layout: one of :py:data:`LAYOUTS`
+    :param collection: name of the queue collection
+    """
+
+    def __init__(self, db, layout=EMBEDDED, collection='game_queues'):
+        if layout not in LAYOUTS:
+            raise ValueError('unknown queue layout %r' % layout)
+        self._db = db
+        self.layout = layout
+        self.collection_name = collection
+
+    @property
+    def collection(self):
+        # the unique index on game and slot is created by dd_ensure_indexes
+        return self._db()[self.collection_name]
+
+    # game reads
+
+    def find(self, queue, key):
+        """Query matching games with the item ``key`` of ``queue``"""
+        if self.layout == COLLECTION:
+            return {}
+        return {'%s.%s' % (queue, KEYS[queue]): key}
+
+    def fields(self, *queues):
+        """Projection of the game document for transactions on ``queues``"""
+        if self.layout == COLLECTION:
+            # embedded queues not moved yet are moved by begin()
+            fields = dict((queue, 1) for queue in QUEUES)
+            fields['queue_txn'] = 1
+            fields['nodes_lock'] = 1
+            return fields
+        return dict((queue, 1) for queue in queues)
+
+    def begin(self, game):
+        """Starts a queue transaction of a mutation of ``game``
+
+        ``game`` is the game document read with :py:meth:`fields`. Items
+        read with ``peek`` are taken by ``take`` and added by ``put``, then
+        ``prepare`` adds the changes to the game update. After the
+        compare-and-swapped game update, ``commit`` or ``abort`` the
+        transaction.
+        """
+        if self.layout == EMBEDDED:
+            return EmbeddedTxn(game)
+        self.adopt(game)
+        self.settle(game['_id'], game.get('queue_txn', None))
+        return CollectionTxn(self, game)
+
+    # collection layout
+
+    def resolve(self, game_id, txn, committed):
+        """Resolves the tags of transaction ``txn``"""
+        query = {'game': game_id, 'txn': txn}
+        if committed:
+            self.collection.remove(dict(query, op='take'), safe=True)
+            self.collection.update(dict(query, op='put'), {'$unset': {'txn': 1, 'op': 1, 'txn_at': 1}}, safe=True, multi=True)
+        else:
+            self.collection.remove(dict(query, op='put'), safe=True)
+            self.collection.update(dict(query, op='take'), {'$unset': {'txn': 1, 'op': 1, 'txn_at': 1}}, safe=True, multi=True)
+
+    def settle(self, game_id, committed_txn):
+        """Resolves tags left behind by transactions of a game"""
+        stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=TXN_TIMEOUT)
+        tagged = self.collection.find({'game': game_id, 'txn': {'$exists': True}}, {'txn': 1, 'txn_at': 1})
+        for txn, txn_at in set((doc['txn'], doc['txn_at'].replace(tzinfo=None)) for doc in tagged):
+            if txn == committed_txn:
+                self.resolve(game_id, txn, True)
+            elif txn_at < stale:
+                self.resolve(game_id, txn, self.fence(game_id, txn))
+
+    def fence(self, game_id, txn):
+        """Keeps the game update of transaction ``txn`` from matching
+
+        Advances ``nodes_lock``, which game updates compare-and-swap, unless
+        the game's ``queue_txn`` is ``txn``. Returns True if ``txn`` has
+        updated the game already, i.e. is committed.
+        """
+        games = self._db()['games']
+        resp = games.update({'_id': game_id, 'queue_txn': {'$ne': txn}}, {'$inc': {'nodes_lock': 1}},
+                            safe=True, upsert=False, multi=False)
+        if resp.get('n', 0) > 0:
+            return False
+        game = games.find_one({'_id': game_id}, {'queue_txn': 1})
+        return game is not None and game.get('queue_txn', None) == txn
+
+    def adopt(self, game):
+        """Moves embedded queues of ``game`` to the collection
+
+        Advances ``nodes_lock`` of the game, ``game['nodes_lock']`` too if
+        the game wasn't changed since it was read.
+        """
+        pull = {}
+        for queue in QUEUES:
+            items = game.pop(queue, None)
+            if not items:
+                continue
+            keys = [item[KEYS[queue]] for item in items]
+            for key, item in zip(keys, items):
+                self.collection.update({'game': game['_id'], 'slot': slot(queue, key)},
+                                       {'$setOnInsert': {'queue': queue, 'item': item}},
+                                       upsert=True, safe=True)
+            pull[queue] = {KEYS[queue]: {'$in': keys}}
+        if not pull:
+            return
+        games = self._db()['games']
+        nodes_lock = game.get('nodes_lock', None)
+        resp = games.update({'_id': game['_id'], 'nodes_lock': nodes_lock}, {'$pull': pull, '$inc': {'nodes_lock': 1}},
+                            safe=True, upsert=False, multi=False)
+        if resp.get('n', 0) > 0:
+            game['nodes_lock'] = (nodes_lock or 0) + 1
+        else:
+            # changed meanwhile, the caller's compare-and-swap will fail
+            games.update({'_id': game['_id']}, {'$pull': pull, '$inc': {'nodes_lock': 1}}, safe=True)
+
+    # games
+
+    def adopted(self, game):
+        """False if ``game`` holds embedded queues to be moved to the collection"""
+        return self.layout == EMBEDDED or not any(game.get(queue, None) for queue in QUEUES)
+
+    def items(self, game_id, queue):
+        """Returns the items of ``queue`` of a game"""
+        docs = self.collection.find({'game': game_id, 'queue': queue, 'op': {'$ne': 'put'}}, {'item': 1}).sort('_id')
+        return [doc['item'] for doc in docs]
+
+    def export(self, game):
+        """Adds the queues to a loaded ``game``"""
+        if self.layout == COLLECTION:
+            self.adopt(game)
+            self.settle(game['_id'], game.pop('queue_txn', None))
+            for queue in QUEUES:
+                game[queue] = self.items(game['_id'], queue)
+        return game
+
+    def charged(self, query_base, path, result):
+        """Makes the charging node at ``path`` collectable
+
+        Returns the ``nodes_lock`` of the game after the change, None if the
+        node isn't charging. Games cached before have to be invalidated,
+        see :py:meth:`dd_app.cache.GameCache.invalidate`.
+        """
+        if self.layout == EMBEDDED:
+            game = self._db()['games'].find_and_modify(query=dict(query_base, **{'nodes_charging.path': path}),
+                                                       update={'$pull': {'nodes_charging': {'path': path}},
+                                                               '$push': {'nodes_collect': {'path': path, 'result': result}},
+                                                               '$inc': {'nodes_lock': 1}},
+                                                       upsert=False,
+                                                       new=True,
+                                                       fields={'nodes_lock': 1})
+            return None if game is None else game['nodes_lock']
+        game = self._db()['games'].find_one(query_base, self.fields())
+        if game is None:
+            return None
+        self.adopt(game)
+        self.settle(game['_id'], game.get('queue_txn', None))
+        resp = self.collection.update({'game': game['_id'], 'slot': slot('nodes_charging', path),
+                                       'queue': 'nodes_charging', 'txn': {'$exists': False}},
+                                      {'$set': {'queue': 'nodes_collect', 'item': {'path': path, 'result': result}}},
+                                      upsert=False, multi=False, safe=True)
+        if resp.get('n', 0) == 0:
+            return None
+        # the game document itself is unchanged unless adopted
+        return game.get('nodes_lock', 0)
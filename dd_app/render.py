@@ -1,8 +1,175 @@
 """Collection of pyramid renderers used by Data Dealer"""
 
+import datetime
+import decimal
+import json
+import re
+import uuid
+
 from pyramid.renderers import JSON
-from bson.json_util import dumps
+from bson import json_util
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+
+from dd_app.helpers import datetime_to_millis
+
+
+class RawJSON(object):
+    """Pre-encoded json value
+
+    Spliced verbatim into the output by :py:func:`dumps`, so static data
+    (e.g. rules) is encoded once instead of on every response. Only valid as
+    a value, not as a key.
+    """
+    __slots__ = ('encoded', )
+
+    def __init__(self, encoded):
+        self.encoded = encoded
+
+    @classmethod
+    def encode(cls, value):
+        return cls(dumps(value))
+
+    def __repr__(self):
+        return '<RawJSON %d bytes>' % len(self.encoded)
+
+# random per process, can't collide with encoded user data
+_RAW_PREFIX = '__rawjson_%s_' % uuid.uuid4().hex
+_RAW_PATTERN = re.compile(r'"%s(\d+)"' % _RAW_PREFIX)
+
+def bson_default(value):
+    """``default`` hook encoding BSON types like bson.json_util
+
+    ObjectId, datetime and DBRef are checked first, they are the only BSON
+    types in game documents. Decimals are encoded as numbers.
+    """
+    if isinstance(value, ObjectId):
+        return {'$oid': str(value)}
+    if isinstance(value, datetime.datetime):
+        return {'$date': datetime_to_millis(value)}
+    if isinstance(value, DBRef):
+        # nested ObjectId is passed to this hook again
+        return value.as_doc()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return json_util.default(value)
+
+def _make_dumps(encode):
+    def dumps(obj, default=None, **kwargs):
+        fragments = []
+        def _default(value):
+            if isinstance(value, RawJSON):
+                fragments.append(value.encoded)
+                return '%s%d' % (_RAW_PREFIX, len(fragments) - 1)
+            try:
+                return bson_default(value)
+            except TypeError:
+                pass
+            # like bson.json_util, encode other mappings and iterables
+            if hasattr(value, 'iteritems'):
+                return dict(value.iteritems())
+            if hasattr(value, '__iter__'):
+                return list(value)
+            if default is None:
+                raise TypeError('%r is not JSON serializable' % (value, ))
+            return default(value)
+        result = encode(obj, default=_default, **kwargs)
+        if fragments:
+            result = _RAW_PATTERN.sub(lambda m: fragments[int(m.group(1))], result)
+        return result
+    return dumps
+
+dumps = _make_dumps(json.dumps)
+"""json.dumps with BSON types handled by the C encoder's ``default`` hook
+
+Wire compatible with bson.json_util (``$oid``, ``$date``, ``$ref``/``$id``)
+without converting the whole document in python first. Splices in
+:py:class:`RawJSON` values. ``Code`` and ``Binary`` are str subclasses and
+encode as plain strings, neither is used in game documents.
+"""
+
+bson_util_dumps = _make_dumps(json_util.dumps)
+"""Previous bson.json_util.dumps based serializer, for comparison"""
+
+class StreamArray(object):
+    """Array value streamed by :py:func:`iterdumps` from an iterable
+
+    Items are encoded one by one, the array is never encoded as a whole.
+    """
+    __slots__ = ('iterable', )
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+STREAM_CHUNK_SIZE = 16384
+
+def _streams(value):
+    # dicts are walked if they contain streamed values, anything else is encoded whole
+    return isinstance(value, (StreamArray, RawJSON)) or \
+        (isinstance(value, dict) and any(_streams(v) for v in value.itervalues()))
+
+def _iterencode(value):
+    if isinstance(value, RawJSON):
+        yield value.encoded
+    elif isinstance(value, StreamArray):
+        yield '['
+        first = True
+        for item in value.iterable:
+            if not first:
+                yield ', '
+            first = False
+            for part in _iterencode(item):
+                yield part
+        yield ']'
+    elif isinstance(value, dict) and _streams(value):
+        yield '{'
+        first = True
+        for key, item in value.iteritems():
+            if not first:
+                yield ', '
+            first = False
+            yield dumps(key)
+            yield ': '
+            for part in _iterencode(item):
+                yield part
+        yield '}'
+    else:
+        yield dumps(value)
+
+def iterdumps(value, chunk_size=STREAM_CHUNK_SIZE):
+    """Encodes ``value`` like :py:func:`dumps`, yielding chunks
+
+    Streams :py:class:`StreamArray` values and dicts containing them.
+    Small parts are buffered up to ``chunk_size`` bytes, large ones
+    (e.g. :py:class:`RawJSON` fragments) are yielded without copying.
+    """
+    buf = []
+    size = 0
+    for part in _iterencode(value):
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        if len(part) >= chunk_size:
+            if buf:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+            yield part
+            continue
+        buf.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield ''.join(buf)
 
 DDJSONRenderer = JSON(serializer=dumps)
-"""pyramid.renderers.JSON using bson.json_util for serialization"""
+"""pyramid.renderers.JSON using :py:func:`dumps`, registered as ``ddjson``"""
 #DDJSONRenderer.add_adapter(datetime.datetime, lambda v, r: v.isoformat())
+
+BSONJSONRenderer = JSON(serializer=bson_util_dumps)
+"""Previous pyramid.renderers.JSON using bson.json_util for serialization"""
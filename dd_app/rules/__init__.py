@@ -1,6 +1,5 @@
 from dd_app.rules.rulesets import get_ruleset
 from bson.objectid import ObjectId
-from beaker.cache import cache_region
 
 def mkid():
     return unicode(ObjectId())
@@ -29,10 +28,29 @@ class ElemRegistry(object):
 
 class RulesVersion(object):
 
-    def __init__(self, game_db=None, version=None, lang=None, **kwargs):
+    def __init__(self, game_db=None, version=None, lang=None, ruleset=None, **kwargs):
         self.game_db = game_db
         self.version = version
         self.lang = lang
+        if ruleset is not None:
+            # bound to a specific ruleset, e.g. of a state being reloaded
+            self._rules = ruleset
+
+    def __setattr__(self, key, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError('RulesVersion %s/%s is shared and read-only' % (self.version, self.lang))
+        object.__setattr__(self, key, value)
+
+    def warm(self):
+        """Resolves ruleset, index and level table, then freezes this instance
+
+        Used by :py:mod:`dd_app.rules.registry`, warmed instances are shared
+        by all requests and tasks of a process. Client rules are encoded on
+        first request, so sections only they need aren't decoded before.
+        """
+        self.index.levels
+        self._frozen = True
+        return self
 
     def set_newgame(self):
         # FIXME hardcoded for now...
@@ -48,20 +66,15 @@ class RulesVersion(object):
         return self._rules
 
     @property
-    def nodes(self):
-        if not hasattr(self, '_nodes'):
-            self._nodes = ElemRegistry()
-            self._nodes.load_elems(self.rules.perps)
-            self._nodes.load_elems(self.rules.view_maps)
-            self._nodes.load_elems(self.rules.tokens)
-        return self._nodes
+    def index(self):
+        return self.rules.index
 
     @property
     def missions(self):
-        return dict((elem.get('type_data').get('gestalt'), elem) for elem in self.rules.missions)
+        return self.index.missions_by_gestalt
 
     def get_next_missions(self, gestalt=0):
-        return dict((elem.get('type_data').get('gestalt'), elem) for elem in self.rules.missions if elem.get('type_data').get('required_mission', 0)==gestalt)
+        return self.index.missions_by_required.get(gestalt, {})
 
     def missions_runtime_data(self, missions):
         """generates initial mission runtime data to be written to game"""
@@ -79,50 +92,34 @@ class RulesVersion(object):
                 'active_missions': active_missions}
 
     def get_powerups_for_project(self, project):
-        @cache_region('long_term', 'jsonrpc-getpowerups-%s-%s-%s' % (project, self.version, self.lang))
-        def cached_powerups():
-            import copy
-            node_type_data = self.rules.perps.get(project, {}).get('type_data', {})
-            powerups = node_type_data.get('provided_ads', []) + node_type_data.get('provided_teammembers', []) + node_type_data.get('provided_upgrades', [])
-            def map_powerups(item):
-                powerup = copy.deepcopy(self.rules.powerups.get(item['gestalt']))
-                powerup['type_data'].update(item)
-                powerup['game_gestalt']=item['gestalt']
-                return powerup
-            return map(map_powerups, powerups)
-        return cached_powerups()
+        """Returns localized powerups of ``project``, a read-only tuple"""
+        return self.rules.project_powerups(project).powerups
 
     def get_levelup_notify_perps(self):
-        perp_types = ('AgentPerp', 'ContactPerp', 'ProxyPerp', 'ProjectPerp', 'CityPerp',)
-        if not hasattr(self, '_levelup_notify_perps'):
-            self._levelup_notify_perps = dict((gestalt, data) for gestalt, data in self.rules.perps.items() if data.get('game_type', None) in perp_types)
-        return self._levelup_notify_perps
+        return self.index.levelup_notify_perps
 
     def get_levelup_items(self, level):
-        perps = [gestalt for gestalt, data in self.get_levelup_notify_perps().items() if data.get('type_data', {}).get('required_level', 0)==level]
-        return perps
+        return list(self.index.levelup_perps_by_level.get(level, []))
 
     def get_levelup_powerups(self, level, current_nodes):
         result = {}
-        for project_gestalt in current_nodes:
-            if project_gestalt.startswith('project'):
-                powerups = self.get_powerups_for_project(project_gestalt)
-                level_powerups = [p for p in powerups if p.get('type_data', {}).get('required_level', None)==level]
-                if len(level_powerups)>0:
-                    result[project_gestalt] = level_powerups
+        level_projects = self.index.powerup_projects_by_level.get(level, ())
+        for project_gestalt in set(current_nodes):
+            if project_gestalt.startswith('project') and project_gestalt in level_projects:
+                result[project_gestalt] = self.rules.project_powerups(project_gestalt).by_level[level]
         return result
 
     def get_consumers(self, level=None):
-        CONSUMERS = ('PusherPerp', 'ClientPerp')
+        consumers = self.index.consumers
         if level is None:
-            return dict((gestalt, data) for gestalt, data in self.rules.perps.items() if data.get('game_type') in CONSUMERS)
-        else:
-            return dict((gestalt, data) for gestalt, data in self.rules.perps.items() if data.get('game_type') in CONSUMERS and data.get('type_data', {}).get('required_level', 0) <= level)
+            return dict(consumers)
+        return dict((gestalt, data) for gestalt, data in consumers.iteritems() if data.get('type_data', {}).get('required_level', 0) <= level)
 
     def get_new_consumers_for_provider(self, provider_gestalt, level=0, current_nodes=[]):
-        consumers = self.get_consumers(level=level)
-        current = set(current_nodes)
-        return dict((gestalt, data) for gestalt, data in consumers.items() if provider_gestalt in set(data.get('type_data', {}).get('required_providers', [])) - current)
+        if provider_gestalt in current_nodes:
+            return {}
+        consumers = self.index.consumers_by_provider.get(provider_gestalt, {})
+        return dict((gestalt, data) for gestalt, data in consumers.iteritems() if data.get('type_data', {}).get('required_level', 0) <= level)
 
     def get_new_game(self):
         result = {'version': self.version}
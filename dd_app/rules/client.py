@@ -0,0 +1,53 @@
+"""Static rules data sent to the client
+
+The client needs the localized type registry (tokens and perps), levels,
+karma and missions of its ruleset. They are encoded once per ruleset and
+language and served content-addressed (``/app/rules/<hash>.json``), so
+clients and proxies can cache them indefinitely and ``loadGame`` only has to
+send the hash. The body is gzip compressed once as well, when the ruleset
+is loaded.
+"""
+
+import hashlib
+
+from dd_app.compression import precompress
+from dd_app.render import RawJSON
+from dd_app.rules import rulesets
+
+
+def client_rules_data(ruleset):
+    """Returns static rules data of a localized ruleset as sent to the client"""
+    type_registry = {}
+    type_registry.update(ruleset.localized('tokens'))
+    type_registry.update(ruleset.localized('perps'))
+    return {'type_registry': type_registry,
+            'levels': ruleset.levels,
+            'karmalauters': ruleset.localized('karmalauters'),
+            'karmalizers': ruleset.localized('karmalizers'),
+            'missions': ruleset.localized('missions')}
+
+
+class ClientRules(object):
+    """Encoded static rules data of a localized ruleset
+
+    ``fragments`` maps every key of :py:func:`client_rules_data` to its
+    :py:class:`dd_app.render.RawJSON` encoding, ``body`` is the json object
+    assembled from them, ``gzipped`` its gzip compression and ``hash`` its
+    sha1 hex digest.
+    """
+
+    def __init__(self, ruleset):
+        self.fragments = dict((key, RawJSON.encode(value)) for key, value in client_rules_data(ruleset).iteritems())
+        self.body = '{%s}' % ', '.join('"%s": %s' % (key, self.fragments[key].encoded) for key in sorted(self.fragments))
+        self.hash = hashlib.sha1(self.body).hexdigest()
+        self.gzipped = precompress(self.body)
+
+
+def find_client_rules(content_hash):
+    """Returns :py:class:`ClientRules` of the current rulesets by hash, or None"""
+    for rules in rulesets.get_state().rules.itervalues():
+        for ruleset in rules:
+            client_rules = ruleset.client_rules()
+            if client_rules.hash == content_hash:
+                return client_rules
+    return None
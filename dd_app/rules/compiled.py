@@ -0,0 +1,180 @@
+"""Compiled binary ruleset artifacts
+
+The json sources of all languages of a ruleset (plus the shared
+``default_game.json``) are compiled into a language-neutral core artifact and
+one text artifact per language, see :py:mod:`dd_app.rules.texts`. Layout::
+
+    MAGIC | header length (4 bytes, big endian) | header (json) | sections
+
+The header contains the content hash of the sections, the marshal format
+version and an ``(offset, length)`` pair for every section. Every section is
+a separately marshalled value, so loading an artifact just memory-maps the
+file and a section is only decoded when it is accessed for the first time.
+
+Artifacts are named ``<name>.<hash>.ddr`` (core) and
+``<name>.<lang>.texts.<hash>.ddr`` (texts). A pointer file
+``<name>.current`` resp. ``<name>.<lang>.texts.current`` holds the file name
+of the artifact to load, it is replaced atomically when a new artifact gets
+compiled.
+"""
+
+import hashlib
+import json
+import marshal
+import mmap
+import os
+import struct
+import tempfile
+
+from dd_app.rules.texts import TEXT_SECTIONS, split_languages
+
+MAGIC = 'DDRULES\x01'
+_HEADER_LEN = struct.Struct('>I')
+
+SECTIONS = ('version', 'perps', 'default_game', 'tokens', 'powerups', 'levels', 'karmalauters', 'karmalizers', 'missions')
+OPTIONAL_SECTIONS = ('karmalauters', 'karmalizers', 'missions')
+
+
+class InvalidArtifact(Exception):
+    pass
+
+
+def artifact_name(name, content_hash):
+    return '%s.%s.ddr' % (name, content_hash)
+
+def texts_name(name, lang):
+    return '%s.%s.texts' % (name, lang)
+
+def pointer_name(name):
+    return '%s.current' % name
+
+def _atomic_write(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+def _load_json(rulepath, filename):
+    with open(os.path.join(rulepath, filename), 'rb') as fp:
+        return json.load(fp)
+
+def build_sections(data, default_game):
+    """Maps ruleset json data to artifact sections"""
+    sections = {'default_game': default_game}
+    for key in SECTIONS:
+        if key == 'default_game':
+            continue
+        if key in OPTIONAL_SECTIONS:
+            sections[key] = data.get(key, [])
+        else:
+            sections[key] = data[key]
+    return sections
+
+def build_text_sections(texts):
+    """Maps split texts of one language to artifact sections"""
+    return dict((key, texts.get(key, {})) for key in TEXT_SECTIONS)
+
+def compile_sections(sections):
+    """Returns ``(content, content_hash)`` of an artifact for ``sections``"""
+    offset = 0
+    index = {}
+    payloads = []
+    digest = hashlib.sha1()
+    for key in sorted(sections):
+        payload = marshal.dumps(sections[key], marshal.version)
+        index[key] = (offset, len(payload))
+        offset += len(payload)
+        payloads.append(payload)
+        digest.update(key)
+        digest.update(payload)
+    content_hash = digest.hexdigest()
+    header = json.dumps({'hash': content_hash,
+                         'marshal_version': marshal.version,
+                         'sections': index})
+    return ''.join([MAGIC, _HEADER_LEN.pack(len(header)), header] + payloads), content_hash
+
+def write_artifact(name, sections, outpath):
+    """Writes artifact ``name`` for ``sections`` to ``outpath``
+
+    Returns the path of the artifact. Writing unchanged sections is a no-op
+    apart from refreshing the pointer file.
+    """
+    content, content_hash = compile_sections(sections)
+    path = os.path.join(outpath, artifact_name(name, content_hash))
+    if not os.path.exists(path):
+        _atomic_write(path, content)
+    _atomic_write(os.path.join(outpath, pointer_name(name)), os.path.basename(path))
+    return path
+
+def compile_ruleset(name, langs, rulepath, outpath=None):
+    """Compiles ``<rulepath>/<name>.<lang>.json`` for all ``langs``
+
+    Writes the core artifact and a text artifact per language to
+    ``outpath``. The game data of all languages has to be identical, else
+    :py:class:`dd_app.rules.texts.RulesetMismatch` is raised. Returns a list
+    of ``(artifact name, path)`` tuples.
+    """
+    if outpath is None:
+        outpath = rulepath
+    sources = [(lang, _load_json(rulepath, '%s.%s.json' % (name, lang))) for lang in langs]
+    core, texts = split_languages(sources)
+    del sources
+    result = [(name, write_artifact(name, build_sections(core, _load_json(rulepath, 'default_game.json')), outpath))]
+    for lang in langs:
+        lang_name = texts_name(name, lang)
+        result.append((lang_name, write_artifact(lang_name, build_text_sections(texts[lang]), outpath)))
+    return result
+
+def current_artifact(name, path):
+    """Returns path of the current artifact for ``name`` or None"""
+    try:
+        with open(os.path.join(path, pointer_name(name)), 'rb') as fp:
+            filename = fp.read().strip()
+    except IOError:
+        return None
+    artifact = os.path.join(path, filename)
+    if not os.path.exists(artifact):
+        return None
+    return artifact
+
+
+class CompiledRuleset(object):
+    """Memory-mapped ruleset artifact
+
+    Exposes every section as attribute, like the json based ``Ruleset`` and
+    ``Texts`` namedtuples. Sections are decoded on first access and cached
+    afterwards.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise InvalidArtifact('%s is not a ruleset artifact' % path)
+        start = len(MAGIC) + _HEADER_LEN.size
+        header_len, = _HEADER_LEN.unpack(self._map[len(MAGIC):start])
+        header = json.loads(self._map[start:start+header_len])
+        if header['marshal_version'] != marshal.version:
+            raise InvalidArtifact('%s was compiled with marshal version %s' % (path, header['marshal_version']))
+        self.content_hash = header['hash']
+        self._base = start + header_len
+        self._sections = header['sections']
+
+    def __getattr__(self, key):
+        # only called for sections not decoded yet
+        if key.startswith('_') or key not in self._sections:
+            raise AttributeError(key)
+        offset, length = self._sections[key]
+        start = self._base + offset
+        value = marshal.loads(self._map[start:start+length])
+        setattr(self, key, value)
+        return value
+
+    def __repr__(self):
+        return '<CompiledRuleset %s>' % self.path
@@ -0,0 +1,28 @@
+"""Read-only containers for rules data shared across requests"""
+
+
+class FrozenDict(dict):
+    """dict raising TypeError on modification
+
+    Still a ``dict``, so it renders and pickles like one. ``dict(frozen)``
+    returns a modifiable copy.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('%s is read-only' % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self), ))
+
+
+def freeze(value):
+    """Returns a deeply read-only copy of json-like ``value``"""
+    if isinstance(value, FrozenDict):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
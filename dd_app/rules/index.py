@@ -0,0 +1,162 @@
+"""Precomputed lookup tables for loaded rulesets"""
+
+import threading
+
+from dd_app.rules.frozen import FrozenDict, freeze
+from dd_app.rules.levels import LevelTable
+from dd_app.perps import PerpGraph
+
+PROJECT_POWERUP_KEYS = ('provided_ads', 'provided_teammembers', 'provided_upgrades',)
+
+
+class ProjectPowerups(object):
+    """Frozen powerup table of a project perp
+
+    :param provided: ``(key, item)`` pairs, the project specific powerup
+                     items of ``type_data[key]`` for all
+                     :py:data:`PROJECT_POWERUP_KEYS`
+    :param get_powerup: returns powerup definition for a gestalt, or None
+
+    ``powerups`` are the powerup definitions with the project specific item
+    merged into their type_data, as sent to the client. All tables are built
+    once and read-only.
+    """
+
+    def __init__(self, provided, get_powerup):
+        self._get_powerup = get_powerup
+        self.provided = tuple((key, freeze(item)) for key, item in provided)
+        # (key, gestalt) -> project specific item
+        self.items = FrozenDict(((key, item['gestalt']), item) for key, item in self.provided)
+        powerups = []
+        by_level = {}
+        for key, item in self.provided:
+            powerup = get_powerup(item['gestalt'])
+            if powerup is None:
+                continue
+            merged = dict(powerup)
+            merged['type_data'] = dict(powerup.get('type_data', {}))
+            merged['type_data'].update(item)
+            merged['game_gestalt'] = item['gestalt']
+            merged = freeze(merged)
+            powerups.append(merged)
+            by_level.setdefault(merged['type_data'].get('required_level', None), []).append(merged)
+        self.powerups = tuple(powerups)
+        # required_level -> (powerup, ...)
+        self.by_level = FrozenDict((level, tuple(p)) for level, p in by_level.iteritems())
+
+    def get_item(self, key, gestalt):
+        """Returns the project specific item for powerup ``gestalt`` or None"""
+        return self.items.get((key, gestalt), None)
+
+    def localized(self, localize):
+        """Returns a copy with powerups passed through ``localize(gestalt, powerup)``"""
+        get_powerup = self._get_powerup
+        def localized_powerup(gestalt):
+            powerup = get_powerup(gestalt)
+            if powerup is None:
+                return None
+            return localize(gestalt, powerup)
+        return ProjectPowerups(self.provided, localized_powerup)
+
+
+EMPTY_POWERUPS = ProjectPowerups((), lambda gestalt: None)
+
+
+class RulesIndex(object):
+    """Lookup tables compiled once from a ruleset
+
+    :param ruleset: ruleset as provided by
+                    :py:func:`dd_app.rules.rulesets.get_ruleset`
+
+    Every table is built with the index, so answering a rules question does
+    not have to walk the raw ruleset dicts. Tables must be treated as read-only,
+    they are shared by all requests and tasks of a process.
+    """
+
+    LEVELUP_NOTIFY_TYPES = ('AgentPerp', 'ContactPerp', 'ProxyPerp', 'ProjectPerp', 'CityPerp',)
+    CONSUMER_TYPES = ('PusherPerp', 'ClientPerp',)
+
+    def __init__(self, ruleset):
+        self.version = ruleset.version
+        self.levels = LevelTable(ruleset.levels)
+        self._index_perps(ruleset.perps)
+        self.perp_graph = PerpGraph(ruleset.perps, ruleset.tokens)
+        self._index_powerups(ruleset.perps, ruleset.powerups)
+        self._index_missions(ruleset.missions)
+
+    def _index_perps(self, perps):
+        # game_type -> {gestalt: perp}
+        self.perps_by_type = {}
+        # required_level -> [gestalt, ...]
+        self.perps_by_level = {}
+        # provider gestalt -> {consumer gestalt: perp}
+        self.consumers_by_provider = {}
+        for gestalt, data in perps.iteritems():
+            game_type = data.get('game_type', None)
+            type_data = data.get('type_data', {})
+            level = type_data.get('required_level', 0)
+            self.perps_by_type.setdefault(game_type, {})[gestalt] = data
+            self.perps_by_level.setdefault(level, []).append(gestalt)
+            if game_type in self.CONSUMER_TYPES:
+                for provider in set(type_data.get('required_providers', [])):
+                    self.consumers_by_provider.setdefault(provider, {})[gestalt] = data
+        self.levelup_notify_perps = {}
+        for game_type in self.LEVELUP_NOTIFY_TYPES:
+            self.levelup_notify_perps.update(self.perps_by_type.get(game_type, {}))
+        self.consumers = {}
+        for game_type in self.CONSUMER_TYPES:
+            self.consumers.update(self.perps_by_type.get(game_type, {}))
+        # required_level -> [gestalt, ...], levelup notification candidates only
+        self.levelup_perps_by_level = {}
+        for gestalt, data in self.levelup_notify_perps.iteritems():
+            level = data.get('type_data', {}).get('required_level', 0)
+            self.levelup_perps_by_level.setdefault(level, []).append(gestalt)
+
+    def _index_powerups(self, perps, powerups):
+        # required_level -> [powerup gestalt, ...]
+        self.powerups_by_level = {}
+        for gestalt, data in powerups.iteritems():
+            level = data.get('type_data', {}).get('required_level', 0)
+            self.powerups_by_level.setdefault(level, []).append(gestalt)
+        # project gestalt -> ProjectPowerups, projects providing powerups only
+        self.project_powerups = {}
+        # required_level -> set of project gestalten providing powerups of that level
+        self.powerup_projects_by_level = {}
+        for project, data in perps.iteritems():
+            type_data = data.get('type_data', {})
+            provided = [(key, item) for key in PROJECT_POWERUP_KEYS for item in type_data.get(key, [])]
+            if not provided:
+                continue
+            table = ProjectPowerups(provided, powerups.get)
+            self.project_powerups[project] = table
+            for level in table.by_level:
+                self.powerup_projects_by_level.setdefault(level, set()).add(project)
+
+    def _index_missions(self, missions):
+        # gestalt -> mission
+        self.missions_by_gestalt = {}
+        # required mission gestalt -> {gestalt: mission}
+        self.missions_by_required = {}
+        for mission in missions:
+            type_data = mission.get('type_data')
+            gestalt = type_data.get('gestalt')
+            self.missions_by_gestalt[gestalt] = mission
+            self.missions_by_required.setdefault(type_data.get('required_mission', 0), {})[gestalt] = mission
+
+
+def lazy_index(ruleset):
+    """Returns a function building the :py:class:`RulesIndex` of ``ruleset``
+
+    The index is built on the first call only, later calls (from any
+    thread) return the same instance. Rulesets of versions never played
+    aren't indexed this way.
+    """
+    lock = threading.Lock()
+    built = []
+    def get_index():
+        if not built:
+            with lock:
+                if not built:
+                    built.append(RulesIndex(ruleset))
+        return built[0]
+    return get_index
@@ -0,0 +1,76 @@
+"""Level lookups compiled from ruleset levels"""
+
+from bisect import bisect_right
+
+from dd_app import helpers
+
+
+class LevelNotFound(Exception):
+    pass
+
+
+class LevelTable(object):
+    """XP to level lookup table
+
+    :param levels: list of level definitions (``rules.levels``), each
+                   containing ``number``, ``xp_min``, ``xp_max``, ``ap_max``,
+                   ``ap_inc_value`` and ``ap_inc_interval``
+
+    Levels are sorted by ``xp_min`` once, lookups bisect over the sorted
+    ``xp_min`` values instead of scanning all levels.
+    """
+
+    def __init__(self, levels):
+        self.levels = sorted(levels, key=lambda l: l['xp_min'])
+        self.xp_min = [l['xp_min'] for l in self.levels]
+        self.xp_max = [l['xp_max'] for l in self.levels]
+        self.by_number = dict((l['number'], l) for l in self.levels)
+
+    def __len__(self):
+        return len(self.levels)
+
+    def _position(self, xp_value):
+        pos = bisect_right(self.xp_min, xp_value) - 1
+        if pos < 0 or xp_value > self.xp_max[pos]:
+            raise LevelNotFound('No levels for xp_value %s' % xp_value)
+        return pos
+
+    def level_for_xp(self, xp_value):
+        """Returns level definition for ``xp_value``"""
+        return self.levels[self._position(xp_value)]
+
+    def level_number(self, level):
+        """Returns level definition by level ``number``"""
+        return self.by_number[level]
+
+    def level_jump(self, old_xp, new_xp):
+        """Returns ``(levelinfo, next_levelinfo)`` for an xp change
+
+        ``next_levelinfo`` is the level reached with ``new_xp``, which may be
+        several levels above ``levelinfo``. It is ``levelinfo`` itself if the
+        xp change does not leave the current level.
+        """
+        levelinfo = self.level_for_xp(old_xp)
+        if new_xp > levelinfo['xp_max'] or new_xp < levelinfo['xp_min']:
+            return levelinfo, self.level_for_xp(new_xp)
+        return levelinfo, levelinfo
+
+    def levels_for_xp(self, xp_values):
+        """Returns level definitions for a batch of xp values, in order
+
+        Every value is bisected, O(log n) in the number of levels.
+        """
+        return [self.levels[self._position(xp_value)] for xp_value in xp_values]
+
+    def level_numbers(self, xp_values):
+        """Returns level numbers for a batch of xp values, in order"""
+        return [l['number'] for l in self.levels_for_xp(xp_values)]
+
+    def ap_state(self, xp_value, snap_val, snap_ms, now_ms):
+        """Returns ``(ap, update_ms)`` for a player with ``xp_value``
+
+        :param snap_val: AP snapshot value (``game_values.ap_snapshot``)
+        :param snap_ms: snapshot time in milliseconds since epoch
+        :param now_ms: current time in milliseconds since epoch
+        """
+        return helpers.calculateAPMillis(snap_val, snap_ms, self.level_for_xp(xp_value), now_ms)
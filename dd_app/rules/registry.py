@@ -0,0 +1,54 @@
+"""Process-wide registry of warmed :py:class:`dd_app.rules.RulesVersion` views"""
+
+import threading
+
+from dd_app.rules import RulesVersion, RulesNoVersion
+from dd_app.rules import rulesets
+
+
+class RulesRegistry(object):
+    """Hands out one shared, read-only ``RulesVersion`` per (version, lang)
+
+    Views are kept per :py:class:`dd_app.rules.rulesets.RulesState`, a
+    reload swaps in a new state together with its views. Lookups of
+    registered views don't lock; creating a view is serialized, so
+    concurrent first requests (threads or greenlets) end up with the same
+    instance. Unknown languages fall back to 'en', like
+    :py:func:`dd_app.rules.rulesets.get_ruleset`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def get(self, version, lang='en', state=None):
+        if state is None:
+            state = rulesets.get_state()
+        if lang not in state.rules:
+            lang = 'en'
+        key = (version, lang)
+        view = state.views.get(key, None)
+        if view is not None:
+            return view
+        with self._lock:
+            view = state.views.get(key, None)
+            if view is None:
+                ruleset = state.get_ruleset(version, lang)
+                if ruleset is None:
+                    raise RulesNoVersion('No ruleset for version %s' % version)
+                view = RulesVersion(version=version, lang=lang, ruleset=ruleset).warm()
+                state.views[key] = view
+        return view
+
+    def warm(self, state=None):
+        """Creates views for all rulesets of ``state`` (default: current)"""
+        if state is None:
+            state = rulesets.get_state()
+        for lang, rules in state.rules.items():
+            for rule in rules:
+                self.get(rule.version, lang, state=state)
+
+
+REGISTRY = RulesRegistry()
+
+def get_rules_version(version, lang='en'):
+    return REGISTRY.get(version, lang)
@@ -0,0 +1,121 @@
+"""Hot reload of compiled rulesets
+
+Every process polls the ``.current`` pointer files of its rulesets (see
+:py:mod:`dd_app.rules.compiled`). When a pointer changes, a new
+:py:class:`dd_app.rules.rulesets.RulesState` is built and warmed in the
+background and then swapped in atomically. The process noticing the change
+broadcasts a ``rules_reload`` message on the ``srv_msg`` channel, so all
+other processes check their pointers right away instead of waiting for
+their next poll.
+
+Requests and tasks keep the rules they started with (see
+``ApiHandler._get_rules_version``), only new ones see the new state.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from dd_app.messaging.messenger import Messenger
+from dd_app.rules import rulesets
+from dd_app.rules.registry import REGISTRY
+from dd_app.rules.rulesets import settings as rules_settings
+from dd_app.rules.rulesets.loader import current_sources
+
+log = logging.getLogger(__name__)
+
+
+def changed_sources(state):
+    """Returns current artifact paths if they differ from ``state``, else None"""
+    sources = dict((name, current_sources(name, langs)) for name, langs in rules_settings.RULESETS.iteritems())
+    if sources == state.sources:
+        return None
+    # only compiled rulesets are reloaded
+    for core, texts in sources.itervalues():
+        if core is None or None in texts.values():
+            return None
+    return sources
+
+
+class RulesReloader(object):
+    """Watches compiled rulesets and swaps in new ones
+
+    :param settings: registry settings, used for the ``redis.connector``
+    :param interval: poll interval in seconds
+    """
+
+    def __init__(self, settings, interval):
+        self.settings = settings
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._failed = None
+        self._pid = None
+
+    def check(self, broadcast=True):
+        """Reloads rulesets if their artifacts changed
+
+        Returns True if a new state was swapped in. Broken artifacts are
+        logged and skipped until their pointers change again, the current
+        state stays active meanwhile.
+        """
+        if changed_sources(rulesets.get_state()) is None:
+            return False
+        with self._lock:
+            sources = changed_sources(rulesets.get_state())
+            if sources is None or sources == self._failed:
+                return False
+            try:
+                state = rulesets.RulesState()
+                REGISTRY.warm(state)
+            except Exception:
+                self._failed = sources
+                log.exception('Loading rulesets %s failed, keeping current rulesets' % sources)
+                return False
+            rulesets.set_state(state)
+            self._failed = None
+        log.info('Rulesets reloaded: %s' % state.sources)
+        if broadcast:
+            self._messenger().rules_reload(state.sources)
+        return True
+
+    def _messenger(self):
+        return Messenger(settings=self.settings)
+
+    def _safe_check(self, broadcast):
+        try:
+            self.check(broadcast=broadcast)
+        except Exception:
+            log.exception('Rules reload check failed')
+
+    def poll(self):
+        while True:
+            time.sleep(self.interval)
+            self._safe_check(True)
+
+    def listen(self):
+        while True:
+            try:
+                # own messenger, pubsub connections can't be shared
+                messenger = self._messenger()
+                messenger.attach()
+                for m in messenger.get_incoming():
+                    if m.action == Messenger.RULES_RELOAD:
+                        self._safe_check(False)
+            except Exception:
+                log.exception('Rules reload listener failed')
+                time.sleep(self.interval)
+
+    def start(self):
+        """Starts poller and listener, once per process
+
+        Threads are greenlets in gevent patched processes. Safe to be called
+        again after a fork, e.g. in celery pool processes.
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        for target in (self.poll, self.listen):
+            thread = threading.Thread(target=target, name='rules-reload-%s' % target.__name__)
+            thread.daemon = True
+            thread.start()
@@ -1,13 +1,54 @@
-from dd_app.rules.rulesets.ruleset_3_de import RULESET as RULESET_3_DE
-from dd_app.rules.rulesets.ruleset_3_en import RULESET as RULESET_3_EN
+from dd_app.rules.rulesets import settings
+from dd_app.rules.rulesets.loader import load_ruleset, ruleset_sources
+from dd_app.rules.index import lazy_index
+from dd_app.rules.texts import LocalizedRuleset
 
-RULES = {
-    'en': [RULESET_3_EN, ],
-    'de': [RULESET_3_DE, ],
-}
+
+class RulesState(object):
+    """All rulesets of ``settings.RULESETS`` with their lazily built indexes
+
+    A state is never modified after it has been built. Reloading rulesets
+    builds a new state and swaps it in with :py:func:`set_state`, requests
+    holding rules of the old state keep working on those.
+    """
+
+    def __init__(self):
+        # ruleset name -> artifact paths the ruleset was loaded from
+        self.sources = {}
+        # lang -> [LocalizedRuleset, ...]
+        self.rules = {}
+        # (version, lang) -> warmed RulesVersion, see dd_app.rules.registry
+        self.views = {}
+        for name, langs in sorted(settings.RULESETS.items()):
+            core, texts = load_ruleset(name, langs)
+            self.sources[name] = ruleset_sources(core, texts)
+            # one index per language-neutral core, shared by all languages
+            # and built on first use
+            build_index = lazy_index(core)
+            for lang in langs:
+                self.rules.setdefault(lang, []).append(LocalizedRuleset(core, lang, texts[lang], build_index=build_index))
+
+    def get_ruleset(self, version, lang):
+        res = [rule for rule in self.rules.get(lang, self.rules.get('en')) if rule.version==version]
+        if not res:
+            return None
+        return res[0]
+
+
+_state = RulesState()
+
+def get_state():
+    return _state
+
+def set_state(state):
+    global _state
+    _state = state
 
 def get_ruleset(version, lang):
-    res = [rule for rule in RULES.get(lang, RULES.get('en')) if rule.version==version]
-    if not res:
+    return _state.get_ruleset(version, lang)
+
+def get_index(version, lang):
+    rule = get_ruleset(version, lang)
+    if rule is None:
         return None
-    return res[0]
+    return rule.index
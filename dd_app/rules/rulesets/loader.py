@@ -0,0 +1,54 @@
+"""Ruleset loading, preferring compiled artifacts over json sources"""
+
+from collections import namedtuple
+import json
+import os
+
+from dd_app.rules.compiled import SECTIONS, CompiledRuleset, build_sections, current_artifact, texts_name
+from dd_app.rules.texts import TEXT_SECTIONS, Texts, split_languages
+from dd_app.rules.rulesets import settings
+
+Ruleset = namedtuple('Ruleset', SECTIONS)
+
+def load_json_ruleset(name, langs, rulepath):
+    sources = []
+    for lang in langs:
+        fp = open(os.path.join(rulepath, '%s.%s.json' % (name, lang)))
+        sources.append((lang, json.load(fp)))
+        fp.close()
+    core, texts = split_languages(sources)
+
+    fp = open(os.path.join(rulepath, 'default_game.json'))
+    default_game = json.load(fp)
+    fp.close()
+
+    return Ruleset(**build_sections(core, default_game)), \
+           dict((lang, Texts(*[t.get(key, {}) for key in TEXT_SECTIONS])) for lang, t in texts.iteritems())
+
+def current_sources(name, langs):
+    """Returns the current compiled artifact paths for ruleset ``name``
+
+    ``(core, {lang: texts})``, paths are None if not compiled.
+    """
+    path = settings.COMPILED_RULEPATH or settings.RULEPATH
+    return current_artifact(name, path), dict((lang, current_artifact(texts_name(name, lang), path)) for lang in langs)
+
+def ruleset_sources(core, texts):
+    """Returns the artifact paths a loaded ruleset was loaded from
+
+    Comparable to :py:func:`current_sources`, paths are None for rulesets
+    loaded from json.
+    """
+    return getattr(core, 'path', None), dict((lang, getattr(t, 'path', None)) for lang, t in texts.iteritems())
+
+def load_ruleset(name, langs):
+    """Returns ``(core, {lang: texts})`` for ruleset ``name``
+
+    Loads the current compiled artifacts (see :py:mod:`dd_app.rules.compiled`)
+    if there are any for the core and all ``langs``, else falls back to
+    parsing the json sources.
+    """
+    core, texts = current_sources(name, langs)
+    if core is not None and None not in texts.values():
+        return CompiledRuleset(core), dict((lang, CompiledRuleset(t)) for lang, t in texts.iteritems())
+    return load_json_ruleset(name, langs, settings.RULEPATH)
@@ -1,4 +1,13 @@
-RULEPATH = 'dd_app/rules/rulesets'
+import os
+
+RULEPATH = os.path.dirname(os.path.abspath(__file__))
+# directory containing compiled ruleset artifacts, defaults to RULEPATH
+COMPILED_RULEPATH = None
+# ruleset name -> languages, the first language is the reference for the
+# language-neutral core
+RULESETS = {
+    'ruleset_3': ('en', 'de'),
+}
 
 try:
     from dd_app.rules.rulesets.settings_local import *
@@ -0,0 +1,179 @@
+"""Language-neutral rulesets and per-language text overlays
+
+Rulesets of different languages only differ in their texts. A ruleset is
+split into a language-neutral core (all game data, texts removed) and a text
+overlay per language, mapping ``section -> gestalt -> {field: text}``.
+Texts are only merged back into rules elements when those are rendered for
+the client, see :py:meth:`LocalizedRuleset.localized`.
+"""
+
+from collections import namedtuple
+
+TEXT_FIELDS = ('label', 'title', 'subtitle', 'description', 'requirements_text', 'findings_text', 'knowledge_text')
+TEXT_SECTIONS = ('perps', 'tokens', 'powerups', 'karmalauters', 'karmalizers', 'missions')
+
+Texts = namedtuple('Texts', TEXT_SECTIONS)
+
+
+class RulesetMismatch(Exception):
+    """Raised if rulesets of different languages differ in game data"""
+    pass
+
+
+def _element_key(elem):
+    return elem.get('type_data', {}).get('gestalt')
+
+def _items(elems):
+    if isinstance(elems, dict):
+        return elems.iteritems()
+    return ((_element_key(elem), elem) for elem in elems)
+
+def split_texts(data):
+    """Returns ``(core, texts)`` for ruleset json ``data``
+
+    ``core`` is a copy of ``data`` with all text fields removed from the
+    elements of :py:data:`TEXT_SECTIONS`, ``texts`` the removed text fields.
+    """
+    core = dict(data)
+    texts = {}
+    for section in TEXT_SECTIONS:
+        elems = data.get(section, None)
+        if elems is None:
+            continue
+        section_texts = {}
+        stripped = []
+        for key, elem in _items(elems):
+            type_data = elem.get('type_data', {})
+            elem_texts = dict((f, type_data[f]) for f in TEXT_FIELDS if f in type_data)
+            if elem_texts:
+                section_texts[key] = elem_texts
+                elem = dict(elem)
+                elem['type_data'] = dict((k, v) for k, v in type_data.iteritems() if k not in TEXT_FIELDS)
+            stripped.append((key, elem))
+        if isinstance(elems, dict):
+            core[section] = dict(stripped)
+        else:
+            core[section] = [elem for key, elem in stripped]
+        texts[section] = section_texts
+    return core, texts
+
+def split_languages(sources):
+    """Splits ``sources`` (list of ``(lang, data)``) into a shared core
+
+    Returns ``(core, {lang: texts})``. The core of the first language is
+    used, all other languages have to match it exactly.
+    """
+    core = None
+    texts = {}
+    for lang, data in sources:
+        lang_core, texts[lang] = split_texts(data)
+        if core is None:
+            core = lang_core
+        elif lang_core != core:
+            raise RulesetMismatch('Game data for language %s differs from %s' % (lang, sources[0][0]))
+    return core, texts
+
+def localize(elem, texts):
+    """Returns a copy of ``elem`` with ``texts`` merged into its type_data"""
+    if not texts:
+        return elem
+    elem = dict(elem)
+    elem['type_data'] = dict(elem.get('type_data', {}), **texts)
+    return elem
+
+
+class LocalizedRuleset(object):
+    """A language-neutral ruleset core combined with one language's texts
+
+    Attribute access is delegated to the core, so game logic keeps working
+    on the shared, text-free data. ``index`` is the
+    :py:class:`dd_app.rules.index.RulesIndex` of the core, or built by
+    ``build_index`` on first access, see
+    :py:func:`dd_app.rules.index.lazy_index`.
+    """
+
+    def __init__(self, core, lang, texts, index=None, build_index=None):
+        self.core = core
+        self.lang = lang
+        self.texts = texts
+        self._index = index
+        self._build_index = build_index
+        self._project_powerups = {}
+        self._client_rules = None
+        self._encoded = {}
+
+    def __getattr__(self, key):
+        if key in ('core', 'lang', 'texts', '_index', '_build_index', '_project_powerups', '_client_rules', '_encoded'):
+            raise AttributeError(key)
+        return getattr(self.core, key)
+
+    @property
+    def index(self):
+        if self._index is None and self._build_index is not None:
+            self._index = self._build_index()
+        return self._index
+
+    @property
+    def revision(self):
+        """Content hash of the compiled core, None for json rulesets"""
+        return getattr(self.core, 'content_hash', None)
+
+    def section_texts(self, section):
+        return getattr(self.texts, section, None) or {}
+
+    def localize(self, section, elem, key=None):
+        """Returns ``elem`` of ``section`` including its texts"""
+        if key is None:
+            key = _element_key(elem)
+        return localize(elem, self.section_texts(section).get(key, None))
+
+    def localized(self, section):
+        """Returns ``section`` with texts merged into its elements"""
+        elems = getattr(self.core, section)
+        texts = self.section_texts(section)
+        if isinstance(elems, dict):
+            return dict((key, localize(elem, texts.get(key, None))) for key, elem in elems.iteritems())
+        return [localize(elem, texts.get(_element_key(elem), None)) for elem in elems]
+
+    def project_powerups(self, project):
+        """Returns the localized, frozen powerup table of ``project``
+
+        Built from the index table on first access, then cached. Unknown
+        projects share the empty table, so client input doesn't grow the
+        cache.
+        """
+        if not self.has_project(project):
+            project = None
+        table = self._project_powerups.get(project, None)
+        if table is None:
+            from dd_app.rules.index import EMPTY_POWERUPS
+            table = self.index.project_powerups.get(project, EMPTY_POWERUPS)
+            table = table.localized(lambda gestalt, powerup: self.localize('powerups', powerup, gestalt))
+            self._project_powerups[project] = table
+        return table
+
+    def has_project(self, project):
+        """True if ``project`` is the gestalt of a project with powerups"""
+        return isinstance(project, basestring) and project in self.index.project_powerups
+
+    def client_rules(self):
+        """Returns the encoded :py:class:`dd_app.rules.client.ClientRules`, built once"""
+        if self._client_rules is None:
+            from dd_app.rules.client import ClientRules
+            self._client_rules = ClientRules(self)
+        return self._client_rules
+
+    def encoded(self, key, build):
+        """Returns ``build()`` as :py:class:`dd_app.render.RawJSON`
+
+        Encoded once per ``key``, for static data rendered to the client.
+        """
+        raw = self._encoded.get(key, None)
+        if raw is None:
+            from dd_app.render import RawJSON
+            raw = RawJSON.encode(build())
+            self._encoded[key] = raw
+        return raw
+
+    def __repr__(self):
+        return '<LocalizedRuleset %s %r>' % (self.lang, self.core)
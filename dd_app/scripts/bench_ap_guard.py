@@ -0,0 +1,84 @@
+"""Benchmarks the AP guard of mutations: ``$where`` against plain equality
+
+Usage::
+
+    python -m dd_app.scripts.bench_ap_guard [-n NUMBER] [-g GAMES] INI
+
+Fills a scratch collection ``bench_ap_guard`` in the mongodb configured in
+``INI`` with ``GAMES`` synthetic games and spends one AP of random games
+``NUMBER`` times with each guard, like ``collectPerp`` does. The collection
+is dropped afterwards. Timings are per ``find_and_modify``.
+"""
+
+import datetime
+import optparse
+import random
+import sys
+import time
+
+import pytz
+from bson.dbref import DBRef
+
+from dd_app.helpers import calculateAP, datetime_to_millis
+
+LEVELINFO = {'ap_inc_interval': 5000, 'ap_inc_value': 1, 'ap_max': 100}
+
+
+def where_guard(game_values, now_ms, cost):
+    return {'$where': 'function() { return Math.min(this.game_values.ap_snapshot + (parseInt((%s-this.game_values.ap_update.getTime()) / %s)) * %s, %s) >= %s; }' % (
+        now_ms, LEVELINFO['ap_inc_interval'], LEVELINFO['ap_inc_value'], LEVELINFO['ap_max'], cost)}
+
+def equality_guard(game_values, now_ms, cost):
+    return {'game_values.ap_snapshot': game_values['ap_snapshot'],
+            'game_values.ap_update': game_values['ap_update']}
+
+def fill(collection, games):
+    now = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC, microsecond=0)
+    collection.drop()
+    collection.insert([{'user': DBRef('users', i),
+                        'nodes_lock': 1,
+                        'game_values': {'ap_snapshot': 50, 'ap_update': now, 'xp_value': 0},
+                        'nodes': [{'full_path': 'Database.%s' % j} for j in xrange(100)]} for i in xrange(games)])
+    collection.ensure_index('user.$id')
+
+def spend(collection, user, guard):
+    game = collection.find_one({'user.$id': user}, {'game_values': 1, 'nodes_lock': 1})
+    now = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
+    ap, update = calculateAP(game['game_values']['ap_snapshot'], game['game_values']['ap_update'], LEVELINFO, datenow=now)
+    query = {'user.$id': user, 'nodes_lock': game['nodes_lock']}
+    query.update(guard(game['game_values'], datetime_to_millis(now), 1))
+    start = time.time()
+    result = collection.find_and_modify(query=query,
+                                        update={'$set': {'game_values.ap_snapshot': ap - 1, 'game_values.ap_update': update},
+                                                '$inc': {'nodes_lock': 1}},
+                                        new=True,
+                                        fields={'game_values': 1})
+    if result is None:
+        raise AssertionError('guard %s rejected user %s' % (guard.__name__, user))
+    return time.time() - start
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(usage='%prog [-n NUMBER] [-g GAMES] INI')
+    parser.add_option('-n', '--number', dest='number', type='int', default=1000,
+                      help='updates per guard')
+    parser.add_option('-g', '--games', dest='games', type='int', default=10000,
+                      help='synthetic games')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error('INI is required')
+    from pyramid.paster import bootstrap
+    settings = bootstrap(args[0])['registry'].settings
+    collection = settings['mongodb.connector'].get_db()['bench_ap_guard']
+    fill(collection, options.games)
+    try:
+        timings = {}
+        for guard in (where_guard, equality_guard):
+            users = [random.randrange(options.games) for i in xrange(options.number)]
+            timings[guard] = sum(spend(collection, user, guard) for user in users) / options.number
+            print '%-15s %7.3fms' % (guard.__name__, timings[guard]*1000)
+        print 'x%.1f' % (timings[where_guard] / timings[equality_guard])
+    finally:
+        collection.drop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Benchmarks the ddjson renderer serializer against bson.json_util
+
+Usage::
+
+    python -m dd_app.scripts.bench_render [-n NUMBER] [-g GAMES] [INI]
+
+With a pyramid ``INI`` file, up to ``GAMES`` game documents are sampled from
+the configured mongodb and encoded as ``loadGame`` responses. Without, a
+synthetic mature game (a node for every perp, a filled ``db_queue``) is
+generated for every loaded ruleset. Both serializers have to produce equal
+json, timings are per encoded response.
+"""
+
+import datetime
+import json
+import optparse
+import sys
+import timeit
+
+import pytz
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+
+from dd_app.render import bson_util_dumps, dumps
+
+
+def sample_games(ini, limit):
+    from pyramid.paster import bootstrap
+    settings = bootstrap(ini)['registry'].settings
+    db = settings['mongodb.connector'].get_db()
+    for game in db['games'].find().limit(limit):
+        game['_id'] = unicode(game['_id'])
+        yield 'game %s (%d nodes)' % (game['_id'], len(game.get('nodes', []))), game
+
+def synthetic_games():
+    from dd_app.rules.registry import REGISTRY
+    from dd_app.rules.rulesets import get_state
+    REGISTRY.warm()
+    now = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
+    for (version, lang), rv in sorted(get_state().views.items()):
+        game = rv.get_new_game()
+        game['_id'] = unicode(ObjectId())
+        game['user'] = DBRef('users', ObjectId())
+        for gestalt, perp in rv.rules.perps.iteritems():
+            game['nodes'].append({'game_id': ObjectId(),
+                                  'gestalt': gestalt,
+                                  'game_type': perp.get('game_type'),
+                                  'full_type': '%s:%s' % (perp.get('game_type'), gestalt),
+                                  'full_path': 'Database.%s' % ObjectId(),
+                                  'instance_data': {'charge_time': now, 'powerups': []}})
+        game['db_queue'] = [{'collect_id': unicode(ObjectId()), 'collect_dt': now,
+                             'profile_set': {'profiles_value': 10, 'tokens_map': {}}} for i in xrange(200)]
+        yield 'synthetic %s/%s (%d nodes)' % (version, lang, len(game['nodes'])), game
+
+def bench(name, game, number):
+    payload = {'jsonrpc': '2.0', 'id': 1, 'result': game}
+    old = bson_util_dumps(payload)
+    new = dumps(payload)
+    if json.loads(old) != json.loads(new):
+        raise AssertionError('%s: serializers differ' % name)
+    t_old = timeit.timeit(lambda: bson_util_dumps(payload), number=number) / number
+    t_new = timeit.timeit(lambda: dumps(payload), number=number) / number
+    print '%-45s %8d bytes  json_util %7.2fms  ddjson %7.2fms  x%.1f' % (
+        name, len(new), t_old*1000, t_new*1000, t_old/t_new)
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(usage='%prog [-n NUMBER] [-g GAMES] [INI]')
+    parser.add_option('-n', '--number', dest='number', type='int', default=20,
+                      help='encodings per payload')
+    parser.add_option('-g', '--games', dest='games', type='int', default=10,
+                      help='games to sample from mongodb')
+    options, args = parser.parse_args(argv[1:])
+    games = sample_games(args[0], options.games) if args else synthetic_games()
+    for name, game in games:
+        bench(name, game, options.number)
+
+if __name__ == '__main__':
+    main()
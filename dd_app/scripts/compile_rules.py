@@ -0,0 +1,29 @@
+"""Compiles ruleset json sources into binary ruleset artifacts
+
+Usage::
+
+    dd_compile_rules [-o OUTPATH] [RULEPATH] [NAME ...]
+
+``RULEPATH`` and ``NAME`` default to ``RULEPATH`` and ``RULESETS`` of
+:py:mod:`dd_app.rules.rulesets.settings`. Every ruleset is compiled into a
+language-neutral core artifact plus one text artifact per language.
+"""
+
+import optparse
+import sys
+
+from dd_app.rules.compiled import compile_ruleset
+from dd_app.rules.rulesets import settings
+
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(usage='%prog [-o OUTPATH] [RULEPATH] [NAME ...]')
+    parser.add_option('-o', '--outpath', dest='outpath', default=None,
+                      help='directory to write artifacts to, defaults to COMPILED_RULEPATH or RULEPATH')
+    options, args = parser.parse_args(argv[1:])
+    rulepath = args[0] if args else settings.RULEPATH
+    names = args[1:] or sorted(settings.RULESETS)
+    outpath = options.outpath or settings.COMPILED_RULEPATH or rulepath
+    for name in names:
+        for artifact, path in compile_ruleset(name, settings.RULESETS[name], rulepath, outpath):
+            print '%s -> %s' % (artifact, path)
@@ -0,0 +1,49 @@
+"""Creates or verifies the indexes declared in :py:mod:`dd_app.indexes`
+
+Usage::
+
+    dd_ensure_indexes [-c] INI
+
+Run at deploy time. Missing indexes of the game database and, if
+``mongodb_log.uri`` is configured, of the action log database are created in
+the background. With ``-c``, they are only reported and the exit status is 1
+if any are missing. Indexes that exist but aren't declared (e.g. of a former
+layout) are reported as unused, they are not dropped.
+"""
+
+import optparse
+import sys
+
+from dd_app.indexes import game_indexes, log_indexes, check
+
+
+def report(label, db, indexes, create):
+    missing, present, undeclared = check(db, indexes, create=create)
+    for index in present:
+        print '%s ok       %r' % (label, index)
+    for index in missing:
+        print '%s %s %r' % (label, 'created ' if create else 'missing ', index)
+    for collection, name in undeclared:
+        print '%s unused   %s %s' % (label, collection, name)
+    return missing
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(usage='%prog [-c] INI')
+    parser.add_option('-c', '--check', dest='check', action='store_true', default=False,
+                      help='only report missing indexes')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error('INI is required')
+    from pyramid.paster import bootstrap
+    settings = bootstrap(args[0])['registry'].settings
+    create = not options.check
+    indexes = game_indexes(settings['mongodb.users'],
+                           settings.get('mongodb.node_layout', 'array'),
+                           settings.get('mongodb.queue_layout', 'embedded'))
+    missing = report('game', settings['mongodb.connector'].get_db(), indexes, create)
+    if 'logdb.connector' in settings:
+        missing += report('log ', settings['logdb.connector'].get_db(), log_indexes(), create)
+    return 1 if missing and not create else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+"""Migrates game nodes to the ``map`` layout, see :py:mod:`dd_app.nodes`
+
+Usage::
+
+    dd_migrate_nodes [-c] [-l LIMIT] INI
+
+Set ``mongodb.node_layout = map`` on all servers of ``INI`` before, they
+read and write both layouts then and keep serving while games are converted.
+Every game is converted by one update, compare-and-swapped on ``nodes_lock``;
+games changed concurrently are read and converted again. With ``-c``, only
+the number of games per layout is printed.
+
+Once all games are converted, the ``nodes.*`` indexes of ``games`` can be
+dropped.
+"""
+
+import optparse
+import sys
+
+from dd_app.nodes import NodeStore, MAP
+
+RETRIES = 5
+
+
+def count(collection):
+    unconverted = collection.find({'node_map': {'$exists': False}}).count()
+    return collection.count() - unconverted, unconverted
+
+def migrate(collection, store, limit=0):
+    """Converts games still in the ``array`` layout
+
+    Returns the numbers of converted and failed games.
+    """
+    query = {'node_map': {'$exists': False}}
+    converted = failed = 0
+    ids = [game['_id'] for game in collection.find(query, {'_id': 1}, limit=limit)]
+    for game_id in ids:
+        for attempt in xrange(RETRIES):
+            game = collection.find_one(dict(query, _id=game_id), {'nodes': 1, 'nodes_lock': 1})
+            if game is None:
+                # deleted or converted meanwhile
+                break
+            if store.migrate(collection, game):
+                converted += 1
+                break
+        else:
+            failed += 1
+    return converted, failed
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(usage='%prog [-c] [-l LIMIT] INI')
+    parser.add_option('-c', '--count', dest='count', action='store_true', default=False,
+                      help='only count games per layout')
+    parser.add_option('-l', '--limit', dest='limit', type='int', default=0,
+                      help='convert at most LIMIT games')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error('INI is required')
+    from pyramid.paster import bootstrap
+    settings = bootstrap(args[0])['registry'].settings
+    collection = settings['mongodb.connector'].get_db()['games']
+    if not options.count:
+        if settings['mongodb.connector'].nodes.layout != MAP:
+            parser.error('set mongodb.node_layout = map on all servers first')
+        converted, failed = migrate(collection, NodeStore(MAP), options.limit)
+        print 'converted %d, failed %d' % (converted, failed)
+    mapped, unconverted = count(collection)
+    print 'map %d, array %d' % (mapped, unconverted)
+    return 1 if unconverted and not options.count and not options.limit else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,6 +2,7 @@ from pyramid_sockjs.session import Session
 
 from dd_app.base_handler import BaseHandler
 from dd_app.messaging.mixins import MsgMixin
+from dd_app.messaging.messenger import Messenger
 
 import logging
 import uuid
@@ -82,5 +83,7 @@ class DDSockJSSession(Session, MsgMixin):
                     #log.error(m.data.get('sender', False))
                     self.emit(m.action, m.data)
                     return self.close()
+            elif m.action in Messenger.SERVER_ACTIONS:
+                continue
             else:
                 self.emit(m.action, m.data)
@@ -1,3 +1,3 @@
 """Module handling async deferred tasks over a messaging middleware"""
 
-from dd_app.tasks.tasks import test, chargePerpReady, notifyLevelupItems, notifyBuyperpItems, logAction
+from dd_app.tasks.tasks import test, chargePerpReady, notifyLevelupItems, notifyBuyperpItems, logAction, logActions
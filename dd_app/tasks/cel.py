@@ -1,5 +1,5 @@
 from celery import Celery
-from celery.signals import worker_init
+from celery.signals import worker_init, worker_process_init
 
 from dd_app.tasks import celeryconfig
 
@@ -16,6 +16,20 @@ def bootstrap_pyramid(signal, sender):
         from raven.contrib.celery import register_signal
         register_signal(client)
 
+@worker_process_init.connect
+def start_rules_reloader(**kwargs):
+    # reloader threads don't survive forking the pool processes
+    reloader = getattr(celery, 'settings', {}).get('rules.reloader', None)
+    if reloader is not None:
+        reloader.start()
+
+@worker_process_init.connect
+def start_user_cache(**kwargs):
+    # same for the invalidation listener of the user cache
+    mongodb = getattr(celery, 'settings', {}).get('mongodb.connector', None)
+    if getattr(mongodb, 'user_cache', None) is not None:
+        mongodb.user_cache.start()
+
 
 celery = Celery()
 celery.config_from_object(celeryconfig)
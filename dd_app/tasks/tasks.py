@@ -3,6 +3,8 @@ from dd_app.messaging.mixins import MsgMixin
 
 from pyramid.threadlocal import get_current_registry
 
+from dd_app.indexes import LOG_ACTIONS
+
 class DDTask(celery.Task, MsgMixin):
     abstract = True
     ignore_result = True
@@ -52,14 +54,8 @@ class DDTask(celery.Task, MsgMixin):
         return query_base
 
     def _get_rules(self, version, lang='en'):
-        if getattr(self, '_dd_rules', {}).get(version, {}).get(lang, None) is None:
-            from dd_app.rules import RulesVersion
-            if getattr(self, '_dd_rules', None) is None:
-                self._dd_rules = {}
-                if self._dd_rules.get(version, None) is None:
-                    self._dd_rules[version] = {}
-            self._dd_rules[version].update({lang: RulesVersion(version=version, lang=lang)})
-        return self._dd_rules[version].get(lang)
+        from dd_app.rules.registry import get_rules_version
+        return get_rules_version(version, lang)
 
 
 @celery.task(base=DDTask)
@@ -70,16 +66,10 @@ def test(uid, x, y):
 @celery.task(base=DDTask)
 def chargePerpReady(user_oid, auth_uid, node, start, result):
     # FIXME check for redundancies w. json-rpc handlers
-    db = chargePerpReady.mongodb.get_db()
-    query_find = {'nodes_charging.path': node['full_path']}
-    query_find.update(chargePerpReady.game_base_query(auth_uid))
-    resp = db.games.update(query_find,
-                           {'$pull': {'nodes_charging': {'path': node['full_path']}},
-                            '$push': {'nodes_collect': {'path': node['full_path'], 'result': result}}},
-                           upsert=False,
-                           multi=False)
-    found = (resp.get('n', 0)>0)
-    if found:
+    query_base = chargePerpReady.game_base_query(auth_uid)
+    nodes_lock = chargePerpReady.mongodb.queues.charged(query_base, node['full_path'], result)
+    chargePerpReady.mongodb.invalidate_game(query_base, nodes_lock)
+    if nodes_lock is not None:
         chargePerpReady.dd_msg.node_ready(uid=auth_uid,
                                         node_type=node['game_type'],
                                         node_id=unicode(node['game_id']),
@@ -120,14 +110,8 @@ def logAction(uid=0, action=None, time=None, **kwargs):
         db = logAction.logdb.get_db()
     except KeyError:
         return 1
-    assert(action in ['newgame', 'loadgame', 'missiondone', 'levelup', 'charge', 'collect', 'integrate', 'buyperp', 'buypowerup', 'incident'])
+    assert(action in LOG_ACTIONS)
     collection = db[action]
-    collection.ensure_index('uid')
-    collection.ensure_index('time')
-    if action=='levelup':
-        collection.ensure_index('level')
-    if action=='missiondone':
-        collection.ensure_index('mission')
     doc = {'uid': uid,
            'time': time}
     optional_args = ['level', 'xp', 'lang', 'mission', 'active_missions', 'game_values', 'target', 'costs', 'gain', 'project', 'karma', 'origins', 'karmalizer']
@@ -137,3 +121,10 @@ def logAction(uid=0, action=None, time=None, **kwargs):
             doc[a] = val
     collection.save(doc)
     return 1
+
+@celery.task(base=DDTask)
+def logActions(actions):
+    """Logs several actions (keyword arguments of :py:func:`logAction`) at once"""
+    for kwargs in actions:
+        logAction(**kwargs)
+    return 1
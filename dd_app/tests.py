@@ -17,3 +17,924 @@ class ViewTests(unittest.TestCase):
         request = testing.DummyRequest()
         info = my_view(request)
         self.assertEqual(info['project'], 'dd_app')
+
+    def test_mutation_fields(self):
+        from .views import ApiHandler
+        from .connections import DDMongoConnector
+        self.config.registry.settings['mongodb.connector'] = DDMongoConnector('mongodb://localhost', 'dd_app', 'users')
+        handler = ApiHandler(testing.DummyRequest())
+        query_set = {'$inc': {'game_values.xp_value': 1, 'nodes_lock': 1},
+                     '$set': {'nodes.$.instance_data.tokens': [], 'game_values.ap_snapshot': 2}}
+        self.assertEqual(handler._mutation_fields(query_set), {'game_values': 1})
+        self.assertEqual(handler._mutation_fields(query_set, delta=True, node='Database.a'),
+                         {'game_values.xp_value': 1, 'game_values.ap_snapshot': 1, 'nodes.$': 1})
+        self.assertEqual(handler._mutation_fields(query_set, node='Database.a', nodes=True), {'game_values': 1, 'nodes': 1})
+
+    def test_get_games(self):
+        from bson.dbref import DBRef
+        from .connections import DDMongoConnector
+        queries = []
+        class Cursor(list):
+            def batch_size(self, size):
+                return self
+        class Collection(object):
+            def __init__(self, docs):
+                self.docs = docs
+            def find(self, query, fields=None):
+                queries.append(query)
+                return Cursor(dict(doc) for doc in self.docs)
+        games = [{'_id': i, 'user': DBRef('users', i % 2), 'nodes': []} for i in range(3)]
+        users = [{'_id': 0, 'display_name': 'a'}, {'_id': 1, 'display_name': 'b'}]
+        connector = DDMongoConnector('mongodb://localhost', 'dd_app', 'users')
+        connector._db = {'games': Collection(games), 'users': Collection(users)}
+        loaded = list(connector.get_games(oids=[0, 1], batch_size=2))
+        self.assertEqual([game['user']['display_name'] for game in loaded], ['a', 'b', 'a'])
+        self.assertEqual(queries, [{'user.$id': {'$in': [0, 1]}}, {'_id': {'$in': [0, 1]}}, {'_id': {'$in': [0]}}])
+
+
+class RulesIndexTests(unittest.TestCase):
+
+    def _make_index(self):
+        from collections import namedtuple
+        from dd_app.rules.index import RulesIndex
+        Ruleset = namedtuple('Ruleset', ['version', 'perps', 'tokens', 'powerups', 'missions', 'levels'])
+        perps = {
+            'contact001': {'game_type': 'ContactPerp', 'type_data': {'required_level': 2}},
+            'agent001': {'game_type': 'AgentPerp', 'type_data': {'provided_perps': ['contact001', 'client001', 'unknown001']}},
+            'project001': {'game_type': 'ProjectPerp', 'type_data': {'required_level': 3,
+                                                                     'provided_ads': [{'gestalt': 'ad001'},
+                                                                                      {'gestalt': 'ad002', 'required_level': 5}]}},
+            'client001': {'game_type': 'ClientPerp', 'type_data': {'required_level': 4,
+                                                                   'required_providers': ['contact001', 'project001']}},
+        }
+        powerups = {
+            'ad001': {'game_type': 'AdPowerup', 'type_data': {'required_level': 3}},
+            'ad002': {'game_type': 'AdPowerup', 'type_data': {'required_level': 1}},
+        }
+        missions = [
+            {'game_type': 'Mission', 'type_data': {'gestalt': 'mission001'}},
+            {'game_type': 'Mission', 'type_data': {'gestalt': 'mission002', 'required_mission': 'mission001'}},
+        ]
+        levels = [
+            {'number': 1, 'xp_min': 0, 'xp_max': 19, 'ap_max': 10, 'ap_inc_value': 1, 'ap_inc_interval': 5},
+        ]
+        return RulesIndex(Ruleset(version=1, perps=perps, tokens={}, powerups=powerups, missions=missions, levels=levels))
+
+    def test_perps(self):
+        index = self._make_index()
+        self.assertEqual(sorted(index.perps_by_type['ContactPerp']), ['contact001'])
+        self.assertEqual(index.levelup_perps_by_level[3], ['project001'])
+        self.assertNotIn('client001', index.levelup_notify_perps)
+        self.assertEqual(sorted(index.consumers_by_provider['project001']), ['client001'])
+
+    def test_project_powerups(self):
+        index = self._make_index()
+        table = index.project_powerups['project001']
+        self.assertEqual([p['game_gestalt'] for p in table.by_level[3]], ['ad001'])
+        self.assertEqual(table.by_level[5][0]['type_data'], {'gestalt': 'ad002', 'required_level': 5})
+        self.assertEqual(table.get_item('provided_ads', 'ad002'), {'gestalt': 'ad002', 'required_level': 5})
+        self.assertEqual(index.powerup_projects_by_level[5], set(['project001']))
+        self.assertRaises(TypeError, table.powerups[0]['type_data'].update, {'price': 0})
+        self.assertEqual(sorted(index.powerups_by_level[1]), ['ad002'])
+
+    def test_unknown_project(self):
+        from collections import namedtuple
+        from dd_app.rules.texts import LocalizedRuleset
+        index = self._make_index()
+        ruleset = LocalizedRuleset(None, 'en', namedtuple('Texts', [])(), index=index)
+        self.assertEqual(len(ruleset.project_powerups('project001').powerups), 2)
+        empty = ruleset.project_powerups('made-up')
+        self.assertEqual(empty.powerups, ())
+        self.assertTrue(ruleset.project_powerups(['unhashable']) is empty)
+        self.assertEqual(sorted(ruleset._project_powerups), [None, 'project001'])
+
+    def test_lazy_index(self):
+        from collections import namedtuple
+        from dd_app.rules.texts import LocalizedRuleset
+        built = []
+        def build_index():
+            built.append(self._make_index())
+            return built[-1]
+        ruleset = LocalizedRuleset(None, 'en', namedtuple('Texts', [])(), build_index=build_index)
+        self.assertEqual(built, [])
+        self.assertTrue(ruleset.index is built[0])
+        self.assertTrue(ruleset.index is built[0])
+        self.assertEqual(len(built), 1)
+
+    def test_missions(self):
+        index = self._make_index()
+        self.assertEqual(sorted(index.missions_by_required[0]), ['mission001'])
+        self.assertEqual(sorted(index.missions_by_required['mission001']), ['mission002'])
+
+    def test_perp_graph(self):
+        graph = self._make_index().perp_graph
+        self.assertEqual(graph.provided['agent001'], ('contact001', 'client001'))
+        self.assertEqual(graph.children['agent001'], ('contact001',))
+        self.assertFalse(graph.level_reached('contact001', 1))
+        self.assertTrue(graph.level_reached('contact001', 2))
+        self.assertEqual(graph.required_providers['client001'], frozenset(['contact001', 'project001']))
+
+
+class LevelTableTests(unittest.TestCase):
+
+    def _make_table(self):
+        from dd_app.rules.levels import LevelTable
+        levels = [
+            {'number': 2, 'xp_min': 20, 'xp_max': 41, 'ap_max': 11, 'ap_inc_value': 1, 'ap_inc_interval': 5},
+            {'number': 1, 'xp_min': 0, 'xp_max': 19, 'ap_max': 10, 'ap_inc_value': 1, 'ap_inc_interval': 5},
+            {'number': 3, 'xp_min': 42, 'xp_max': 99, 'ap_max': 12, 'ap_inc_value': 2, 'ap_inc_interval': 10},
+        ]
+        return LevelTable(levels)
+
+    def test_level_for_xp(self):
+        table = self._make_table()
+        self.assertEqual(table.level_for_xp(0)['number'], 1)
+        self.assertEqual(table.level_for_xp(19)['number'], 1)
+        self.assertEqual(table.level_for_xp(20)['number'], 2)
+        self.assertEqual(table.level_for_xp(99)['number'], 3)
+
+    def test_level_not_found(self):
+        from dd_app.rules.levels import LevelNotFound
+        table = self._make_table()
+        self.assertRaises(LevelNotFound, table.level_for_xp, 100)
+        self.assertRaises(LevelNotFound, table.level_for_xp, -1)
+
+    def test_level_jump(self):
+        table = self._make_table()
+        levelinfo, next_levelinfo = table.level_jump(10, 15)
+        self.assertTrue(levelinfo is next_levelinfo)
+        levelinfo, next_levelinfo = table.level_jump(10, 50)
+        self.assertEqual((levelinfo['number'], next_levelinfo['number']), (1, 3))
+
+    def test_batch(self):
+        table = self._make_table()
+        self.assertEqual(table.level_numbers([50, 0, 41, 20, 19]), [3, 1, 2, 2, 1])
+
+    def test_ap_state(self):
+        table = self._make_table()
+        self.assertEqual(table.ap_state(50, 0, 1000, 1035), (6, 1030))
+        self.assertEqual(table.ap_state(50, 5, 1000, 100000), (12, 100000))
+
+
+class CompiledRulesetTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+
+    def _write(self, filename, data):
+        import json, os
+        with open(os.path.join(self.path, filename), 'wb') as fp:
+            json.dump(data, fp)
+
+    def _ruleset(self, label):
+        return {'version': 1,
+                'perps': {u'agent001': {u'game_type': u'AgentPerp',
+                                        u'type_data': {u'label': label, u'required_level': 2}}},
+                'tokens': {}, 'powerups': {}, 'levels': [{u'number': 1}]}
+
+    def test_roundtrip(self):
+        from dd_app.rules.compiled import CompiledRuleset, compile_ruleset, current_artifact, texts_name
+        self._write('rules.en.json', self._ruleset(u'Agent'))
+        self._write('rules.de.json', self._ruleset(u'Agentin'))
+        self._write('default_game.json', {u'game_values': {}})
+        paths = dict(compile_ruleset('rules', ('en', 'de'), self.path))
+        self.assertEqual(current_artifact('rules', self.path), paths['rules'])
+        core = CompiledRuleset(paths['rules'])
+        self.assertEqual(core.perps, {u'agent001': {u'game_type': u'AgentPerp',
+                                                    u'type_data': {u'required_level': 2}}})
+        self.assertEqual(core.missions, [])
+        self.assertEqual(core.default_game, {u'game_values': {}})
+        self.assertRaises(AttributeError, getattr, core, 'foo')
+        texts = CompiledRuleset(current_artifact(texts_name('rules', 'de'), self.path))
+        self.assertEqual(texts.perps, {u'agent001': {u'label': u'Agentin'}})
+        # unchanged sources compile to the same artifacts
+        self.assertEqual(dict(compile_ruleset('rules', ('en', 'de'), self.path)), paths)
+
+    def test_mismatch(self):
+        from dd_app.rules.compiled import compile_ruleset
+        from dd_app.rules.texts import RulesetMismatch
+        other = self._ruleset(u'Agentin')
+        other['perps'][u'agent001'][u'type_data'][u'required_level'] = 3
+        self._write('rules.en.json', self._ruleset(u'Agent'))
+        self._write('rules.de.json', other)
+        self._write('default_game.json', {u'game_values': {}})
+        self.assertRaises(RulesetMismatch, compile_ruleset, 'rules', ('en', 'de'), self.path)
+
+
+class LocalizedRulesetTests(unittest.TestCase):
+
+    def test_localized(self):
+        from collections import namedtuple
+        from dd_app.rules.texts import LocalizedRuleset, split_texts
+        data = {'perps': {u'agent001': {u'type_data': {u'label': u'Agent', u'required_level': 2}}},
+                'missions': [{u'type_data': {u'gestalt': u'mission001', u'title': u'First'}}]}
+        core, texts = split_texts(data)
+        ruleset = LocalizedRuleset(namedtuple('Core', core.keys())(**core), 'en',
+                                   namedtuple('Texts', texts.keys())(**texts))
+        self.assertNotIn(u'label', ruleset.perps[u'agent001'][u'type_data'])
+        self.assertEqual(ruleset.localized('perps')[u'agent001'][u'type_data'],
+                         {u'label': u'Agent', u'required_level': 2})
+        self.assertEqual(ruleset.localized('missions')[0][u'type_data'][u'title'], u'First')
+
+
+class RulesRegistryTests(unittest.TestCase):
+
+    def test_shared_views(self):
+        from dd_app.rules import RulesNoVersion
+        from dd_app.rules.registry import RulesRegistry
+        from dd_app.rules.rulesets import get_state
+        registry = RulesRegistry()
+        version = get_state().rules['en'][0].version
+        view = registry.get(version, 'en')
+        self.assertIs(registry.get(version, 'en'), view)
+        self.assertIs(registry.get(version, 'xx'), view)
+        self.assertRaises(AttributeError, setattr, view, 'version', version + 1)
+        self.assertRaises(RulesNoVersion, registry.get, -1, 'en')
+
+
+class RulesReloaderTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from dd_app.rules import rulesets
+        self.path = tempfile.mkdtemp()
+        self.saved = dict((key, getattr(rulesets.settings, key)) for key in ('RULEPATH', 'COMPILED_RULEPATH', 'RULESETS'))
+        self.state = rulesets.get_state()
+        rulesets.settings.RULEPATH = rulesets.settings.COMPILED_RULEPATH = self.path
+        rulesets.settings.RULESETS = {'rules': ('en', )}
+
+    def tearDown(self):
+        import shutil
+        from dd_app.rules import rulesets
+        for key, value in self.saved.items():
+            setattr(rulesets.settings, key, value)
+        rulesets.set_state(self.state)
+        shutil.rmtree(self.path)
+
+    def _compile(self, required_level):
+        import json, os
+        from dd_app.rules.compiled import compile_ruleset
+        data = {'version': 1, 'tokens': {}, 'powerups': {}, 'levels': [{u'number': 1, u'xp_min': 0, u'xp_max': 10}],
+                'perps': {u'agent001': {u'game_type': u'AgentPerp', u'type_data': {u'required_level': required_level}}}}
+        for filename, content in (('rules.en.json', data), ('default_game.json', {})):
+            with open(os.path.join(self.path, filename), 'wb') as fp:
+                json.dump(content, fp)
+        compile_ruleset('rules', ('en', ), self.path)
+
+    def test_reload(self):
+        from dd_app.rules import rulesets
+        from dd_app.rules.registry import get_rules_version
+        from dd_app.rules.reload import RulesReloader
+        self._compile(2)
+        rulesets.set_state(rulesets.RulesState())
+        reloader = RulesReloader({}, 1)
+        old = get_rules_version(1, 'en')
+        self.assertFalse(reloader.check(broadcast=False))
+        self._compile(3)
+        self.assertTrue(reloader.check(broadcast=False))
+        new = get_rules_version(1, 'en')
+        self.assertEqual(new.rules.perps[u'agent001'][u'type_data'][u'required_level'], 3)
+        # holders of the old view keep the old rules
+        self.assertEqual(old.rules.perps[u'agent001'][u'type_data'][u'required_level'], 2)
+
+
+class ClientRulesTests(unittest.TestCase):
+
+    def test_content_addressed(self):
+        from pyramid.httpexceptions import HTTPNotFound
+        from pyramid.request import Request
+        from dd_app.rules.rulesets import get_state
+        from dd_app.views import RulesHandler
+        client_rules = get_state().rules['en'][0].client_rules()
+        request = Request.blank('/app/rules/%s.json' % client_rules.hash)
+        request.matchdict = {'hash': client_rules.hash}
+        response = RulesHandler(request).client_rules()
+        self.assertEqual(response.body, client_rules.body)
+        self.assertEqual(response.etag, client_rules.hash)
+        cached = Request.blank('/', headers={'If-None-Match': '"%s"' % client_rules.hash}).get_response(response)
+        self.assertEqual(cached.status_int, 304)
+        request.matchdict = {'hash': 'unknown'}
+        self.assertRaises(HTTPNotFound, RulesHandler(request).client_rules)
+
+
+class RenderTests(unittest.TestCase):
+
+    def test_raw_json(self):
+        import json
+        from dd_app.render import RawJSON, dumps
+        value = {'static': RawJSON.encode({'a': [1, 2]}), 'dynamic': [RawJSON('null'), u'__rawjson_0']}
+        self.assertEqual(json.loads(dumps(value)), {'static': {'a': [1, 2]}, 'dynamic': [None, u'__rawjson_0']})
+        self.assertRaises(TypeError, dumps, object())
+
+    def test_bson_compatible(self):
+        import datetime, decimal, json, pytz
+        from bson.dbref import DBRef
+        from bson.json_util import dumps as bson_dumps
+        from bson.objectid import ObjectId
+        from dd_app.render import dumps
+        dt = datetime.datetime(2013, 11, 5, 12, 30, 15, 123456, tzinfo=pytz.timezone('Europe/Vienna'))
+        value = {'_id': ObjectId(), 'user': DBRef('users', ObjectId()), 'dt': dt,
+                 'naive': dt.replace(tzinfo=None), 'nested': [{'set': set([1])}]}
+        self.assertEqual(json.loads(dumps(value)), json.loads(bson_dumps(value)))
+        self.assertEqual(json.loads(dumps({'price': decimal.Decimal('1.5')})), {'price': 1.5})
+
+    def test_iterdumps(self):
+        import json
+        from bson.objectid import ObjectId
+        from dd_app.render import RawJSON, StreamArray, dumps, iterdumps
+        nodes = [{'game_id': ObjectId(), 'label': u'N\xf6de %d' % i} for i in range(200)]
+        value = {'id': 1, 'result': {'nodes': nodes, 'rules': RawJSON.encode({'a': 1}), 'empty': []}}
+        streamed = dict(value, result=dict(value['result'], nodes=StreamArray(iter(nodes)), empty=StreamArray([])))
+        chunks = list(iterdumps(streamed, chunk_size=1024))
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(all(isinstance(chunk, str) for chunk in chunks))
+        self.assertEqual(json.loads(''.join(chunks)), json.loads(dumps(value)))
+
+
+class CompressionTests(unittest.TestCase):
+
+    def test_accepts_gzip(self):
+        from pyramid.request import Request
+        from dd_app.compression import accepts_gzip
+        for header, expected in ((None, False), ('gzip, deflate', True), ('deflate', False),
+                                 ('gzip;q=0, *', False), ('*;q=0.5', True), ('identity, x-gzip', True)):
+            request = Request.blank('/')
+            if header is not None:
+                request.headers['Accept-Encoding'] = header
+            self.assertEqual(accepts_gzip(request), expected, header)
+
+    def test_tween(self):
+        import gzip, json, StringIO
+        from pyramid.request import Request
+        from pyramid.response import Response
+        from dd_app.compression import compression_tween_factory
+        from dd_app.render import StreamArray, iterdumps
+        from dd_app.metrics import METRICS
+        body = json.dumps({'nodes': range(1000)})
+        registry = testing.setUp().registry
+        registry.settings = {'dd_app.compress_min_size': '100'}
+        responses = {'/small': lambda: Response('{}', content_type='application/json'),
+                     '/large': lambda: Response(body, content_type='application/json'),
+                     '/stream': lambda: Response(app_iter=iterdumps({'nodes': StreamArray(range(1000))}, chunk_size=100),
+                                                 content_type='application/json')}
+        tween = compression_tween_factory(lambda request: responses[request.path](), registry)
+        def get(path, accept='gzip'):
+            request = Request.blank(path)
+            request.headers['Accept-Encoding'] = accept
+            response = tween(request)
+            if response.content_encoding == 'gzip':
+                return response, gzip.GzipFile(fileobj=StringIO.StringIO(response.body)).read()
+            return response, response.body
+        METRICS.reset()
+        self.assertEqual(get('/small')[0].content_encoding, None)
+        self.assertEqual(get('/large', 'identity')[0].content_encoding, None)
+        for path in ('/large', '/stream'):
+            response, data = get(path)
+            self.assertEqual(response.content_encoding, 'gzip')
+            self.assertTrue('Accept-Encoding' in response.vary)
+            self.assertEqual(json.loads(data), json.loads(body))
+        self.assertEqual(METRICS.get('compression.dynamic.bytes_in'), len(body))
+        self.assertTrue(0 < METRICS.get('compression.stream.ratio') < 1)
+        testing.tearDown()
+
+
+class MetricsTests(unittest.TestCase):
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_allow(self):
+        from pyramid.httpexceptions import HTTPForbidden
+        from dd_app.views import MetricsHandler
+        testing.setUp(settings={'dd_app.metrics_allow': '10.0.0.1'})
+        request = testing.DummyRequest(remote_addr='10.0.0.1')
+        self.assertTrue('pid' in MetricsHandler(request).metrics())
+        request = testing.DummyRequest(remote_addr='127.0.0.1')
+        self.assertRaises(HTTPForbidden, MetricsHandler(request).metrics)
+
+class NodeStoreTests(unittest.TestCase):
+
+    def test_layouts(self):
+        from dd_app.nodes import NodeStore, ARRAY, MAP, to_map
+        nodes = [{'game_id': 'a', 'full_path': 'Database.a'},
+                 {'game_id': 'b', 'full_path': 'Database.a.b'},
+                 {'game_id': 'c', 'full_path': 'Database.c'}]
+        array_doc = {'nodes': nodes}
+        node_map, node_children = to_map(nodes)
+        self.assertEqual(node_children, {'Database': ['a', 'c'], 'a': ['b']})
+        map_doc = {'node_map': node_map, 'node_children': node_children}
+        store = NodeStore(MAP)
+        for doc in (array_doc, map_doc):
+            self.assertEqual(store.all(doc), nodes)
+            self.assertEqual(store.get(doc, 'Database.a.b'), nodes[1])
+            self.assertEqual(store.get(doc, 'Database.x'), None)
+            # a valid id under the wrong parent
+            self.assertEqual(store.get(doc, 'Database.c.b'), None)
+            self.assertEqual(store.children(doc, 'Database.a'), [nodes[1]])
+        self.assertEqual(store.fields('Database.a.b'), {'node_map.b': 1, 'nodes': 1})
+        self.assertEqual(store.match(MAP, 'Database.c.b'), {'node_map.b.full_path': 'Database.c.b'})
+        self.assertEqual(NodeStore(ARRAY).fields('Database.a.b'), {'nodes.$': 1})
+        self.assertEqual(store.field(MAP, 'Database.a.b', 'instance_data.x'), 'node_map.b.instance_data.x')
+        self.assertEqual(store.field(ARRAY, 'Database.a.b', 'instance_data.x'), 'nodes.$.instance_data.x')
+        new = {'game_id': 'd', 'full_path': 'Database.a.d'}
+        update = {'$push': {}}
+        store.add(MAP, update, new)
+        self.assertEqual(update, {'$set': {'node_map.d': new}, '$push': {'node_children.a': 'd'}})
+        update = {}
+        store.put(MAP, update, nodes + [new], [nodes[2], new], [new])
+        self.assertEqual(update, {'$set': {'node_map.c': nodes[2], 'node_map.d': new},
+                                  '$push': {'node_children.a': {'$each': ['d']}}})
+        update = {}
+        store.put(ARRAY, update, nodes, [nodes[2]])
+        self.assertEqual(update, {'$set': {'nodes': nodes}})
+        game = store.prepare({'nodes': list(nodes)})
+        self.assertEqual(sorted(game), ['node_children', 'node_map'])
+        self.assertEqual(store.export(game), {'nodes': nodes})
+
+
+class QueueStoreTests(unittest.TestCase):
+
+    class Collection(object):
+        """In-memory collection, for the queries of dd_app.queues"""
+
+        MISSING = object()
+
+        def __init__(self, unique=None):
+            self.docs = []
+            self.unique = unique
+
+        class Cursor(list):
+            def sort(self, key):
+                return sorted(self, key=lambda doc: doc[key])
+
+        def _match(self, doc, query):
+            for key, cond in query.iteritems():
+                value = doc.get(key, self.MISSING)
+                if isinstance(cond, dict) and cond and all(op.startswith('$') for op in cond):
+                    for op, arg in cond.iteritems():
+                        if op == '$exists' and (value is not self.MISSING) != arg:
+                            return False
+                        if op == '$ne' and value == arg:
+                            return False
+                        if op == '$in' and value not in arg:
+                            return False
+                elif value != cond and not (cond is None and value is self.MISSING):
+                    return False
+            return True
+
+        def _apply(self, doc, update, insert=False):
+            for key, value in update.get('$set', {}).iteritems():
+                doc[key] = value
+            if insert:
+                doc.update(update.get('$setOnInsert', {}))
+            for key in update.get('$unset', {}):
+                doc.pop(key, None)
+            for key, value in update.get('$inc', {}).iteritems():
+                doc[key] = doc.get(key, 0) + value
+            for key, cond in update.get('$pull', {}).iteritems():
+                doc[key] = [item for item in doc.get(key, []) if not self._match(item, cond)]
+
+        def _check_unique(self, doc):
+            from pymongo.errors import DuplicateKeyError
+            key = lambda d: tuple(d.get(k, None) for k in self.unique)
+            if self.unique and any(key(other) == key(doc) for other in self.docs if other is not doc):
+                raise DuplicateKeyError('duplicate')
+
+        def find(self, query, fields=None):
+            import copy
+            return self.Cursor(copy.deepcopy(doc) for doc in self.docs if self._match(doc, query))
+
+        def find_one(self, query, fields=None):
+            docs = self.find(query)
+            return docs[0] if docs else None
+
+        def find_and_modify(self, query, update, fields=None, upsert=False, new=False):
+            import copy
+            for doc in self.docs:
+                if self._match(doc, query):
+                    old = copy.deepcopy(doc)
+                    self._apply(doc, update)
+                    return copy.deepcopy(doc) if new else old
+            return None
+
+        def insert(self, doc, safe=False):
+            from bson.objectid import ObjectId
+            doc = dict(doc, _id=doc.get('_id', ObjectId()))
+            self._check_unique(doc)
+            self.docs.append(doc)
+            return doc['_id']
+
+        def update(self, query, update, upsert=False, multi=False, safe=False):
+            n = 0
+            for doc in self.docs:
+                if self._match(doc, query):
+                    self._apply(doc, update)
+                    n += 1
+                    if not multi:
+                        break
+            if n == 0 and upsert:
+                doc = dict((k, v) for k, v in query.iteritems() if not isinstance(v, dict))
+                self._apply(doc, update, insert=True)
+                self.insert(doc)
+                n = 1
+            return {'n': n}
+
+        def remove(self, query, safe=False):
+            self.docs = [doc for doc in self.docs if not self._match(doc, query)]
+
+    def _make_store(self, game):
+        from dd_app.queues import QueueStore, COLLECTION
+        games, queues = self.Collection(), self.Collection(unique=('game', 'slot'))
+        games.insert(game)
+        store = QueueStore(lambda: {'games': games, 'game_queues': queues}, COLLECTION)
+        return store, games, queues
+
+    def _mutate(self, games, txn, nodes_lock):
+        # the compare-and-swapped game update of a mutation
+        query_find, query_set = {'_id': 1, 'nodes_lock': nodes_lock}, {'$inc': {'nodes_lock': 1}}
+        if not txn.prepare(query_find, query_set):
+            return False
+        if games.update(query_find, query_set)['n'] == 0:
+            txn.abort()
+            return False
+        txn.commit()
+        return True
+
+    def test_collection_txn(self):
+        store, games, queues = self._make_store({'_id': 1, 'nodes_lock': 1, 'db_queue': [{'collect_id': 'c'}],
+                                                 'nodes_collect': [{'path': 'a', 'result': {'cash': 1}}]})
+        game = games.find_one({'_id': 1})
+        txn = store.begin(game)
+        # embedded queues are moved to the collection, advancing nodes_lock
+        self.assertEqual(games.find_one({'_id': 1})['db_queue'], [])
+        self.assertEqual((game['nodes_lock'], games.find_one({'_id': 1})['nodes_lock']), (2, 2))
+        self.assertEqual(store.items(1, 'db_queue'), [{'collect_id': 'c'}])
+        self.assertEqual(txn.peek('nodes_collect', 'a'), {'path': 'a', 'result': {'cash': 1}})
+        txn.take('nodes_collect', 'a')
+        txn.put('db_queue', {'collect_id': 'd'})
+        # a concurrent transaction can't take the tagged item
+        other = store.begin(game)
+        other.take('nodes_collect', 'a')
+        self.assertTrue(self._mutate(games, txn, 2))
+        self.assertFalse(self._mutate(games, other, 3))
+        self.assertEqual(store.items(1, 'nodes_collect'), [])
+        self.assertEqual(store.items(1, 'db_queue'), [{'collect_id': 'c'}, {'collect_id': 'd'}])
+        self.assertEqual(games.find_one({'_id': 1})['queue_txn'], txn.id)
+        # a node can't charge while collectable, nor be put twice
+        txn = store.begin(games.find_one({'_id': 1}))
+        txn.put('nodes_charging', {'path': 'b'})
+        txn.put('nodes_collect', {'path': 'b', 'result': {}})
+        self.assertFalse(self._mutate(games, txn, 3))
+        self.assertEqual(len(queues.docs), 2)
+        # aborted by a failed game update
+        txn = store.begin(games.find_one({'_id': 1}))
+        txn.take('db_queue', 'c')
+        self.assertFalse(self._mutate(games, txn, 2))
+        self.assertEqual(store.items(1, 'db_queue'), [{'collect_id': 'c'}, {'collect_id': 'd'}])
+        self.assertFalse(any('txn' in doc for doc in queues.docs))
+
+    def test_settle(self):
+        import datetime
+        from dd_app.queues import TXN_TIMEOUT
+        store, games, queues = self._make_store({'_id': 1, 'nodes_lock': 1, 'db_queue': [{'collect_id': 'c'}]})
+        def stall(txn):
+            # prepared, then stalled past TXN_TIMEOUT
+            txn.take('db_queue', 'c')
+            self.assertTrue(txn.prepare({}, {}))
+            for doc in queues.docs:
+                if 'txn_at' in doc:
+                    doc['txn_at'] -= datetime.timedelta(seconds=TXN_TIMEOUT + 1)
+        stalled = store.begin(games.find_one({'_id': 1}))
+        stall(stalled)
+        self.assertEqual(store.export(games.find_one({'_id': 1}))['db_queue'], [{'collect_id': 'c'}])
+        # aborted and fenced: its late game update doesn't match
+        self.assertEqual(games.find_one({'_id': 1})['nodes_lock'], 3)
+        self.assertEqual(games.update({'_id': 1, 'nodes_lock': 2}, {'$set': {'queue_txn': stalled.id}})['n'], 0)
+        # committed by its game update, before being noticed
+        committed = store.begin(games.find_one({'_id': 1}))
+        stall(committed)
+        games.update({'_id': 1}, {'$set': {'queue_txn': committed.id}})
+        store.settle(1, None)
+        self.assertEqual(store.items(1, 'db_queue'), [])
+        self.assertEqual(games.find_one({'_id': 1})['nodes_lock'], 3)
+
+    def test_charged(self):
+        store, games, queues = self._make_store({'_id': 1, 'nodes_lock': 1, 'nodes_charging': [{'path': 'a'}]})
+        # nodes_lock of the game, advanced by moving its queues
+        self.assertEqual(store.charged({'_id': 1}, 'a', {'cash': 1}), 2)
+        self.assertEqual(store.items(1, 'nodes_charging'), [])
+        self.assertEqual(store.items(1, 'nodes_collect'), [{'path': 'a', 'result': {'cash': 1}}])
+        self.assertEqual(store.charged({'_id': 1}, 'a', {'cash': 1}), None)
+
+    def test_adopt_stale(self):
+        store, games, queues = self._make_store({'_id': 1, 'db_queue': [{'collect_id': 'c'}]})
+        game = games.find_one({'_id': 1})
+        games.update({'_id': 1}, {'$inc': {'nodes_lock': 1}})
+        store.adopt(game)
+        # moved anyway, the stale game keeps its nodes_lock
+        self.assertEqual(games.find_one({'_id': 1}), {'_id': 1, 'db_queue': [], 'nodes_lock': 2})
+        self.assertEqual(game.get('nodes_lock', None), None)
+
+    def test_embedded(self):
+        from dd_app.queues import QueueStore, COLLECTION, slot
+        store = QueueStore(None)
+        self.assertEqual(store.find('db_queue', 'c'), {'db_queue.collect_id': 'c'})
+        self.assertEqual(store.fields('db_queue.$'), {'db_queue.$': 1})
+        self.assertEqual(QueueStore(None, COLLECTION).find('db_queue', 'c'), {})
+        self.assertEqual(slot('nodes_charging', 'a.b'), slot('nodes_collect', 'a.b'))
+        txn = store.begin({'_id': 1, 'nodes_collect': [{'path': 'a', 'result': {}}, {'path': 'b', 'result': {'cash': 1}}]})
+        self.assertEqual(txn.peek('nodes_collect', 'b'), {'path': 'b', 'result': {'cash': 1}})
+        self.assertEqual(txn.peek('nodes_collect', 'c'), None)
+        txn.take('nodes_collect', 'b')
+        txn.put('db_queue', {'collect_id': 'x'})
+        txn.put('db_queue', {'collect_id': 'y'})
+        txn.put('nodes_charging', {'path': 'c'})
+        query_find, query_set = {'nodes_lock': 1}, {'$push': {}}
+        self.assertTrue(txn.prepare(query_find, query_set))
+        self.assertEqual(query_find, {'nodes_lock': 1, 'nodes_charging.path': {'$nin': ['c']}, 'nodes_collect.path': {'$nin': ['c']}})
+        self.assertEqual(query_set, {'$pull': {'nodes_collect': {'path': 'b'}},
+                                     '$push': {'db_queue': {'$each': [{'collect_id': 'x'}, {'collect_id': 'y'}]},
+                                               'nodes_charging': {'$each': [{'path': 'c'}]}}})
+
+
+class IndexTests(unittest.TestCase):
+
+    def test_check(self):
+        from dd_app.indexes import Index, check
+        created = []
+        class Collection(object):
+            def __init__(self, info):
+                self.info = info
+            def index_information(self):
+                return self.info
+            def ensure_index(self, keys, **kwargs):
+                created.append((keys, kwargs))
+        class DB(dict):
+            def collection_names(self):
+                return self.keys()
+        db = DB(games=Collection({'_id_': {'key': [('_id', 1)]}, 'version_1': {'key': [('version', 1)]}}),
+                old=Collection({'_id_': {'key': [('_id', 1)]}, 'x_1': {'key': [('x', 1)]}}))
+        indexes = [Index('games', [('_id', 1)]), Index('games', [('user.$id', 1)]), Index('users', [('auth_uid', 1)], unique=True)]
+        missing, present, undeclared = check(db, indexes)
+        self.assertEqual((missing, present), (indexes[1:], indexes[:1]))
+        self.assertEqual(undeclared, [('games', 'version_1'), ('old', 'x_1')])
+        self.assertEqual(created, [])
+        db['users'] = Collection({})
+        check(db, indexes, create=True)
+        self.assertEqual(created, [([('user.$id', 1)], {'unique': False, 'background': True}),
+                                   ([('auth_uid', 1)], {'unique': True, 'background': True})])
+
+class MongoOptionsTests(unittest.TestCase):
+
+    def test_mongo_options(self):
+        from pymongo.read_preferences import ReadPreference
+        from dd_app.connections import mongo_options
+        settings = {'mongodb.max_pool_size': '20', 'mongodb.wait_queue_timeout_ms': '500',
+                    'mongodb.read_preference': 'primary', 'mongodb.read_preference.ranking': 'secondary_preferred',
+                    'mongodb_log.replica_set': 'log'}
+        self.assertEqual(mongo_options(settings),
+                         {'client_options': {'max_pool_size': 20, 'waitQueueTimeoutMS': 500,
+                                             'read_preference': ReadPreference.PRIMARY},
+                          'read_preferences': {'ranking': 'secondary_preferred'}})
+        self.assertEqual(mongo_options(settings, 'mongodb_log'),
+                         {'client_options': {'replicaSet': 'log'}, 'read_preferences': {}})
+
+class CacheTests(unittest.TestCase):
+
+    def test_ttl_cache(self):
+        from dd_app.cache import TTLCache
+        now = [0]
+        cache = TTLCache(2, 10, clock=lambda: now[0])
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        # b was least recently used
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        now[0] = 11
+        self.assertEqual(cache.get('a', 'expired'), 'expired')
+
+    def test_user_cache(self):
+        from dd_app.cache import UserCache
+        cache = UserCache(10, 60)
+        generation = cache.generation
+        cache.set('1', {'_id': 'oid1', 'display_name': 'a'}, generation)
+        user = cache.get('1')
+        user['display_name'] = 'b'
+        self.assertEqual(cache.get('1')['display_name'], 'a')
+        cache.invalidate(oid='oid1')
+        self.assertEqual(cache.get('1'), None)
+        # read before the invalidation
+        cache.set('1', {'_id': 'oid1'}, generation)
+        self.assertEqual(cache.get('1'), None)
+
+    def test_session_cache(self):
+        from dd_app.cache import SessionCache
+        class Codec(object):
+            decoded = 0
+            def decode(self, session_data):
+                self.decoded += 1
+                return {'_auth_user_id': session_data}, session_data
+        codec = Codec()
+        cache = SessionCache(10, cookie_ttl=60)
+        self.assertEqual(cache.decode(codec, 'raw'), ({'_auth_user_id': 'raw'}, 'raw'))
+        self.assertEqual(cache.decode(codec, 'raw'), ({'_auth_user_id': 'raw'}, 'raw'))
+        self.assertEqual(codec.decoded, 1)
+        cache.set_raw('key', 'raw')
+        self.assertEqual(cache.get_raw('key'), 'raw')
+        cache.invalidate('key')
+        self.assertEqual(cache.get_raw('key'), None)
+        cache.decode(codec, 'raw')
+        self.assertEqual(codec.decoded, 2)
+
+    def test_game_cache_order(self):
+        from dd_app.cache import GameCache
+        class Redis(object):
+            def __init__(self):
+                self.data = {}
+            def get(self, key):
+                return self.data.get(key, None)
+            def set(self, key, value, ex=None):
+                self.data[key] = value
+            def setex(self, key, ttl, value):
+                self.data[key] = value
+            def delete(self, key):
+                self.data.pop(key, None)
+            def multi(self):
+                pass
+            def transaction(self, func, *watches):
+                func(self)
+        redis = Redis()
+        class Connector(object):
+            def get(self):
+                return redis
+        cache = GameCache(10, 60, {'redis.connector': Connector()})
+        base = {'user.$id': 2, 'version': 3}
+        cache.put(base, {'_id': 1, 'nodes_lock': 1})
+        # a node is charged while a mutation is running
+        cache.invalidate(base, 3)
+        self.assertEqual(cache.get(base), None)
+        # the mutation finishes late with the game it wrote before
+        cache.put(base, {'_id': 1, 'nodes_lock': 2})
+        self.assertEqual(cache.get(base), None)
+        cache.put(base, {'_id': 1, 'nodes_lock': 3, 'x': 1}, replace=False)
+        self.assertEqual(cache.get(base), {'_id': 1, 'nodes_lock': 3, 'x': 1})
+        cache.put(base, {'_id': 1, 'nodes_lock': 3}, replace=False)
+        cache.put(base, {'_id': 1, 'nodes_lock': 2})
+        self.assertEqual(cache.get(base), {'_id': 1, 'nodes_lock': 3, 'x': 1})
+        cache.put(base, {'_id': 1, 'nodes_lock': 4})
+        self.assertEqual(cache.get(base), {'_id': 1, 'nodes_lock': 4})
+        cache.invalidate(base)
+        self.assertEqual(cache.get(base), None)
+
+class BatchTests(unittest.TestCase):
+
+    class Collection(object):
+
+        def __init__(self, game):
+            self.game = game
+            self.calls = []
+
+        def find_one(self, query, fields=None):
+            self.calls.append('find_one')
+            return self.game
+
+        def find_and_modify(self, query, update, upsert=False, new=False, fields=None):
+            self.calls.append('find_and_modify')
+            self.game = dict(self.game, nodes_lock=self.game['nodes_lock'] + 1)
+            return self.game
+
+        def update(self, query, update, **kwargs):
+            self.calls.append('update')
+            return {'n': 1}
+
+    def _make_context(self):
+        from dd_app.batch import GameContext
+        game = {'_id': 1, 'user': 2, 'version': 3, 'nodes_lock': 1, 'game_values': {'xp_value': 5, 'cash_value': 6},
+                'nodes': [{'full_path': 'a', 'gestalt': 'x'}, {'full_path': 'b', 'gestalt': 'y'}],
+                'db_queue': [{'collect_id': 'c'}]}
+        collection = self.Collection(game)
+        return collection, GameContext(collection, lambda: {'user.$id': 2, 'version': 3})
+
+    def test_game_context(self):
+        collection, context = self._make_context()
+        base = {'user.$id': 2, 'version': 3}
+        self.assertEqual(context.find_one(dict(base, **{'nodes.full_path': 'b'}), {'nodes.$': 1, 'nodes_lock': 1}),
+                         {'_id': 1, 'nodes': [{'full_path': 'b', 'gestalt': 'y'}], 'nodes_lock': 1})
+        self.assertEqual(context.find_one(dict(base, **{'db_queue.collect_id': 'x'}), {'db_queue.$': 1}), None)
+        node = context.find_one(dict(base, **{'nodes.full_path': 'a'}), {'nodes': 1})['nodes'][0]
+        node['gestalt'] = 'changed'
+        self.assertEqual(collection.calls, ['find_one'])
+        # unsupported queries go to the collection
+        context.find_one(dict(base, **{'nodes_collect.path': 'a'}), {'nodes.$': 1})
+        self.assertEqual(collection.calls, ['find_one', 'find_one'])
+        result = context.find_and_modify(query=base, update={}, new=True, fields={'game_values.xp_value': 1})
+        self.assertEqual(result, {'_id': 1, 'game_values': {'xp_value': 5}})
+        self.assertEqual(context.find_one(base, {'nodes_lock': 1, 'nodes': 1}),
+                         {'_id': 1, 'nodes_lock': 2, 'nodes': collection.game['nodes']})
+        self.assertEqual(collection.calls, ['find_one', 'find_one', 'find_and_modify'])
+
+    def test_game_cache(self):
+        from dd_app.batch import GameContext
+        collection = self._make_context()[0]
+        base = {'user.$id': 2, 'version': 3}
+        class Cache(object):
+            def __init__(self):
+                self.games = {}
+            def get(self, query_base):
+                return self.games.get(query_base['version'], None)
+            def put(self, query_base, game, replace=True):
+                if replace or query_base['version'] not in self.games:
+                    self.games[query_base['version']] = game
+            def invalidate(self, query_base):
+                self.games.pop(query_base['version'], None)
+        cache = Cache()
+        context = GameContext(collection, lambda: base, cache)
+        context.find_one(base, {'nodes_lock': 1})
+        self.assertEqual(cache.games[3]['nodes_lock'], 1)
+        context.find_and_modify(query=base, update={}, new=True, fields={'nodes_lock': 1})
+        self.assertEqual(cache.games[3]['nodes_lock'], 2)
+        # next call, loaded from the cache
+        context = GameContext(collection, lambda: base, cache)
+        self.assertEqual(context.find_one(base, {'nodes_lock': 1}), {'_id': 1, 'nodes_lock': 2})
+        self.assertEqual(collection.calls, ['find_one', 'find_and_modify'])
+        context.update(base, {})
+        self.assertEqual(cache.games, {})
+
+    def test_connector_game_cache(self):
+        from dd_app.cache import GameCache
+        from dd_app.connections import DDMongoConnector
+        from dd_app.queues import COLLECTION
+        cache = GameCache(10, 60, {})
+        connector = DDMongoConnector('mongodb://localhost', 'dd_app', 'users', queue_layout=COLLECTION, game_cache=cache)
+        self.assertTrue(connector.game_cache is cache)
+        self.assertTrue(cache.cacheable({'_id': 1, 'db_queue': []}))
+        self.assertFalse(cache.cacheable({'_id': 1, 'db_queue': [{'collect_id': 'c'}]}))
+
+    def test_run_batch(self):
+        from dd_app.batch import run_batch
+        collection, context = self._make_context()
+        class Handler(object):
+            BATCH_METHODS = ('add', 'fail')
+            game_query_base = {'user.$id': 2, 'version': 3}
+            class mongo(object):
+                game_cache = None
+                @staticmethod
+                def get_db():
+                    return {'games': collection}
+            def add(self, a, b=1):
+                return a + b
+            def fail(self):
+                raise ValueError()
+        handler = Handler()
+        responses = run_batch(handler, [{'jsonrpc': '2.0', 'id': 1, 'method': 'add', 'params': [1]},
+                                        {'jsonrpc': '2.0', 'id': 2, 'method': 'add', 'params': {'a': 1, 'b': 2}},
+                                        {'jsonrpc': '2.0', 'method': 'add', 'params': [1]},
+                                        {'jsonrpc': '2.0', 'id': 3, 'method': 'fail'},
+                                        {'jsonrpc': '2.0', 'id': 4, 'method': 'loadGame'},
+                                        {'jsonrpc': '2.0', 'id': 5, 'method': 'add', 'params': [1, 2, 3]},
+                                        'invalid'])
+        self.assertEqual([r.get('result', r.get('error', {}).get('code')) for r in responses],
+                         [2, 3, -32603, -32601, -32602, -32600])
+        self.assertEqual(run_batch(handler, [])['error']['code'], -32600)
+
+
+class ConcurrencyTests(unittest.TestCase):
+
+    def test_retry_on_conflict(self):
+        from dd_app.concurrency import WriteConflict, retry_on_conflict
+        from dd_app.metrics import METRICS
+        class Handler(object):
+            settings = {'dd_app.conflict_retries': '2', 'dd_app.conflict_backoff': '0'}
+            _batch_logs = None
+            def __init__(self, conflicts):
+                self.conflicts = conflicts
+                self.attempts = 0
+                self.logged = []
+            def _log_action(self, kwargs):
+                # like ApiHandler._log_action
+                if self._batch_logs is not None:
+                    self._batch_logs.append(kwargs)
+                else:
+                    self.logged.append(kwargs)
+            @retry_on_conflict
+            def mutate(self, token, value=1):
+                self.attempts += 1
+                self._log_action({'attempt': self.attempts})
+                if self.attempts <= self.conflicts:
+                    raise WriteConflict(4)
+                return {'value': value}
+        METRICS.reset()
+        handler = Handler(2)
+        self.assertEqual(handler.mutate('token', value=2), {'value': 2})
+        self.assertEqual((handler.attempts, handler.logged), (3, [{'attempt': 3}]))
+        handler = Handler(3)
+        self.assertEqual(handler.mutate('token'), {'error': 4})
+        self.assertEqual((handler.attempts, handler.logged), (3, []))
+        self.assertEqual((METRICS.get('rpc.mutate.conflicts'), METRICS.get('rpc.mutate.retries'),
+                          METRICS.get('rpc.mutate.conflict_failures')), (5, 4, 1))
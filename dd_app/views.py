@@ -2,15 +2,24 @@
 """
 
 from pyramid.view import view_config
-from pyramid.httpexceptions import HTTPForbidden
+from pyramid.httpexceptions import HTTPForbidden, HTTPNotFound
+from pyramid.response import Response
 
-from pyramid_rpc.jsonrpc import jsonrpc_method
+from pyramid_rpc.jsonrpc import jsonrpc_method, JsonRpcParseError
 from bson.objectid import ObjectId
 
 from dd_app.base_handler import BaseHandler, dd_protected
 from dd_app.chargecollect import CollectablePerp
 from dd_app.perps import PerpNode
 from dd_app.missions import MissionHandler
+from dd_app.rules.registry import get_rules_version
+from dd_app.rules.client import find_client_rules
+from dd_app.render import StreamArray
+from dd_app.jsonrpc import make_streaming_response
+from dd_app.compression import accepts_gzip, add_vary
+from dd_app.batch import run_batch
+from dd_app.concurrency import WriteConflict, retry_on_conflict
+from dd_app.metrics import METRICS
 
 import datetime, pytz, math, random
 
@@ -30,8 +39,78 @@ class FakeHandler(BaseHandler):
         """Uhm...?"""
         raise HTTPForbidden('my hovercraft is full of eels!')
 
+class RulesHandler(BaseHandler):
+
+    # content-addressed, never changes for a given url
+    CACHE_MAX_AGE = 365*24*3600
+
+    @view_config(route_name='rules')
+    def client_rules(self):
+        """Static rules data by content hash, as referenced by ``loadGame``
+
+        Unknown hashes (e.g. of rules replaced by a reload) are not found,
+        clients have to call ``loadGame`` again then. Clients accepting gzip
+        get the body compressed at ruleset load.
+        """
+        client_rules = find_client_rules(self.request.matchdict['hash'])
+        if client_rules is None:
+            raise HTTPNotFound()
+        if accepts_gzip(self.request):
+            response = Response(body=client_rules.gzipped, content_type='application/json', conditional_response=True)
+            response.content_encoding = 'gzip'
+            response.etag = '%s-gzip' % client_rules.hash
+        else:
+            response = Response(body=client_rules.body, content_type='application/json', conditional_response=True)
+            response.etag = client_rules.hash
+        add_vary(response)
+        response.cache_control = 'public, max-age=%d' % self.CACHE_MAX_AGE
+        return response
+
+class MetricsHandler(BaseHandler):
+    """Registered only with ``dd_app.metrics_enabled``, see :py:func:`dd_app.main`"""
+
+    DEFAULT_ALLOW = '127.0.0.1 ::1'
+
+    def metrics(self):
+        """Metrics of the serving process, see :py:mod:`dd_app.metrics`
+
+        Only clients listed in ``dd_app.metrics_allow`` are served.
+        """
+        allow = self.settings.get('dd_app.metrics_allow', self.DEFAULT_ALLOW).split()
+        if self.request.remote_addr not in allow:
+            raise HTTPForbidden()
+        return METRICS.snapshot()
+
+class BatchHandler(BaseHandler):
+
+    @view_config(route_name='api_batch', renderer='ddjson')
+    def batch(self):
+        """JSON-RPC 2.0 batch of ``api`` calls, see :py:mod:`dd_app.batch`"""
+        try:
+            calls = self.request.json_body
+        except ValueError:
+            return {'jsonrpc': '2.0', 'id': None, 'error': JsonRpcParseError().as_dict()}
+        responses = run_batch(ApiHandler(self.request), calls)
+        if not responses:
+            # notifications only
+            return Response(status=204)
+        return responses
+
 class ApiHandler(BaseHandler):
 
+    # methods allowed in batch requests, see dd_app.batch
+    BATCH_METHODS = ('setPerpCoordinates', 'integrateCollected', 'collectPerp', 'chargePerp',
+                     'buySlots', 'buyKarma', 'buyPerp', 'getProvidedPerps', 'sellPowerup',
+                     'buyPowerup', 'getPowerups', 'getTokens', 'ping')
+
+    _batch_logs = None
+
+    def _log_action(self, kwargs):
+        if self._batch_logs is not None:
+            self._batch_logs.append(kwargs)
+        else:
+            logAction.apply_async(kwargs=kwargs)
+
     def _mergeTokens(self, original, new, minus=False):
         new_tokens_dict = dict((t['gestalt'], t) for t in new)
         old_tokens_dict = dict((t['gestalt'], t) for t in original)
@@ -57,40 +136,36 @@ class ApiHandler(BaseHandler):
                         result.append(elem)
         return result
 
-    def _get_rules(self, version):
+    def _get_rules_version(self, version):
+        # pinned per request, a concurrent rules reload must not switch rules mid-request
         if getattr(self, '_dd_rules', {}).get(version, None) is None:
-            from dd_app.rules import RulesVersion
             if getattr(self, '_dd_rules', None) is None:
                 self._dd_rules = {}
-            self._dd_rules.update({version: RulesVersion(version=version, lang=self.session_language).rules})
-        return self._dd_rules.get(version)
+            self._dd_rules[version] = get_rules_version(version, self.session_language)
+        return self._dd_rules[version]
+
+    def _get_rules(self, version):
+        return self._get_rules_version(version).rules
+
+    def _get_level_table(self, version):
+        return self._get_rules_version(version).index.levels
 
     def _get_level_for_xp(self, xp_value, version):
-        rules = self._get_rules(version)
-        levels = [l for l in rules.levels if xp_value>=l['xp_min'] and xp_value<=l['xp_max']]
-        if len(levels) < 1:
-            raise Exception('No levels for xp_value %s' % xp_value)
-        return levels[0]
+        return self._get_level_table(version).level_for_xp(xp_value)
 
-    def get_typedata_by_path(self, path, db=None, include_nodes=False, extra_query={}):
+    def get_typedata_by_path(self, path, include_nodes=False, extra_query={}, extra_fields={}):
         query_base = self.game_query_base
-        if db is None:
-            db = self.mongo.get_db()
-        query_find = {'nodes.full_path': path}
+        query_find = self.mongo.nodes.find(path)
         query_find.update(query_base)
         query_find.update(extra_query)
-        if include_nodes:
-            db_result = db['games'].find_one(query_find, {'nodes': 1, 'version': 1, 'game_values': 1, 'nodes_lock': 1, 'mission_goals': 1, 'active_missions': 1})
-            if db_result is not None:
-                matched_nodes = [node for node in db_result['nodes'] if node['full_path']==path]
-                node = matched_nodes[0]
-                nodes = db_result['nodes']
-        else:
-            db_result = db['games'].find_one(query_find, {'nodes.$': 1, 'version': 1, 'game_values': 1, 'nodes_lock': 1, 'mission_goals': 1, 'active_missions': 1})
-            if db_result is not None:
-                nodes = []
-                node = db_result['nodes'][0]
+        fields = {'version': 1, 'game_values': 1, 'nodes_lock': 1, 'mission_goals': 1, 'active_missions': 1}
+        fields.update(self.mongo.nodes.fields(None if include_nodes else path))
+        fields.update(extra_fields)
+        db_result = self.games.find_one(query_find, fields)
         if db_result is not None:
+            node = self.mongo.nodes.get(db_result, path)
+            nodes = self.mongo.nodes.all(db_result) if include_nodes else []
+        if db_result is not None and node is not None:
             version = db_result['version']
             game_values = db_result['game_values']
             gestalt = node['full_type'].split(':')[-1]
@@ -126,15 +201,42 @@ class ApiHandler(BaseHandler):
                                                   },
                                            countdown=2)
 
+    def _mutation_fields(self, query_set, delta=False, node=None, nodes=False):
+        """Projection of the ``find_and_modify`` result of a mutation
+
+        :param query_set: the update, with ``delta`` only the game values it
+                          changes are returned
+        :param node: path of a node to return (the query has to match it),
+                     instead of no nodes
+        :param nodes: return all nodes, e.g. on levelup
+        """
+        if delta:
+            fields = dict((key, 1) for op in ('$set', '$inc') for key in query_set.get(op, {}) if key.startswith('game_values.'))
+        else:
+            fields = {'game_values': 1}
+        if nodes:
+            fields.update(self.mongo.nodes.fields())
+        elif node is not None:
+            fields.update(self.mongo.nodes.fields(node))
+        return fields
+
+    def _ap_guard(self, game_values):
+        """Query guarding an AP spending update
+
+        AP are checked in python against the snapshot read before, the
+        update only matches if that snapshot is still current. Plain
+        equality, so mongodb doesn't have to run javascript per document.
+        """
+        return {'game_values.ap_snapshot': game_values['ap_snapshot'],
+                'game_values.ap_update': game_values['ap_update']}
+
     def _handle_levelup(self, new_xp, old_xp, version):
-        levelinfo = self._get_level_for_xp(old_xp, version)
+        levelinfo, next_levelinfo = self._get_level_table(version).level_jump(old_xp, new_xp)
         levelup = False
         query_inc = {}
         query_set = {}
-        next_levelinfo = levelinfo
         if new_xp > levelinfo['xp_max']:
             levelup = True
-            next_levelinfo = self._get_level_for_xp(new_xp, version)
             query_inc['game_values.xp_level'] = next_levelinfo['number'] - levelinfo['number']
             query_set['game_values.ap_snapshot'] = next_levelinfo['ap_max']
             query_set['game_values.ap_update'] = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
@@ -186,17 +288,26 @@ class ApiHandler(BaseHandler):
     def resetGame(self, token):
         oid = self.userdata['_id']
         version = self.userdata.get('game_version', None)
-        return self.mongo.drop_game(oid, version=version)
+        result = self.mongo.drop_game(oid, version=version)
+        self.mongo.invalidate_user(self.auth_uid, oid)
+        return result
 
 
     @dd_protected
     @jsonrpc_method(endpoint='api')
-    def loadGame(self, token, extra_types=True):
+    def loadGame(self, token, extra_types=True, inline_rules=False, stream=False):
         """Fetch game data
 
         :param token: string containing token as acquired by
                       :py:func:`getToken`
         :type token: string
+        :param extra_types: include static rules reference (``rules_hash``
+                            and ``rules_url``)
+        :param inline_rules: additionally inline the static rules data
+                             (``type_registry``, ``levels``, ``karmalauters``,
+                             ``karmalizers``, ``missions``)
+        :param stream: stream the response body in chunks, ``nodes`` and
+                       ``db_queue`` are encoded node by node
         :returns: game data
         :rtype: json object
 
@@ -209,9 +320,9 @@ class ApiHandler(BaseHandler):
         """
         oid = self.userdata['_id']
         version = self.userdata.get('game_version', None)
-        game,created = self.mongo.get_game(oid, version=version)
+        game,created = self.mongo.get_game(oid, version=version, user=self.userdata)
         if created:
-            logAction.apply_async(kwargs={
+            self._log_action({
                 'action': 'newgame',
                 'uid': self.auth_uid,
                 'time': datetime.datetime.utcnow().replace(tzinfo=pytz.UTC),
@@ -223,26 +334,24 @@ class ApiHandler(BaseHandler):
         if version is None:
             version = game.get('version')
         rules = self._get_rules(version=version)
-        levelinfo = self._get_level_for_xp(game.get('game_values').get('xp_value'), version)
-        ap_initial, ap_up = helpers.calculateAP(game['game_values']['ap_snapshot'],
-                                                game['game_values']['ap_update'],
-                                                levelinfo)
+        now_ms = millis_since_epoch()
+        ap_initial, ap_up_ms = self._get_level_table(version).ap_state(game['game_values']['xp_value'],
+                                                                       game['game_values']['ap_snapshot'],
+                                                                       helpers.datetime_to_millis(game['game_values']['ap_update']),
+                                                                       now_ms)
         game['game_values']['ap_initial'] = ap_initial
-        ap_delta = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC) - ap_up
-        game['game_values']['ap_offset'] = int(ap_delta.total_seconds()*1000)
+        game['game_values']['ap_offset'] = now_ms - ap_up_ms
         if extra_types:
-            tr = {}
-            tr.update(rules.tokens)
-            tr.update(rules.perps)
-            game['type_registry'] = tr
-            game['levels'] = rules.levels
-            game['karmalauters'] = rules.karmalauters
-            game['karmalizers'] = rules.karmalizers
-            game['missions'] = rules.missions
+            # static rules are fetched (and cached) separately by hash
+            client_rules = rules.client_rules()
+            game['rules_hash'] = client_rules.hash
+            game['rules_url'] = self.request.route_path('rules', hash=client_rules.hash)
+            if inline_rules:
+                game.update(client_rules.fragments)
             game['is_new_game'] = created
 
         if not created:
-            logAction.apply_async(kwargs={
+            self._log_action({
                 'action': 'loadgame',
                 'uid': self.auth_uid,
                 'time': datetime.datetime.utcnow().replace(tzinfo=pytz.UTC),
@@ -250,10 +359,15 @@ class ApiHandler(BaseHandler):
                 'level': game['game_values'].get('xp_level', 0),
                 'xp': game['game_values'].get('xp_value', 0),
             })
+        if stream:
+            for key in ('nodes', 'db_queue'):
+                if key in game:
+                    game[key] = StreamArray(game[key])
+            return make_streaming_response(self.request, game)
         return game
 
     def _log_mission_complete(self, mission, game_values):
-        logAction.apply_async(kwargs={
+        self._log_action({
             'action': 'missiondone',
             'uid': self.auth_uid,
             'time': datetime.datetime.utcnow().replace(tzinfo=pytz.UTC),
@@ -263,7 +377,7 @@ class ApiHandler(BaseHandler):
         })
 
     def _log_levelup(self, active_missions, game_values):
-        logAction.apply_async(kwargs={
+        self._log_action({
             'action': 'levelup',
             'uid': self.auth_uid,
             'time': datetime.datetime.utcnow().replace(tzinfo=pytz.UTC),
@@ -275,6 +389,7 @@ class ApiHandler(BaseHandler):
 
     @dd_protected
     @jsonrpc_method(endpoint='api')
+    @retry_on_conflict
     def setPerpCoordinates(self, token, updates):
         """
         :param token: string containing token as acquired by
@@ -295,50 +410,81 @@ class ApiHandler(BaseHandler):
         .. todo:: Cleanup & organize
 
         """
+        BUBU = 1 # lock check failed
         query_base = self.game_query_base
-        db = self.mongo.get_db()
+        orig_data = self.games.find_one(query_base, {'nodes_lock': 1})
+        if orig_data is None:
+            return 0
+        nodes_lock = orig_data.get('nodes_lock', None)
         updated = 0
         for path, position in updates:
-            query_find = {}
-            query_set = {}
             x, y = (position.get('x', None), position.get('y', None))
             # TODO in eine query verpacken moeglich?
-            if (path is not None) and (x is not None or y is not None):
-                container = 'nodes'
-                query_find.update({'%s.full_path' % container: path})
+            if (path is None) or (x is None and y is None):
+                continue
+            # layout of the game is unknown, try the current one first
+            for layout in self.mongo.nodes.layouts:
+                query_find = self.mongo.nodes.match(layout, path)
                 query_find.update(query_base)
+                if nodes_lock is None:
+                    query_find.update({'nodes_lock': {'$exists': False}})
+                else:
+                    query_find.update({'nodes_lock': nodes_lock})
+                query_set = {}
                 if x is not None:
-                    query_set.update({'%s.$.instance_data.x' % container: int(x)})
+                    query_set.update({self.mongo.nodes.field(layout, path, 'instance_data.x'): int(x)})
                 if y is not None:
-                    query_set.update({'%s.$.instance_data.y' %container: int(y)})
-            resp = db['games'].update(query_find, {'$set': query_set}, safe=True, upsert=False, multi=False)
-            updated += resp.get('n', 0)
+                    query_set.update({self.mongo.nodes.field(layout, path, 'instance_data.y'): int(y)})
+                # advances nodes_lock, so games read before are stale
+                resp = self.games.find_and_modify(query=query_find,
+                                                  update={'$set': query_set, '$inc': {'nodes_lock': 1}},
+                                                  upsert=False,
+                                                  new=True,
+                                                  fields={'nodes_lock': 1})
+                if resp is not None:
+                    nodes_lock = resp['nodes_lock']
+                    updated += 1
+                    break
+            else:
+                # missing nodes are skipped, changed games retried
+                current = self.games.find_one(query_base, {'nodes_lock': 1})
+                if current is not None and current.get('nodes_lock', None) != nodes_lock:
+                    raise WriteConflict(BUBU)
         return updated
 
     @dd_protected
     @jsonrpc_method(endpoint='api')
-    def integrateCollected(self, token, collect_id):
+    @retry_on_conflict
+    def integrateCollected(self, token, collect_id, delta=False):
         """
         WIP
+
+        With ``delta``, only the modified token nodes and the changed game
+        values are returned.
         """
         NOT_IN_QUEUE = 0
         NOT_ENOUGH_AP = 1
         BUBU = 2 # lock or ap second-check failed, should not happen
-        now_ms = millis_since_epoch()
         xp_increment = 1
         ap_cost = 1
         # find: find game, read Token nodes, read profileset from queue, read version
         query_base = self.game_query_base
-        db = self.mongo.get_db()
-        query_find = {'db_queue.collect_id': collect_id}
+        db = self.mongo.get_db('missions')
+        query_find = self.mongo.queues.find('db_queue', collect_id)
         query_find.update(query_base)
-        orig_data = db['games'].find_one(query_find, {'nodes': 1, 'db_queue.$': 1, 'version': 1, 'nodes_lock': 1, 'game_values': 1, 'mission_goals': 1, 'active_missions': 1})
+        fields = {'version': 1, 'nodes_lock': 1, 'game_values': 1, 'mission_goals': 1, 'active_missions': 1}
+        fields.update(self.mongo.nodes.fields())
+        fields.update(self.mongo.queues.fields('db_queue.$'))
+        orig_data = self.games.find_one(query_find, fields)
         if orig_data is None:
             return {'error': NOT_IN_QUEUE}
+        queues = self.mongo.queues.begin(orig_data)
+        queue_data = queues.peek('db_queue', collect_id)
+        if queue_data is None:
+            return {'error': NOT_IN_QUEUE}
         # collect all tokes types, set amounts, merge
         game_values = orig_data['game_values']
-        queue_data = orig_data['db_queue'][0]
-        nodes = orig_data.get('nodes', [])
+        nodes = self.mongo.nodes.all(orig_data)
         version = orig_data.get('version', 1)
         rules = self._get_rules(version=version)
         levelinfo = self._get_level_for_xp(game_values['xp_value'], version)
@@ -374,6 +520,7 @@ class ApiHandler(BaseHandler):
         new_vals = dict((e['type'], e['amount']) for e in merged['mapping'])
         mh = MissionHandler(version,
                             self.session_language,
+                            rules=self._get_rules_version(version),
                             goal_data=orig_data.get('mission_goals', []),
                             active_missions=orig_data.get('active_missions', []),
                             game_nodes=nodes,
@@ -382,6 +529,7 @@ class ApiHandler(BaseHandler):
                             game_values=game_values)
         goals_met = False
         response_extra = {}
+        added = []
         for gestalt in [t for t in modified_tokens if t not in old_tokens]:
             if gestalt not in old_tokens:
                 elem = {}
@@ -393,25 +541,28 @@ class ApiHandler(BaseHandler):
                 elem['full_path'] = 'Database.%s' % elem_id
                 elem['instance_data'] = {}
                 nodes.append(elem)
+                added.append(elem)
+        changed = []
         for node in nodes:
             if node.get('gestalt', None) in modified_tokens:
                 mh.set_new_amount(int(merged.get('amount')))
                 goals_met = goals_met or mh.handle_integrateprofiles(node['gestalt'], new_vals[node['gestalt']])
                 node['instance_data'].update({'amount': new_vals[node['gestalt']]})
+                changed.append(node)
         rewards = mh.compute_rewards()
         # find_and_modify: find game w. correct version, if none -> abort, remove profileset from queue, write new node elements and update others
+        queues.take('db_queue', collect_id)
         query_set = {
-            '$pull': {'db_queue': {'collect_id': collect_id}},
             '$inc': {
                      'game_values.xp_value': xp_increment + rewards.get('xp_value', 0),
                      'game_values.cash_value': rewards.get('cash_value', 0),
                      'game_values.karma_value': min(rewards.get('karma_value', 0), 100-game_values['karma_value']),
                      'nodes_lock': 1,
                     },
-            '$set': {'nodes': nodes,
-                     'game_values.profiles_value': int(merged.get('amount'))},
+            '$set': {'game_values.profiles_value': int(merged.get('amount'))},
             '$push': {},
         }
+        self.mongo.nodes.put(self.mongo.nodes.layout_of(orig_data), query_set, nodes, changed, added)
         if goals_met:
             new_mission_data = {'mission_goals': mh.get_goals(),
                                 'active_missions': mh.active_missions}
@@ -424,7 +575,8 @@ class ApiHandler(BaseHandler):
             for m in mh.complete_missions:
                 self._log_mission_complete(m, game_values)
             if len(profile_sets)>0:
-                query_set['$push'].update({'db_queue': {'$each': profile_sets}})
+                for profile_set in profile_sets:
+                    queues.put('db_queue', profile_set)
         new_xp = game_values['xp_value'] + xp_increment + rewards.get('xp_value', 0)
         # levelup
         levelup, inc_update, set_update, next_levelinfo = self._handle_levelup(new_xp, game_values['xp_value'], version)
@@ -439,18 +591,20 @@ class ApiHandler(BaseHandler):
             query_find.update({'nodes_lock': {'$exists': False}})
         else:
             query_find.update({'nodes_lock': orig_data['nodes_lock']})
-        query_find.update({
-                             '$where': 'function() { return Math.min(this.game_values.ap_snapshot + (parseInt((%s-this.game_values.ap_update.getTime()) / %s)) * %s, %s) >= %s; }' % (now_ms, levelinfo['ap_inc_interval'], levelinfo['ap_inc_value'], levelinfo['ap_max'], ap_cost),
-                         })
-        resp = db['games'].find_and_modify(query=query_find,
-                                           update=query_set,
-                                           upsert=False,
-                                           new=True,
-                                           fields={'game_values': 1, 'nodes': 1})
+        query_find.update(self._ap_guard(game_values))
+        if not queues.prepare(query_find, query_set):
+            raise WriteConflict(BUBU)
+        resp = self.games.find_and_modify(query=query_find,
+                                          update=query_set,
+                                          upsert=False,
+                                          new=True,
+                                          fields=self._mutation_fields(query_set, delta))
         if resp is None:
-            return {'error': BUBU}
-        # return results
-        result_nodes = [n for n in resp['nodes'] if n.get('game_type', None)=='TokenPerp']
+            queues.abort()
+            raise WriteConflict(BUBU)
+        queues.commit()
+        # return results, nodes were written by us
+        result_nodes = [n for n in nodes if n.get('game_type', None)=='TokenPerp' and (not delta or n['gestalt'] in modified_tokens)]
         response = {'result': {'nodes': result_nodes,
                                'increment': int(merged.get('increment')),
                                'dup': int(merged.get('dup'))},
@@ -460,9 +614,9 @@ class ApiHandler(BaseHandler):
         if levelup:
             response.update({'levelup': levelup})
             response['game_values'].update({'ap_initial': next_levelinfo['ap_max']})
-            self._deferred_levelup(level=response['game_values']['xp_level'], version=version, nodes=resp['nodes'])
+            self._deferred_levelup(level=response['game_values']['xp_level'], version=version, nodes=nodes)
             self._log_levelup(orig_data.get('active_missions', []), game_values)
-        logAction.apply_async(kwargs={
+        self._log_action({
             'action': 'integrate',
             'uid': self.auth_uid,
             'time': datetime.datetime.utcnow().replace(tzinfo=pytz.UTC),
@@ -487,7 +641,7 @@ class ApiHandler(BaseHandler):
                 karma_choice = [k for k in rules.karmalizers if level>=k.get('type_data', {}).get('required_level', 0)]
                 if len(karma_choice)>0:
                     karmalizer = random.choice(karma_choice)
-                    logAction.apply_async(kwargs={
+                    self._log_action({
                         'action': 'incident',
                         'uid': self.auth_uid,
                         'time': datetime.datetime.utcnow().replace(tzinfo=pytz.UTC),
@@ -502,6 +656,7 @@ class ApiHandler(BaseHandler):
 
     @dd_protected
     @jsonrpc_method(endpoint='api')
+    @retry_on_conflict
     def collectPerp(self, token, path):
         """
         Proof-of-concept testing!!!
@@ -518,39 +673,41 @@ class ApiHandler(BaseHandler):
         NOT_COLLECTABLE = 1
         BUBU = 3
         query_base = self.game_query_base
-        db = self.mongo.get_db()
+        db = self.mongo.get_db('missions')
 
         def get_data(path, extra_query={}):
-            q_find = {'nodes.full_path': path}
+            q_find = self.mongo.nodes.find(path)
             q_find.update(query_base)
             q_find.update(extra_query)
-            db_result = db['games'].find_one(q_find, {'nodes.$': 1, 'version': 1, 'game_values': 1, 'nodes_collect': 1, 'nodes_lock': 1, 'mission_goals': 1, 'active_missions': 1})
-            if db_result is not None:
-                node = db_result['nodes'][0]
+            fields = {'version': 1, 'game_values': 1, 'nodes_lock': 1, 'mission_goals': 1, 'active_missions': 1}
+            fields.update(self.mongo.nodes.fields(path))
+            fields.update(self.mongo.queues.fields('nodes_collect'))
+            db_result = self.games.find_one(q_find, fields)
+            node = None if db_result is None else self.mongo.nodes.get(db_result, path)
+            if node is not None:
                 version = db_result['version']
                 game_values = db_result['game_values']
-                nodes_lock = db_result.get('nodes_lock', None)
                 gestalt = node['full_type'].split(':')[-1]
                 rules = self._get_rules(version=version)
-                collectables = db_result.get('nodes_collect', [])
-                result = [collect.get('result', None) for collect in collectables if collect.get('path')==path].pop()
+                queues = self.mongo.queues.begin(db_result)
+                # after begin(), moving queues advances nodes_lock
+                nodes_lock = db_result.get('nodes_lock', None)
+                collect = queues.peek('nodes_collect', path)
+                if collect is None:
+                    return None
+                result = collect.get('result', None)
                 try:
                     prp = rules.perps[gestalt]
                 except KeyError:
                     prp = rules.tokens[gestalt]
-                return prp['type_data'], node, game_values, rules, result, version, nodes_lock, db_result.get('mission_goals', []), db_result.get('active_missions', []), db_result['_id']
+                return prp['type_data'], node, game_values, rules, result, version, nodes_lock, db_result.get('mission_goals', []), db_result.get('active_missions', []), db_result['_id'], self.mongo.nodes.layout_of(db_result), queues
             return None
 
-        now_ms = millis_since_epoch()
-        extra_query_find = {
-            'nodes_collect.path': path,
-            'nodes_charging.path': {'$ne': path}
-        }
-        old_game_data = get_data(path, extra_query=extra_query_find)
+        old_game_data = get_data(path, extra_query=self.mongo.queues.find('nodes_collect', path))
         if old_game_data is None:
             # Nothing to collect
             return {'error': NOT_COLLECTABLE}
-        node_type_data, node_data, old_game_values, rules, result, version, nodes_lock, mission_goals, active_missions, game_id = old_game_data
+        node_type_data, node_data, old_game_values, rules, result, version, nodes_lock, mission_goals, active_missions, game_id, layout, queues = old_game_data
         levelinfo = self._get_level_for_xp(old_game_values['xp_value'], version)
         ap_base_dt = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
         ap_current, ap_up = helpers.calculateAP(old_game_values['ap_snapshot'],
@@ -567,8 +724,8 @@ class ApiHandler(BaseHandler):
         collectable_tokenamount = result.get('collect_tokenamount', None)
         collect_risk = result.get('collect_risk', 0)
         old_karma = old_game_values['karma_value']
+        queues.take('nodes_collect', path)
         query_set = {
-            '$pull': {'nodes_collect': {'path': path}},
             '$inc': {
                      'game_values.xp_value': xp_increment,
                      'nodes_lock': 1,
@@ -580,9 +737,11 @@ class ApiHandler(BaseHandler):
         response_extra = {}
         mh = MissionHandler(version,
                             self.session_language,
+                            rules=self._get_rules_version(version),
                             goal_data=mission_goals,
                             active_missions=active_missions,
                             db=db,
+                            node_store=self.mongo.nodes,
                             game_id=game_id,
                             game_values=old_game_values)
         goals_met = False
@@ -596,7 +755,7 @@ class ApiHandler(BaseHandler):
                         'profile_set': result,
                         'collect_dt': datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)}
 
-            query_set.update({'$push': {'db_queue': queue_ps}})
+            queues.put('db_queue', queue_ps)
             resp_result = queue_ps
             goals_met = goals_met or mh.handle_collectamount(node_data['full_type'].split(':')[-1], result['profiles_value'], 'collect_profiles')
             #goals_met = goals_met or mh.handle_integrateprofiles(node_data['full_type'].split(':')[-1], node_data.get('instance_data', {}).get('amount', 0))
@@ -616,7 +775,7 @@ class ApiHandler(BaseHandler):
             increment_corrected = increment/correction_factor
             if tofull<increment_corrected:
                 increment_corrected = tofull
-            query_set['$inc']['nodes.$.instance_data.amount'] = increment_corrected
+            query_set['$inc'][self.mongo.nodes.field(layout, path, 'instance_data.amount')] = increment_corrected
             #query_set['$set']['nodes.$.instance_data.amount'] = node_data.get('instance_data', {}).get('amount', 0) + increment_corrected
             resp_result = {'token_upgraded_amount': node_data.get('instance_data', {}).get('amount', 0) + increment_corrected}
             goals_met = goals_met or mh.handle_upgradetoken(node_data['full_type'].split(':')[-1])
@@ -627,7 +786,8 @@ class ApiHandler(BaseHandler):
                                 'active_missions': mh.active_missions}
             profile_sets = rewards.get('profile_sets', [])
             if len(profile_sets)>0:
-                query_set['$push'].update({'db_queue': {'$each': profile_sets}})
+                for profile_set in profile_sets:
+                    queues.put('db_queue', profile_set)
             query_set['$set'].update(new_mission_data)
             if collectable_cash is None:
                 cash_i = rewards.get('cash_value', 0)
@@ -674,31 +834,33 @@ class ApiHandler(BaseHandler):
         if not levelup:
             query_set['$set']['game_values.ap_snapshot'] = ap_current-ap_cost
             query_set['$set']['game_values.ap_update'] = ap_up
-        query_find = {'nodes.full_path': path}
+        query_find = self.mongo.nodes.match(layout, path)
         query_find.update(query_base)
         if nodes_lock is None:
             query_find.update({'nodes_lock': {'$exists': False}})
         else:
             query_find.update({'nodes_lock': nodes_lock})
-        query_find.update({
-                             '$where': 'function() { return Math.min(this.game_values.ap_snapshot + (parseInt((%s-this.game_values.ap_update.getTime()) / %s)) * %s, %s) >= %s; }' % (now_ms, levelinfo['ap_inc_interval'], levelinfo['ap_inc_value'], levelinfo['ap_max'], node_type_data.get('collect_AP_cost', 1)),
-                         })
-        resp = db['games'].find_and_modify(query=query_find,
-                                           update=query_set,
-                                           upsert=False,
-                                           new=True,
-                                           fields={'game_values': 1, 'nodes': 1})
+        query_find.update(self._ap_guard(old_game_values))
+        if not queues.prepare(query_find, query_set):
+            raise WriteConflict(BUBU)
+        resp = self.games.find_and_modify(query=query_find,
+                                          update=query_set,
+                                          upsert=False,
+                                          new=True,
+                                          fields=self._mutation_fields(query_set, nodes=levelup))
         if resp is None:
-            return {'error': BUBU}
+            queues.abort()
+            raise WriteConflict(BUBU)
+        queues.commit()
         response.update({'result': resp_result, 'game_values': resp['game_values']})
         response['game_values'].update({'ap_increment': -ap_cost})
         response.update(response_extra)
         if levelup:
             response.update({'levelup': levelup})
             response['game_values'].update({'ap_initial': next_levelinfo['ap_max']})
-            self._deferred_levelup(level=response['game_values']['xp_level'], version=version, nodes=resp['nodes'])
+            self._deferred_levelup(level=response['game_values']['xp_level'], version=version, nodes=self.mongo.nodes.all(resp))
             self._log_levelup(active_missions, old_game_values) # WARNING! no node data provided. gotta live with it
-        logAction.apply_async(kwargs={
+        self._log_action({
             'action': 'collect',
             'uid': self.auth_uid,
             'time': datetime.datetime.utcnow().replace(tzinfo=pytz.UTC),
@@ -711,6 +873,7 @@ class ApiHandler(BaseHandler):
 
     @dd_protected
     @jsonrpc_method(endpoint='api')
+    @retry_on_conflict
     def chargePerp(self, token, path):
         """
         Proof-of-concept testing!!!
@@ -725,12 +888,19 @@ class ApiHandler(BaseHandler):
 
         .. todo:: UPDATE DOCUMENTATION!
         """
+        ALREADY_CHARGING = 1
+        NOT_ENOUGH_CASH = 1
         NOT_ENOUGH_AP = 2
+        BUBU = 1 # lock or ap second-check failed
         xp_increment = 1
         query_base = self.game_query_base
-        db = self.mongo.get_db()
+        db = self.mongo.get_db('missions')
         # we need all nodes to get db values for client charge/collect cycle
-        node_type_data, node_data, old_game_values, rules, nodes, version, db_result = self.get_typedata_by_path(path, include_nodes=True)
+        node_type_data, node_data, old_game_values, rules, nodes, version, db_result = self.get_typedata_by_path(path, include_nodes=True,
+                                                                                                               extra_fields=self.mongo.queues.fields('nodes_charging', 'nodes_collect'))
+        queues = self.mongo.queues.begin(db_result)
+        if queues.peek('nodes_charging', path) is not None or queues.peek('nodes_collect', path) is not None:
+            return {'error': ALREADY_CHARGING}
         # kosten ermitteln
         cperp = CollectablePerp(node_type_data, node_data, rules, old_game_values, nodes=nodes)
         charge_result, charge_cost = cperp.getPerpChargeData()
@@ -739,12 +909,11 @@ class ApiHandler(BaseHandler):
         # check if we are allowed to charge
         cost_cash = charge_cost.get('cash', 0)
         cost_ap = charge_cost.get('ap', 0)
-        query_find = {'nodes.full_path': path,
-                      'nodes_charging.path': {'$nin': [path]},
-                      'nodes_collect.path': {'$nin': [path]},
-                     }
-        now_ms = millis_since_epoch()
+        layout = self.mongo.nodes.layout_of(db_result)
+        query_find = self.mongo.nodes.match(layout, path)
         if cost_cash>0:
+            if old_game_values.get('cash_value', 0) < cost_cash:
+                return {'error': NOT_ENOUGH_CASH}
             query_find.update({'game_values.cash_value': {'$gte': cost_cash}})
         if cost_ap>0:
             ap_base_dt = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
@@ -757,6 +926,7 @@ class ApiHandler(BaseHandler):
         query_find.update(query_base)
         mh = MissionHandler(version,
                             self.session_language,
+                            rules=self._get_rules_version(version),
                             goal_data=db_result.get('mission_goals', []),
                             active_missions=db_result.get('active_missions', []),
                             game_nodes=nodes,
@@ -771,8 +941,8 @@ class ApiHandler(BaseHandler):
         dt_base = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
         duration = node_type_data['charge_time']/self.debug_charge_accel
         eta = dt_base + datetime.timedelta(milliseconds=duration)
-        query_set = {'$set': {'nodes.$.instance_data.charge_start': dt_base},
-                     '$addToSet': {'nodes_charging': {'path': path, 'result': charge_result, 'charge_start': dt_base, 'charge_end': eta}},
+        queues.put('nodes_charging', {'path': path, 'result': charge_result, 'charge_start': dt_base, 'charge_end': eta})
+        query_set = {'$set': {self.mongo.nodes.field(layout, path, 'instance_data.charge_start'): dt_base},
                      '$inc': {'game_values.xp_value': xp_increment + rewards.get('xp_value', 0),
                               'nodes_lock': 1},
                      '$push': {},
@@ -789,7 +959,8 @@ class ApiHandler(BaseHandler):
                 self._log_mission_complete(m, old_game_values)
             profile_sets = rewards.get('profile_sets', [])
             if len(profile_sets)>0:
-                query_set['$push'].update({'db_queue': {'$each': profile_sets}})
+                for profile_set in profile_sets:
+                    queues.put('db_queue', profile_set)
             query_set['$inc']['game_values.cash_value'] = rewards.get('cash_value', 0)
 
         upgrade_data = charge_result.get('last_upgrade_data', None)
@@ -798,14 +969,12 @@ class ApiHandler(BaseHandler):
         else:
             query_find.update({'nodes_lock': db_result['nodes_lock']})
         if upgrade_data is not None:
-            query_set['$set']['nodes.$.instance_data.last_upgrade_values'] = upgrade_data
+            query_set['$set'][self.mongo.nodes.field(layout, path, 'instance_data.last_upgrade_values')] = upgrade_data
         if cost_cash>0:
             query_set['$inc'].update({'game_values.cash_value': -cost_cash + rewards.get('cash_value', 0)})
             query_set['$inc'].update({'game_values.cash_spent': cost_cash})
         if cost_ap>0:
-            query_find.update({
-                             '$where': 'function() { return Math.min(this.game_values.ap_snapshot + (parseInt((%s-this.game_values.ap_update.getTime()) / %s)) * %s, %s) >= %s; }' % (now_ms, levelinfo['ap_inc_interval'], levelinfo['ap_inc_value'], levelinfo['ap_max'], cost_ap),
-                             })
+            query_find.update(self._ap_guard(old_game_values))
             query_set['$set']['game_values.ap_snapshot'] = ap_current-cost_ap
             query_set['$set']['game_values.ap_update'] = ap_up
         levelup = False
@@ -817,47 +986,53 @@ class ApiHandler(BaseHandler):
         if levelup:
             response_extra['levelup'] = True
         # TODO aufpassen! find_and_modify query muss sharding key enthalten!!!
-        resp = db['games'].find_and_modify(query=query_find,
-                                           update=query_set,
-                                           upsert=False,
-                                           fields={'game_values': 1},
-                                           new=True)
-        updated = (resp is not None)
+        if not queues.prepare(query_find, query_set):
+            # started charging meanwhile
+            return {'error': ALREADY_CHARGING}
+        resp = self.games.find_and_modify(query=query_find,
+                                          update=query_set,
+                                          upsert=False,
+                                          fields={'game_values': 1},
+                                          new=True)
+        if resp is None:
+            # the game changed since it was read
+            queues.abort()
+            raise WriteConflict(BUBU)
+        queues.commit()
         response = {}
-        if updated:
-            if levelup:
-                self._deferred_levelup(level=resp['game_values']['xp_level'], version=version, nodes=nodes)
-                self._log_levelup(db_result.get('active_missions', []), old_game_values)
-            from dd_app.tasks import chargePerpReady
-            chargePerpReady.apply_async(kwargs={
-                                                   'user_oid': self.userdata['_id'],
-                                                   'auth_uid': self.auth_uid,
-                                                   'node': node_data, # safe to pass outdated data
-                                                   'start': dt_base,
-                                                   'result': charge_result,
-                                                  },
-                                           eta=eta)
-            response.update(resp)
-            del response['_id']
-            response['duration'] = duration
-            if cost_ap>0:
-                response['game_values'].update({'ap_increment': -cost_ap})
-            response.update(response_extra)
-            logAction.apply_async(kwargs={
-                'action': 'charge',
-                'uid': self.auth_uid,
-                'time': datetime.datetime.utcnow().replace(tzinfo=pytz.UTC),
-                'target': node_data['full_type'].split(':')[-1],
-                'level': old_game_values['xp_level'],
-                'xp': old_game_values['xp_value'],
-                'costs': charge_cost,
-            })
-            return response
-        return {'error': 1}
+        if levelup:
+            self._deferred_levelup(level=resp['game_values']['xp_level'], version=version, nodes=nodes)
+            self._log_levelup(db_result.get('active_missions', []), old_game_values)
+        from dd_app.tasks import chargePerpReady
+        chargePerpReady.apply_async(kwargs={
+                                               'user_oid': self.userdata['_id'],
+                                               'auth_uid': self.auth_uid,
+                                               'node': node_data, # safe to pass outdated data
+                                               'start': dt_base,
+                                               'result': charge_result,
+                                              },
+                                       eta=eta)
+        response.update(resp)
+        del response['_id']
+        response['duration'] = duration
+        if cost_ap>0:
+            response['game_values'].update({'ap_increment': -cost_ap})
+        response.update(response_extra)
+        self._log_action({
+            'action': 'charge',
+            'uid': self.auth_uid,
+            'time': datetime.datetime.utcnow().replace(tzinfo=pytz.UTC),
+            'target': node_data['full_type'].split(':')[-1],
+            'level': old_game_values['xp_level'],
+            'xp': old_game_values['xp_value'],
+            'costs': charge_cost,
+        })
+        return response
 
     @dd_protected
     @jsonrpc_method(endpoint='api')
-    def buySlots(self, token, perp_full_path, slot_type, slots):
+    @retry_on_conflict
+    def buySlots(self, token, perp_full_path, slot_type, slots, delta=False):
         NOT_FOUND = 0
         INVALID_SLOT_TYPE = 1
         SLOTS_OVER_MAX = 2
@@ -869,15 +1044,17 @@ class ApiHandler(BaseHandler):
         if slot_type not in self.powerup_types:
             return {'error': INVALID_SLOT_TYPE}
         query_base = self.game_query_base
-        db = self.mongo.get_db()
-        query_find = {'nodes.full_path': perp_full_path}
+        query_find = self.mongo.nodes.find(perp_full_path)
         query_find.update(query_base)
-        orig_data = db['games'].find_one(query_find, {'nodes.$': 1, 'version': 1, 'nodes_lock': 1, 'game_values': 1, 'active_missions': 1})
-        if orig_data is None:
+        fields = {'version': 1, 'nodes_lock': 1, 'game_values': 1, 'active_missions': 1}
+        fields.update(self.mongo.nodes.fields(perp_full_path))
+        orig_data = self.games.find_one(query_find, fields)
+        node_data = None if orig_data is None else self.mongo.nodes.get(orig_data, perp_full_path)
+        if node_data is None:
             return {'error': NOT_FOUND}
+        layout = self.mongo.nodes.layout_of(orig_data)
         game_values = orig_data['game_values']
         active_missions = orig_data.get('active_missions', [])
-        node_data = orig_data['nodes'][0]
         version = orig_data.get('version', 1)
         rules = self._get_rules(version=version)
         perp_gestalt = node_data['full_type'].split(':')[-1]
@@ -894,7 +1071,7 @@ class ApiHandler(BaseHandler):
             return {'error': NOT_ENOUGH_CASH}
         query_set = {
             '$set': {
-                        'nodes.$.instance_data.%s' % slots_key: current_slots + slots,
+                        self.mongo.nodes.field(layout, perp_full_path, 'instance_data.%s' % slots_key): current_slots + slots,
                     },
             '$inc': {
                         'game_values.xp_value': xp_increment,
@@ -910,32 +1087,33 @@ class ApiHandler(BaseHandler):
         query_set['$inc'].update(inc_update)
         query_set['$set'].update(set_update)
 
-        query_find = {'nodes.full_path': perp_full_path,
-                      'game_values.cash_value': {'$gte': price}}
+        query_find = self.mongo.nodes.match(layout, perp_full_path)
+        query_find.update({'game_values.cash_value': {'$gte': price}})
         query_find.update(query_base)
         if orig_data.get('nodes_lock', None) is None:
             query_find.update({'nodes_lock': {'$exists': False}})
         else:
             query_find.update({'nodes_lock': orig_data['nodes_lock']})
-        resp = db['games'].find_and_modify(query=query_find,
-                                           update=query_set,
-                                           upsert=False,
-                                           new=True,
-                                           fields={'game_values': 1, 'nodes': 1})
+        resp = self.games.find_and_modify(query=query_find,
+                                          update=query_set,
+                                          upsert=False,
+                                          new=True,
+                                          fields=self._mutation_fields(query_set, delta, nodes=levelup))
         if resp is None:
-            return {'error': BUBU}
+            raise WriteConflict(BUBU)
         node_data['instance_data'].update({slots_key: current_slots + slots})
         response = {'node': node_data,
                     'game_values': resp['game_values']}
         if levelup:
             response.update({'levelup': levelup})
             response['game_values'].update({'ap_initial': next_levelinfo['ap_max']})
-            self._deferred_levelup(level=response['game_values']['xp_level'], version=version, nodes=resp['nodes'])
+            self._deferred_levelup(level=response['game_values']['xp_level'], version=version, nodes=self.mongo.nodes.all(resp))
             self._log_levelup(active_missions, game_values)
         return response
 
     @dd_protected
     @jsonrpc_method(endpoint='api')
+    @retry_on_conflict
     def buyKarma(self, token, karmalauter):
         NOT_FOUND = 1
         KARMALAUTER_UNAVAILABLE = 2
@@ -943,10 +1121,9 @@ class ApiHandler(BaseHandler):
         BUBU = 4
         xp_increment = 1
         query_base = self.game_query_base
-        db = self.mongo.get_db()
         query_find = {}
         query_find.update(query_base)
-        orig_data = db['games'].find_one(query_find, {'version': 1, 'nodes_lock': 1, 'game_values': 1, 'active_missions': 1})
+        orig_data = self.games.find_one(query_find, {'version': 1, 'nodes_lock': 1, 'game_values': 1, 'active_missions': 1})
         if orig_data is None:
             return {'error': NOT_FOUND}
         game_values = orig_data['game_values']
@@ -982,13 +1159,13 @@ class ApiHandler(BaseHandler):
         query_set['$inc'].update(inc_update)
         query_set['$set'].update(set_update)
 
-        resp = db['games'].find_and_modify(query=query_find,
-                                           update=query_set,
-                                           upsert=False,
-                                           new=True,
-                                           fields={'game_values': 1})
+        resp = self.games.find_and_modify(query=query_find,
+                                          update=query_set,
+                                          upsert=False,
+                                          new=True,
+                                          fields={'game_values': 1})
         if resp is None:
-            return {'error': BUBU}
+            raise WriteConflict(BUBU)
         response = {'game_values': resp['game_values']}
         if levelup:
             response.update({'levelup': levelup})
@@ -998,25 +1175,35 @@ class ApiHandler(BaseHandler):
 
     @dd_protected
     @jsonrpc_method(endpoint='api')
-    def buyPerp(self, token, parent_path, perp_gestalt):
+    @retry_on_conflict
+    def buyPerp(self, token, parent_path, perp_gestalt, delta=False):
         NOT_FOUND = 1
         NOT_ENOUGH_CASH = 2
         PERP_UNAVAILABLE = 3
         BUBU = 4
         xp_increment = 1
         query_base = self.game_query_base
-        db = self.mongo.get_db()
+        db = self.mongo.get_db('missions')
         parent_database = parent_path=='Database'
         if not parent_database:
-            query_find = {'nodes.full_path': parent_path}
+            query_find = self.mongo.nodes.find(parent_path)
         else:
             query_find = {}
         query_find.update(query_base)
-        orig_data = db['games'].find_one(query_find, {'nodes': 1, 'version': 1, 'nodes_lock': 1, 'game_values': 1, 'mission_goals': 1, 'active_missions': 1})
+        fields = {'version': 1, 'nodes_lock': 1, 'game_values': 1, 'mission_goals': 1, 'active_missions': 1}
+        fields.update(self.mongo.nodes.fields())
+        fields.update(self.mongo.queues.fields())
+        orig_data = self.games.find_one(query_find, fields)
         if orig_data is None:
             return {'error': NOT_FOUND}
+        queues = self.mongo.queues.begin(orig_data)
+        if not parent_database:
+            parent_node = self.mongo.nodes.get(orig_data, parent_path)
+            if parent_node is None:
+                return {'error': NOT_FOUND}
+        layout = self.mongo.nodes.layout_of(orig_data)
         game_values = orig_data['game_values']
-        game_nodes = orig_data['nodes']
+        game_nodes = self.mongo.nodes.all(orig_data)
         version = orig_data.get('version', 1)
         rules = self._get_rules(version=version)
         perp_data = rules.perps.get(perp_gestalt, rules.tokens.get(perp_gestalt, None))
@@ -1027,7 +1214,6 @@ class ApiHandler(BaseHandler):
         if game_values['cash_value'] < price:
             return {'error': NOT_ENOUGH_CASH}
         if not parent_database:
-            parent_node = [node for node in game_nodes if node['full_path']==parent_path][0]
             parent_gestalt = parent_node['full_type'].split(':')[-1]
             ParentPerp = PerpNode(parent_gestalt, node_data=parent_node, rules=rules, game_id=parent_path.split('.')[-1], game_values=game_values, game_nodes=game_nodes)
         else:
@@ -1039,6 +1225,7 @@ class ApiHandler(BaseHandler):
         response_extra = {}
         mh = MissionHandler(version,
                             self.session_language,
+                            rules=self._get_rules_version(version),
                             goal_data=orig_data.get('mission_goals', []),
                             active_missions=orig_data.get('active_missions', []),
                             game_nodes=game_nodes,
@@ -1074,17 +1261,18 @@ class ApiHandler(BaseHandler):
                 self._log_mission_complete(m, game_values)
             profile_sets = rewards.get('profile_sets', [])
             if len(profile_sets)>0:
-                query_set['$push'].update({'db_queue': {'$each': profile_sets}})
+                for profile_set in profile_sets:
+                    queues.put('db_queue', profile_set)
         if NewPerp.game_type=='CityPerp':
             db_size_inc = NewPerp.city_db_inc
             queue_ps = {'origin': new_node['full_path'],
                         'collect_id': unicode(ObjectId()),
                         'profile_set': NewPerp.add_profileset(),
                         'collect_dt': datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)}
-            query_set['$push'].update({'db_queue': queue_ps})
+            queues.put('db_queue', queue_ps)
             query_set['$inc'].update({'game_values.profiles_max': db_size_inc})
             response_extra.update({'profile_set': queue_ps,})
-        query_set['$push'].update({'nodes': new_node})
+        self.mongo.nodes.add(layout, query_set, new_node)
         new_xp = game_values['xp_value'] + xp_increment + rewards.get('xp_value', 0)
         # levelup
         levelup, inc_update, set_update, next_levelinfo = self._handle_levelup(new_xp, game_values['xp_value'], version)
@@ -1093,29 +1281,35 @@ class ApiHandler(BaseHandler):
 
         query_find = {'game_values.cash_value': {'$gte': price}}
         if not parent_database:
-            query_find.update({'nodes.full_path': parent_path})
+            query_find.update(self.mongo.nodes.match(layout, parent_path))
         query_find.update(query_base)
         if orig_data.get('nodes_lock', None) is None:
             query_find.update({'nodes_lock': {'$exists': False}})
         else:
             query_find.update({'nodes_lock': orig_data['nodes_lock']})
-        resp = db['games'].find_and_modify(query=query_find,
-                                           update=query_set,
-                                           upsert=False,
-                                           new=True,
-                                           fields={'game_values': 1, 'nodes': 1})
+        if not queues.prepare(query_find, query_set):
+            raise WriteConflict(BUBU)
+        resp = self.games.find_and_modify(query=query_find,
+                                          update=query_set,
+                                          upsert=False,
+                                          new=True,
+                                          fields=self._mutation_fields(query_set, delta))
         if resp is None:
-            return {'error': BUBU}
+            queues.abort()
+            raise WriteConflict(BUBU)
+        queues.commit()
         response = {'node': new_node,
                     'game_values': resp['game_values']}
         response.update(response_extra)
+        # xp_level is only returned with delta if it changed
+        level = response['game_values'].get('xp_level', game_values['xp_level'])
         if levelup:
             response.update({'levelup': levelup})
             response['game_values'].update({'ap_initial': next_levelinfo['ap_max']})
-            self._deferred_levelup(level=response['game_values']['xp_level'], version=version, nodes=resp['nodes'])
+            self._deferred_levelup(level=level, version=version, nodes=game_nodes + [new_node])
             self._log_levelup(orig_data.get('active_missions', []), game_values)
-        self._deferred_buyperp(level=response['game_values']['xp_level'], version=version, provider_gestalt=perp_gestalt, nodes=game_nodes)
-        logAction.apply_async(kwargs={
+        self._deferred_buyperp(level=level, version=version, provider_gestalt=perp_gestalt, nodes=game_nodes)
+        self._log_action({
             'action': 'buyperp',
             'uid': self.auth_uid,
             'time': datetime.datetime.utcnow().replace(tzinfo=pytz.UTC),
@@ -1134,27 +1328,31 @@ class ApiHandler(BaseHandler):
         parent_database = perp_full_path=='Database'
         query_find = {}
         if not parent_database:
-            query_find = {'nodes.full_path': perp_full_path}
+            query_find = self.mongo.nodes.find(perp_full_path)
         query_find.update(query_base)
-        db = self.mongo.get_db()
-        orig_data = db['games'].find_one(query_find, {'nodes': 1, 'version': 1, 'game_values': 1})
+        fields = {'version': 1, 'game_values': 1}
+        fields.update(self.mongo.nodes.fields())
+        orig_data = self.read_games('provided_perps').find_one(query_find, fields)
         if orig_data is None:
             return {'error': NOT_FOUND}
         game_values = orig_data['game_values']
-        game_nodes = orig_data['nodes']
+        game_nodes = self.mongo.nodes.all(orig_data)
         rules = self._get_rules(version=orig_data.get('version', 1))
         if perp_full_path=='Database':
             node = {'full_path': 'Database'}
             gestalt = '__DATABASE__'
         else:
-            node = [node for node in game_nodes if node['full_path']==perp_full_path][0]
+            node = self.mongo.nodes.get(orig_data, perp_full_path)
+            if node is None:
+                return {'error': NOT_FOUND}
             gestalt = node['full_type'].split(':')[-1]
         perp = PerpNode(gestalt, node_data=node, rules=rules, game_id=node['full_path'].split('.')[-1], game_values=game_values, game_nodes=game_nodes)
         return {'buyable': perp.get_addable()}
 
     @dd_protected
     @jsonrpc_method(endpoint='api')
-    def sellPowerup(self, token, perp_full_path, slot, powerup):
+    @retry_on_conflict
+    def sellPowerup(self, token, perp_full_path, slot, powerup, delta=False):
         NOT_FOUND = 0
         SLOT_EMPTY = 1
         POWERUP_RULES_FAILURE = 2
@@ -1165,14 +1363,16 @@ class ApiHandler(BaseHandler):
         xp_increment = 1
         sell_factor = 0.75
         query_base = self.game_query_base
-        db = self.mongo.get_db()
-        query_find = {'nodes.full_path': perp_full_path}
+        query_find = self.mongo.nodes.find(perp_full_path)
         query_find.update(query_base)
-        orig_data = db['games'].find_one(query_find, {'nodes.$': 1, 'version': 1, 'nodes_lock': 1, 'game_values': 1, 'active_missions': 1})
-        if orig_data is None:
+        fields = {'version': 1, 'nodes_lock': 1, 'game_values': 1, 'active_missions': 1}
+        fields.update(self.mongo.nodes.fields(perp_full_path))
+        orig_data = self.games.find_one(query_find, fields)
+        node_data = None if orig_data is None else self.mongo.nodes.get(orig_data, perp_full_path)
+        if node_data is None:
             return {'error': NOT_FOUND}
+        layout = self.mongo.nodes.layout_of(orig_data)
         game_values = orig_data['game_values']
-        node_data = orig_data['nodes'][0]
         version = orig_data.get('version', 1)
         rules = self._get_rules(version=version)
         slots = node_data.get('instance_data', {}).get('powerups', [])
@@ -1189,24 +1389,23 @@ class ApiHandler(BaseHandler):
             powerup_type = [p_type for p_type in self.powerup_types if powerup.startswith(p_type)][0]
         except IndexError:
             return {'error': POWERUP_RULES_FAILURE}
-        perp_specifics = [data for data in project_typedata.get('provided_%ss' % powerup_type, {}) if data.get('gestalt')==powerup]
-        if len(perp_specifics)<1:
+        powerup_perp_data = rules.project_powerups(perp_gestalt).get_item('provided_%ss' % powerup_type, powerup)
+        if powerup_perp_data is None:
             return {'error': POWERUP_RULES_FAILURE}
-        powerup_perp_data = perp_specifics[0]
         if game_values['xp_level'] < powerup_perp_data.get('required_level', 0):
             return {'error': POWERUP_NOT_AVAILABLE}
         price = powerup_perp_data.get('price', 0)
         sell_price = int(price*sell_factor)
         # remove modifiers
         # TODO evtl. problem wenn keine werte in instance_data, aber vorinstallierte powerups in default_game
-        new_chargecollect_values = dict(('nodes.$.instance_data.%s' % val, node_data.get('instance_data', {}).get(val, project_typedata.get(val)) - powerup_perp_data.get('%s_modifier' % val, 0)) for val in ('charge_cost', 'collect_amount', 'collect_risk'))
+        new_chargecollect_values = dict((self.mongo.nodes.field(layout, perp_full_path, 'instance_data.%s' % val), node_data.get('instance_data', {}).get(val, project_typedata.get(val)) - powerup_perp_data.get('%s_modifier' % val, 0)) for val in ('charge_cost', 'collect_amount', 'collect_risk'))
         # remove powerup tokens from project result
         old_tokens = node_data.get('instance_data', {}).get('tokens', project_typedata.get('tokens', []))
         new_tokens = powerup_data.get('type_data', {}).get('tokens', [])
         tokens_updated = self._mergeTokens(old_tokens, new_tokens, minus=True)
-        new_chargecollect_values.update({'nodes.$.instance_data.tokens': tokens_updated})
+        new_chargecollect_values.update({self.mongo.nodes.field(layout, perp_full_path, 'instance_data.tokens'): tokens_updated})
         # remove slot
-        new_chargecollect_values.update({'nodes.$.instance_data.powerups': [pup for pup in node_data.get('instance_data', {}).get('powerups', []) if not (pup.get('slot')==slot and pup.get('gestalt')==powerup)]})
+        new_chargecollect_values.update({self.mongo.nodes.field(layout, perp_full_path, 'instance_data.powerups'): [pup for pup in node_data.get('instance_data', {}).get('powerups', []) if not (pup.get('slot')==slot and pup.get('gestalt')==powerup)]})
         # write-out node
         query_set = {
             '$set': new_chargecollect_values,
@@ -1222,32 +1421,33 @@ class ApiHandler(BaseHandler):
         query_set['$inc'].update(inc_update)
         query_set['$set'].update(set_update)
 
-        query_find = {'nodes.full_path': perp_full_path}
+        query_find = self.mongo.nodes.match(layout, perp_full_path)
         query_find.update(query_base)
         if orig_data.get('nodes_lock', None) is None:
             query_find.update({'nodes_lock': {'$exists': False}})
         else:
             query_find.update({'nodes_lock': orig_data['nodes_lock']})
-        resp = db['games'].find_and_modify(query=query_find,
-                                           update=query_set,
-                                           upsert=False,
-                                           new=True,
-                                           fields={'game_values': 1, 'nodes': 1})
+        resp = self.games.find_and_modify(query=query_find,
+                                          update=query_set,
+                                          upsert=False,
+                                          new=True,
+                                          fields=self._mutation_fields(query_set, delta, node=perp_full_path, nodes=levelup))
         if resp is None:
-            return {'error': BUBU}
-        mynode = [node for node in resp['nodes'] if node['full_path']==perp_full_path][0]
+            raise WriteConflict(BUBU)
+        mynode = self.mongo.nodes.get(resp, perp_full_path)
         response = {'node': mynode,
                     'game_values': resp['game_values']}
         if levelup:
             response.update({'levelup': levelup})
             response['game_values'].update({'ap_initial': next_levelinfo['ap_max']})
             self._log_levelup(orig_data.get('active_missions', []), game_values)
-            self._deferred_levelup(level=response['game_values']['xp_level'], version=version, nodes=resp['nodes'])
+            self._deferred_levelup(level=response['game_values']['xp_level'], version=version, nodes=self.mongo.nodes.all(resp))
         return response
 
     @dd_protected
     @jsonrpc_method(endpoint='api')
-    def buyPowerup(self, token, perp_full_path, slot, powerup):
+    @retry_on_conflict
+    def buyPowerup(self, token, perp_full_path, slot, powerup, delta=False):
         """WIP"""
         NOT_FOUND = 0
         SLOT_UNAVAILABLE = 1
@@ -1256,14 +1456,19 @@ class ApiHandler(BaseHandler):
         BUBU = 4 # second-check on ap failed, should not happen
         xp_increment = 1
         query_base = self.game_query_base
-        db = self.mongo.get_db()
-        query_find = {'nodes.full_path': perp_full_path}
+        db = self.mongo.get_db('missions')
+        query_find = self.mongo.nodes.find(perp_full_path)
         query_find.update(query_base)
-        orig_data = db['games'].find_one(query_find, {'nodes.$': 1, 'version': 1, 'nodes_lock': 1, 'game_values': 1, 'mission_goals': 1, 'active_missions': 1})
-        if orig_data is None:
+        fields = {'version': 1, 'nodes_lock': 1, 'game_values': 1, 'mission_goals': 1, 'active_missions': 1}
+        fields.update(self.mongo.nodes.fields(perp_full_path))
+        fields.update(self.mongo.queues.fields())
+        orig_data = self.games.find_one(query_find, fields)
+        node_data = None if orig_data is None else self.mongo.nodes.get(orig_data, perp_full_path)
+        if node_data is None:
             return {'error': NOT_FOUND}
+        layout = self.mongo.nodes.layout_of(orig_data)
+        queues = self.mongo.queues.begin(orig_data)
         game_values = orig_data['game_values']
-        node_data = orig_data['nodes'][0]
         version = orig_data.get('version', 1)
         rules = self._get_rules(version=version)
         # get powerup data
@@ -1276,10 +1481,9 @@ class ApiHandler(BaseHandler):
             powerup_type = [p_type for p_type in self.powerup_types if powerup.startswith(p_type)][0]
         except IndexError:
             return {'error': POWERUP_UNAVAILABLE}
-        perp_specifics = [data for data in project_typedata.get('provided_%ss' % powerup_type, {}) if data.get('gestalt')==powerup]
-        if len(perp_specifics)<1:
+        powerup_perp_data = rules.project_powerups(perp_gestalt).get_item('provided_%ss' % powerup_type, powerup)
+        if powerup_perp_data is None:
             return {'error': POWERUP_UNAVAILABLE}
-        powerup_perp_data = perp_specifics[0]
         price = powerup_perp_data.get('price', 0)
         if game_values['cash_value'] < price:
             return {'error': NOT_ENOUGH_CASH}
@@ -1296,28 +1500,30 @@ class ApiHandler(BaseHandler):
 
         # update node values, add powerup to slot
         new_powerup_slot = {'slot': slot, 'gestalt': powerup, 'full_type': powerup_perp_data['full_type']}
-        new_chargecollect_values = dict(('nodes.$.instance_data.%s' % val, node_data.get('instance_data', {}).get(val, project_typedata.get(val)) + powerup_perp_data.get('%s_modifier' % val, 0)) for val in ('charge_cost', 'collect_amount', 'collect_risk'))
+        new_chargecollect_values = dict((self.mongo.nodes.field(layout, perp_full_path, 'instance_data.%s' % val), node_data.get('instance_data', {}).get(val, project_typedata.get(val)) + powerup_perp_data.get('%s_modifier' % val, 0)) for val in ('charge_cost', 'collect_amount', 'collect_risk'))
 
         old_tokens = node_data.get('instance_data', {}).get('tokens', project_typedata.get('tokens', []))
         new_tokens = powerup_data.get('type_data', {}).get('tokens', [])
         updated_tokens = self._mergeTokens(old_tokens, new_tokens)
 
-        new_chargecollect_values.update({'nodes.$.instance_data.tokens': updated_tokens})
+        new_chargecollect_values.update({self.mongo.nodes.field(layout, perp_full_path, 'instance_data.tokens'): updated_tokens})
 
         response_extra = {}
         mh = MissionHandler(version,
                             self.session_language,
+                            rules=self._get_rules_version(version),
                             goal_data=orig_data.get('mission_goals', []),
                             active_missions=orig_data.get('active_missions', []),
                             game_nodes = None,
                             db=db,
+                            node_store=self.mongo.nodes,
                             game_id=orig_data['_id'],
                             game_values=game_values)
         goals_met = mh.handle_buypowerup(perp_gestalt, powerup)
         rewards = mh.compute_rewards()
         response_extra = {}
         query_set = {
-            '$push': {'nodes.$.instance_data.powerups': new_powerup_slot},
+            '$push': {self.mongo.nodes.field(layout, perp_full_path, 'instance_data.powerups'): new_powerup_slot},
             '$set': new_chargecollect_values,
             '$inc': {
                      'game_values.xp_value': xp_increment + rewards.get('xp_value', 0),
@@ -1342,7 +1548,8 @@ class ApiHandler(BaseHandler):
                 self._log_mission_complete(m, game_values)
             profile_sets = rewards.get('profile_sets', [])
             if len(profile_sets)>0:
-                query_set['$push'].update({'db_queue': {'$each': profile_sets}})
+                for profile_set in profile_sets:
+                    queues.put('db_queue', profile_set)
 
         levelup = False
         new_xp = game_values['xp_value'] + xp_increment + rewards.get('xp_value', 0)
@@ -1351,30 +1558,34 @@ class ApiHandler(BaseHandler):
         query_set['$inc'].update(inc_update)
         query_set['$set'].update(set_update)
 
-        query_find = {'nodes.full_path': perp_full_path,
-                      'game_values.cash_value': {'$gte': price}}
+        query_find = self.mongo.nodes.match(layout, perp_full_path)
+        query_find.update({'game_values.cash_value': {'$gte': price}})
         query_find.update(query_base)
         if orig_data.get('nodes_lock', None) is None:
             query_find.update({'nodes_lock': {'$exists': False}})
         else:
             query_find.update({'nodes_lock': orig_data['nodes_lock']})
-        resp = db['games'].find_and_modify(query=query_find,
-                                           update=query_set,
-                                           upsert=False,
-                                           new=True,
-                                           fields={'game_values': 1, 'nodes': 1})
+        if not queues.prepare(query_find, query_set):
+            raise WriteConflict(BUBU)
+        resp = self.games.find_and_modify(query=query_find,
+                                          update=query_set,
+                                          upsert=False,
+                                          new=True,
+                                          fields=self._mutation_fields(query_set, delta, node=perp_full_path, nodes=levelup))
         if resp is None:
-            return {'error': BUBU}
-        mynode = [node for node in resp['nodes'] if node['full_path']==perp_full_path][0]
+            queues.abort()
+            raise WriteConflict(BUBU)
+        queues.commit()
+        mynode = self.mongo.nodes.get(resp, perp_full_path)
         response = {'node': mynode,
                     'game_values': resp['game_values']}
         response.update(response_extra)
         if levelup:
             response.update({'levelup': levelup})
             response['game_values'].update({'ap_initial': next_levelinfo['ap_max']})
-            self._deferred_levelup(level=response['game_values']['xp_level'], version=version, nodes=resp['nodes'])
+            self._deferred_levelup(level=response['game_values']['xp_level'], version=version, nodes=self.mongo.nodes.all(resp))
             self._log_levelup(orig_data.get('active_missions', []), game_values)
-        logAction.apply_async(kwargs={
+        self._log_action({
             'action': 'buypowerup',
             'uid': self.auth_uid,
             'time': datetime.datetime.utcnow().replace(tzinfo=pytz.UTC),
@@ -1397,9 +1608,11 @@ class ApiHandler(BaseHandler):
         :returns: json encoded list of powerups for given game_type
         :rtype: json array
         """
-        from dd_app.rules import RulesVersion
-        r = RulesVersion(version=version, lang=self.session_language)
-        return r.get_powerups_for_project(project_type)
+        rv = self._get_rules_version(version)
+        if not rv.rules.has_project(project_type):
+            # unknown projects share the empty table's encoding
+            project_type = None
+        return rv.rules.encoded(('powerups', project_type), lambda: rv.get_powerups_for_project(project_type))
 
     @dd_protected
     @jsonrpc_method(endpoint='api')
@@ -1413,7 +1626,8 @@ class ApiHandler(BaseHandler):
         :returns: json encoded list of tokens for given game version
         :rtype: json array
         """
-        return self._get_rules(version=version).tokens
+        rules = self._get_rules(version=version)
+        return rules.encoded('tokens', lambda: rules.localized('tokens'))
 
     @dd_protected
     @jsonrpc_method(endpoint='api')
@@ -1434,6 +1648,7 @@ class ApiHandler(BaseHandler):
             return {'error': 0}
         db = self.mongo.get_db()
         resp = db['users'].update(query_base, {'$set': {'display_name': display_name_clean}}, safe=True, upsert=False, multi=False)
+        self.mongo.invalidate_user(self.auth_uid, oid)
         if resp.get('n', 0)<1:
             return {'error': 1}
         return True
@@ -46,6 +46,10 @@ setup(name='dd_app',
       entry_points = """\
       [paste.app_factory]
       main = dd_app:main
+      [console_scripts]
+      dd_compile_rules = dd_app.scripts.compile_rules:main
+      dd_migrate_nodes = dd_app.scripts.migrate_nodes:main
+      dd_ensure_indexes = dd_app.scripts.ensure_indexes:main
       """,
       )
 